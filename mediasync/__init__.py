@@ -4,6 +4,13 @@ import gzip
 import hashlib
 import mimetypes
 import os
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 JS_MIMETYPES = (
     "application/javascript",
@@ -21,22 +28,325 @@ TYPES_TO_COMPRESS = (
     "text/xml",
 ) + JS_MIMETYPES + CSS_MIMETYPES
 
+# read size used when streaming large files
+CHUNK_SIZE = 64 * 1024
+
+# file extensions of the pre-compressed variants, by content encoding
+ENCODING_EXTENSIONS = {
+    'br': 'brt',
+    'gzip': 'gzt',
+}
+
+# levels used for a COMPRESS_LEVEL of 'max', by content encoding
+MAX_LEVELS = {
+    'br': 11,
+    'gzip': 9,
+}
+
 class SyncException(Exception):
     pass
 
+class PreparedData(str):
+    """
+    Processed file data that carries its checksum and, for content types
+    that are compressed, its compressed variants. checksum() and
+    compress_variants() return these instead of calculating them again, so
+    the work can be done ahead of time, e.g. by a worker process.
+    """
+    checksum = None
+    variants = None
+
+class Timing(object):
+    """
+    Times a phase of syncing a file and sends the sync_timing signal when
+    the phase is done. size is the number of bytes that went into the phase
+    and size_out, which can be set while the phase runs, the number of
+    bytes that came out. Other keyword arguments are sent with the signal.
+    
+        with Timing('compress', remote_path, content_type, len(data), encoding='gzip') as t:
+            compressed = compress(data)
+            t.size_out = len(compressed)
+    
+    Nothing is sent if the phase raises an exception. Phases that don't
+    fit in a with block are timed with start() and stop().
+    """
+
+    def __init__(self, phase, remote_path=None, content_type=None, size=None, **info):
+        self.phase = phase
+        self.remote_path = remote_path
+        self.content_type = content_type
+        self.size = size
+        self.size_out = None
+        self.info = info
+
+    def start(self):
+        self.started = time.time()
+        return self
+
+    def stop(self):
+        duration = time.time() - self.started
+        from mediasync.signals import sync_timing
+        if sync_timing.receivers:
+            sync_timing.send(sender=self.__class__, phase=self.phase, remote_path=self.remote_path,
+                             content_type=self.content_type, duration=duration, size=self.size,
+                             size_out=self.size_out, **self.info)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.stop()
+
 def checksum(data):
+    if getattr(data, 'checksum', None) is not None:
+        return data.checksum
     checksum = hashlib.md5(data)
     hexdigest = checksum.hexdigest()
     b64digest = base64.b64encode(checksum.digest())
     return (hexdigest, b64digest)
 
-def compress(s):
+def checksum_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Same as checksum(), but reads the file in chunks instead of loading the
+    whole thing into memory.
+    """
+    checksum = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            checksum.update(chunk)
+    finally:
+        f.close()
+    hexdigest = checksum.hexdigest()
+    b64digest = base64.b64encode(checksum.digest())
+    return (hexdigest, b64digest)
+
+def compression_level(content_type=None, encoding='gzip'):
+    """
+    Returns the level used to compress content_type with encoding. The
+    level is taken from COMPRESS_LEVELS, falling back to COMPRESS_LEVEL. A
+    level of 'max' is the slowest and smallest the encoding offers.
+    """
+    from mediasync.conf import msettings
+    level = (msettings['COMPRESS_LEVELS'] or {}).get(content_type, msettings['COMPRESS_LEVEL'])
+    if level == 'max':
+        return MAX_LEVELS[encoding]
+    return min(int(level), MAX_LEVELS[encoding])
+
+def _gzip_file(fileobj, level):
+    # a fixed mtime and no file name in the header make the output depend
+    # on nothing but the input, so unchanged files compress identically
+    return gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=fileobj, mtime=0)
+
+def compress(s, level=None):
+    if level is None:
+        level = compression_level()
     zbuf = cStringIO.StringIO()
-    zfile = gzip.GzipFile(mode='wb', compresslevel=6, fileobj=zbuf)
+    zfile = _gzip_file(zbuf, level)
     zfile.write(s)
     zfile.close()
     return zbuf.getvalue()
 
+def compress_brotli(s, level=None):
+    if brotli is None:
+        raise SyncException("The brotli module is required for Brotli compression")
+    if level is None:
+        level = compression_level(encoding='br')
+    return brotli.compress(s, mode=brotli.MODE_TEXT, quality=level)
+
+COMPRESSORS = {
+    'br': compress_brotli,
+    'gzip': compress,
+}
+
+def is_worth_compressing(size, compressed_size=None):
+    """
+    Applies the compression policy: a compressed variant is kept if the
+    original is at least COMPRESS_MIN_SIZE bytes and, when compressed_size
+    is known and COMPRESS_MIN_RATIO is set, compression shrank it by at
+    least COMPRESS_MIN_RATIO.
+    """
+    from mediasync.conf import msettings
+    if size < msettings['COMPRESS_MIN_SIZE']:
+        return False
+    ratio = msettings['COMPRESS_MIN_RATIO']
+    if compressed_size is None or ratio is None:
+        return True
+    return size >= compressed_size * ratio and compressed_size < size
+
+def may_skip_variants():
+    """
+    True if the compression policy can leave out the compressed variants of
+    a file. Without a policy, every file of a compressed type gets them.
+    """
+    from mediasync.conf import msettings
+    return bool(msettings['COMPRESS_MIN_SIZE']) or msettings['COMPRESS_MIN_RATIO'] is not None
+
+def compress_variants(filedata, content_type, encodings, remote_path=None):
+    """
+    Compresses filedata with each of encodings and returns a dict of content
+    encoding to compressed data, leaving out the variants that aren't worth
+    keeping. Results are stored on PreparedData so the work is only done
+    once per file. remote_path is only used to report the timing.
+    """
+    cached = getattr(filedata, 'variants', None)
+    variants = {}
+    for encoding in encodings:
+        if cached is not None and encoding in cached:
+            compressed = cached[encoding]
+        else:
+            compressed = None
+            if is_worth_compressing(len(filedata)):
+                with Timing('compress', remote_path, content_type, len(filedata), encoding=encoding) as t:
+                    compressed = COMPRESSORS[encoding](filedata, compression_level(content_type, encoding))
+                    t.size_out = len(compressed)
+                if not is_worth_compressing(len(filedata), len(compressed)):
+                    compressed = None
+            if cached is not None:
+                cached[encoding] = compressed
+        if compressed is not None:
+            variants[encoding] = compressed
+    return variants
+
+def streamed_variants(size, content_type, encodings):
+    """
+    Returns the encodings a streamed file of size bytes is compressed with.
+    Streamed files are only compressed after they are handed to the backend,
+    so only COMPRESS_MIN_SIZE is applied; files this large compress well.
+    """
+    if is_worth_compressing(size):
+        return list(encodings)
+    return []
+
+class CompressionStats(object):
+    """
+    Totals of original and compressed bytes per content type, reported at
+    the end of a sync.
+    """
+
+    def __init__(self):
+        self.types = {}
+        self._lock = threading.Lock()
+
+    def add(self, content_type, size, variants):
+        with self._lock:
+            totals = self.types.setdefault(content_type, {'files': 0, 'size': 0, 'variants': {}})
+            totals['files'] += 1
+            totals['size'] += size
+            for encoding, compressed in variants.iteritems():
+                totals['variants'][encoding] = totals['variants'].get(encoding, 0) + len(compressed)
+
+    def summary(self):
+        lines = []
+        for content_type in sorted(self.types):
+            totals = self.types[content_type]
+            line = "%s: %d files, %d bytes" % (content_type, totals['files'], totals['size'])
+            for encoding in sorted(totals['variants']):
+                saved = totals['size'] - totals['variants'][encoding]
+                line += ", %s saved %d bytes (%d%%)" % (
+                    encoding, saved, 100 * saved / totals['size'] if totals['size'] else 0)
+            lines.append(line)
+        return lines
+
+class _HashingWriter(object):
+    """
+    File-like wrapper that checksums everything written through it.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.checksum = hashlib.md5()
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+def compress_file(path, fileobj, chunk_size=CHUNK_SIZE, level=None):
+    """
+    Gzips the file at path into fileobj in chunks, so that memory use stays
+    bounded for large files. Returns the checksum of the compressed data,
+    which is calculated as it is written.
+    """
+    if level is None:
+        level = compression_level()
+    writer = _HashingWriter(fileobj)
+    zfile = _gzip_file(writer, level)
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            zfile.write(chunk)
+    finally:
+        f.close()
+    zfile.close()
+    hexdigest = writer.checksum.hexdigest()
+    b64digest = base64.b64encode(writer.checksum.digest())
+    return (hexdigest, b64digest)
+
+def compress_file_brotli(path, fileobj, chunk_size=CHUNK_SIZE, level=None):
+    """
+    Same as compress_file(), but with Brotli instead of gzip.
+    """
+    if brotli is None:
+        raise SyncException("The brotli module is required for Brotli compression")
+    if level is None:
+        level = compression_level(encoding='br')
+    writer = _HashingWriter(fileobj)
+    compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=level)
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            writer.write(compressor.process(chunk))
+    finally:
+        f.close()
+    writer.write(compressor.finish())
+    hexdigest = writer.checksum.hexdigest()
+    b64digest = base64.b64encode(writer.checksum.digest())
+    return (hexdigest, b64digest)
+
+FILE_COMPRESSORS = {
+    'br': compress_file_brotli,
+    'gzip': compress_file,
+}
+
+def compress_file_variant(path, fileobj, content_type, encoding):
+    """
+    Compresses the file at path into fileobj for a content encoding, at the
+    compression level for content_type. Returns the checksum of the
+    compressed data.
+    """
+    return FILE_COMPRESSORS[encoding](path, fileobj, level=compression_level(content_type, encoding))
+
+class _CountingFile(object):
+    """
+    File-like object that only counts the bytes written to it.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+def measure_file_variants(path, content_type, encodings):
+    """
+    Compresses the file at path with each of encodings without keeping the
+    output. Returns a dict of content encoding to the (checksum, size) of
+    the compressed data.
+    """
+    measured = {}
+    for encoding in encodings:
+        counter = _CountingFile()
+        digest = compress_file_variant(path, counter, content_type, encoding)
+        measured[encoding] = (digest, counter.size)
+    return measured
+
 def is_syncable_dir(dir_str):
     return not dir_str.startswith('.') and not dir_str.startswith('_')
 
@@ -44,23 +354,33 @@ def is_syncable_file(file_str):
     return not file_str.startswith('.') and not file_str.startswith('_')
 
 def listdir_recursive(dir_str):
-    for root, dirs, files in os.walk(dir_str):
-        # Go through and yank any directories that don't pass our syncable
-        # dir test. This needs to be done in place so that walk() will avoid.
-        for dir_candidate in dirs:
-            if not is_syncable_dir(dir_candidate):
-                dirs.remove(dir_candidate)
-
-        basename = os.path.basename(root)
-        if is_syncable_dir(basename):
-            for file in files:
-                fname = os.path.join(root, file).replace(dir_str, '', 1)
-                if fname.startswith('/'):
-                    fname = fname[1:]
-                yield fname
-        else:
-            # "Skipping directory %s" % root
-            pass
+    """
+    Yields the path, relative to dir_str, of each file in it that isn't
+    hidden. See mediasync.tree.scan().
+    """
+    from mediasync.tree import scan
+    for media_file in scan(dir_str):
+        yield media_file.path
+
+def joined_dirname(joinfile):
+    """
+    Returns the directory that the sources of a combo file are relative to,
+    or None if the file can not be combo'd.
+    """
+    from mediasync.conf import msettings
+
+    if joinfile.endswith('.css'):
+        return msettings['CSS_PATH'].strip('/')
+    elif joinfile.endswith('.js'):
+        return msettings['JS_PATH'].strip('/')
+
+def joined_sources(joinfile, sourcefiles, client):
+    """
+    Returns the absolute paths of the files that make up a combo file.
+    """
+    dirname = joined_dirname(joinfile.strip('/'))
+    return [os.path.join(client.media_root, dirname, sourcefile)
+            for sourcefile in sourcefiles]
 
 def combine_files(joinfile, sourcefiles, client):
     """
@@ -70,24 +390,21 @@ def combine_files(joinfile, sourcefiles, client):
     Returns a string containing the combo file, or None if the specified
     file can not be combo'd.
     """
-    from mediasync.conf import msettings
-
     joinfile = joinfile.strip('/')
 
     if joinfile.endswith('.css'):
-        dirname = msettings['CSS_PATH'].strip('/')
         separator = '\n'
     elif joinfile.endswith('.js'):
-        dirname = msettings['JS_PATH'].strip('/')
         separator = ';\n'
     else:
         # By-pass this file since we only join CSS and JS.
         return None
 
+    dirname = joined_dirname(joinfile)
+
     buffer = cStringIO.StringIO()
 
-    for sourcefile in sourcefiles:
-        sourcepath = os.path.join(client.media_root, dirname, sourcefile)
+    for sourcepath in joined_sources(joinfile, sourcefiles, client):
         if os.path.isfile(sourcepath):
             f = open(sourcepath)
             buffer.write(f.read())
@@ -98,79 +415,761 @@ def combine_files(joinfile, sourcefiles, client):
     buffer.close()
     return (filedata, dirname)
 
-def sync(client=None, force=False, verbose=True):
+class SyncItem(object):
+    """
+    A single file that sync() will push to the backend. Joined files are
+    combined lazily so that nothing is read until the item is synced.
+    """
+
+    def __init__(self, remote_path, content_type, size, filepath=None,
+                 joinfile=None, sourcefiles=None, sources=None, mtime=None):
+        self.remote_path = remote_path
+        self.content_type = content_type
+        self.size = size
+        self.filepath = filepath
+        # mtime of filepath when it was listed, saves a stat
+        self.mtime = mtime
+        self.joinfile = joinfile
+        self.sourcefiles = sourcefiles
+        # absolute paths of the local files this item is built from
+        self.sources = sources or [filepath]
+
+    def read(self, client):
+        if self.joinfile:
+            return combine_files(self.joinfile, self.sourcefiles, client)[0]
+        f = open(self.filepath, 'rb')
+        filedata = f.read()
+        f.close()
+        return filedata
+
+def joined_items(client):
+    """
+    Generates a SyncItem for each combo file defined in the JOINED setting.
+    """
+    from mediasync.conf import msettings
+
+    for joinfile, sourcefiles in msettings['JOINED'].iteritems():
+
+        joinfile = joinfile.strip('/')
+
+        dirname = joined_dirname(joinfile)
+        if dirname is None:
+            # combine_files() is only interested in CSS/JS files.
+            continue
+
+        content_type = mimetypes.guess_type(joinfile)[0] or msettings['DEFAULT_MIMETYPE']
+
+        remote_path = joinfile
+        if dirname:
+            remote_path = "%s/%s" % (dirname, remote_path)
+
+        size = 0
+        sources = joined_sources(joinfile, sourcefiles, client)
+        for sourcepath in sources:
+            if os.path.isfile(sourcepath):
+                size += os.path.getsize(sourcepath)
+
+        yield SyncItem(remote_path, content_type, size, joinfile=joinfile,
+                       sourcefiles=sourcefiles, sources=sources)
+
+def static_items(client):
+    """
+    Generates a SyncItem for each syncable file in the media root.
+    """
+    from mediasync.tree import scan, sync_rules
+
+    for media_file in scan(client.media_root, sync_rules()):
+        if '/' in media_file.path: # files in the media root itself aren't synced
+            yield SyncItem(media_file.path, media_file.content_type, media_file.size,
+                           filepath=media_file.filepath, mtime=media_file.mtime)
+
+def static_item(client, remote_path):
+    """
+    Returns a SyncItem for the file at remote_path in the media root, or
+    None if it is hidden, excluded or not a file.
+    """
+    from mediasync.tree import media_file as get_media_file, sync_rules
+
+    if '/' not in remote_path.strip('/') or not sync_rules().allows(remote_path):
+        return None # hidden file or directory, do not upload
+
+    filepath = os.path.abspath(os.path.join(client.media_root, remote_path))
+    media_file = get_media_file(filepath, remote_path)
+    if media_file is None:
+        return None
+    return SyncItem(remote_path, media_file.content_type, media_file.size,
+                    filepath=filepath, mtime=media_file.mtime)
+
+class PreparedItem(object):
+    """
+    The result of reading and processing a SyncItem, ready to be put. If
+    skipped is True the item hasn't changed since it was last synced.
+    Streamed files have no filedata and are put from item.filepath.
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self.skipped = False
+        self.filedata = None
+        self.source_checksum = None
+        self.checksum = None
+        self.name = item.remote_path
+
+def prepare_item(client, item, force=False, state=None, fingerprint=False, precompress=False):
+    """
+    Reads and processes a SyncItem. This does not touch the backend or
+    change the sync state, so it can run in a separate process.
+    
+    If a SyncState is given, files that haven't changed since they were
+    last synced are skipped without being read. Files that were touched but
+    have the same content are skipped without being processed.
+    
+    If fingerprint is True, the item is named with a checksum of its
+    content. If precompress is True, the compressed variants the client
+    uploads are made ahead of time.
+    """
+    return prepare_items(client, [item], force, state, fingerprint, precompress)[0]
+
+def prepare_items(client, items, force=False, state=None, fingerprint=False, precompress=False):
+    """
+    Same as prepare_item() for a list of SyncItems. The files that need
+    processing are run through the processors together, so that a
+    processor that handles several files at once, such as YUI Compressor,
+    only runs once for the list.
+    """
+    prepared_items = []
+    to_process = []
+
+    for item in items:
+        prepared, filedata = _read_item(client, item, force, state, fingerprint)
+        prepared_items.append(prepared)
+        if filedata is not None:
+            to_process.append((prepared, filedata))
+
+    if to_process:
+        processed = client.process_many([(data, p.item.content_type, p.item.remote_path)
+                                         for p, data in to_process])
+        for (prepared, unprocessed), filedata in zip(to_process, processed):
+            _finish_item(client, prepared, filedata, state, fingerprint, precompress)
+
+    return prepared_items
+
+def _read_item(client, item, force, state, fingerprint):
+    """
+    Returns the PreparedItem of a SyncItem and the data to process, which
+    is None if the item is skipped or streamed.
+    """
+    from mediasync.conf import msettings
+    from mediasync.manifest import fingerprint as fingerprint_name
+
+    prepared = PreparedItem(item)
+
+    if state is not None and not force and state.is_fresh(item):
+        prepared.skipped = True
+        return prepared, None
+
+    if item.filepath and item.size >= msettings['STREAMING_THRESHOLD'] and \
+            item.content_type not in JS_MIMETYPES + CSS_MIMETYPES:
+        # Large files that aren't CSS or JS skip the processors and are
+        # streamed to the backend instead of being read into memory.
+        with Timing('read', item.remote_path, item.content_type, item.size, streamed=True):
+            prepared.checksum = checksum_file(item.filepath)
+        prepared.source_checksum = prepared.checksum[0]
+        if state is not None and not force and state.has_source(item, prepared.source_checksum):
+            prepared.skipped = True
+        elif fingerprint:
+            prepared.name = fingerprint_name(item.remote_path, prepared.checksum[0])
+        return prepared, None
+
+    with Timing('read', item.remote_path, item.content_type) as t:
+        filedata = item.read(client)
+        t.size = len(filedata)
+
+    if state is not None:
+        with Timing('checksum', item.remote_path, item.content_type, len(filedata)):
+            prepared.source_checksum = checksum(filedata)[0]
+        if not force and state.has_source(item, prepared.source_checksum):
+            prepared.skipped = True
+            return prepared, None
+
+    return prepared, filedata
+
+def _finish_item(client, prepared, filedata, state, fingerprint, precompress):
+    """
+    Checksums, names and optionally compresses the processed data of a
+    PreparedItem.
+    """
+    from mediasync.manifest import fingerprint as fingerprint_name
+
+    item = prepared.item
+
+    if state is not None or fingerprint or precompress:
+        filedata = PreparedData(filedata)
+        with Timing('checksum', item.remote_path, item.content_type, len(filedata)):
+            filedata.checksum = prepared.checksum = checksum(filedata)
+        if precompress:
+            filedata.variants = {}
+            compress_variants(filedata, item.content_type, client.get_variants(item.content_type),
+                              item.remote_path)
+
+    if fingerprint:
+        prepared.name = fingerprint_name(item.remote_path, prepared.checksum[0])
+
+    prepared.filedata = filedata
+
+def _put_args(client, prepared, stats=None):
+    """
+    Returns the PutItem that puts a PreparedItem and the encodings of the
+    compressed variants that come with it.
+    """
+    from mediasync.backends import PutItem
+
+    item = prepared.item
+    encodings = client.get_variants(item.content_type)
+
+    if prepared.filedata is None:
+        variants = streamed_variants(item.size, item.content_type, encodings)
+        return PutItem(item.content_type, prepared.name, filepath=item.filepath,
+                       checksum=prepared.checksum), variants
+
+    filedata = prepared.filedata
+    if encodings and getattr(filedata, 'variants', None) is None:
+        # keep the variants so the backend doesn't compress again
+        filedata = PreparedData(filedata)
+        filedata.checksum = prepared.checksum
+        filedata.variants = {}
+    compressed = compress_variants(filedata, item.content_type, encodings, item.remote_path)
+    if stats is not None and encodings:
+        stats.add(item.content_type, len(filedata), compressed)
+    return PutItem(item.content_type, prepared.name, filedata=filedata), sorted(compressed)
+
+def _plain_put(put, prepared):
+    """
+    Returns the PutItem that puts a fingerprinted file under its original
+    name as well, or None if it isn't fingerprinted. CSS url() references
+    and paths built in templates use the original names.
+    """
+    from mediasync.backends import PutItem
+
+    if prepared.name == prepared.item.remote_path:
+        return None
+    return PutItem(put.content_type, prepared.item.remote_path, filedata=put.filedata,
+                   filepath=put.filepath, checksum=put.checksum)
+
+def _record_item(prepared, state=None, manifest=None, variants=None):
+    """
+    Records a PreparedItem that was put or skipped in the sync state and
+    the manifest.
+    """
+    item = prepared.item
+
+    if prepared.skipped:
+        if state is not None:
+            if prepared.source_checksum:
+                state.update(item, prepared.source_checksum)
+            else:
+                state.keep(item)
+        if manifest is not None:
+            manifest[item.remote_path] = {'name': state.get_name(item),
+                                          'variants': state.get_variants(item)}
+        return
+
+    if state is not None:
+        state.update(item, prepared.source_checksum, prepared.checksum[0], prepared.name, variants)
+    if manifest is not None:
+        manifest[item.remote_path] = {'name': prepared.name, 'variants': variants}
+
+def put_items(client, batch, force=False, state=None, manifest=None, stats=None):
+    """
+    Puts a list of PreparedItems to the backend with a single call to its
+    put_many() and records them in the sync state and the manifest, along
+    with the compressed variants that were uploaded. Returns a list of the
+    values returned by the backend for each item, None for skipped items.
+    If a CompressionStats is given, the sizes of the files and their
+    variants are added to it.
+    """
+    puts = []
+    variants = []
+    for prepared in batch:
+        if not prepared.skipped:
+            put, encodings = _put_args(client, prepared, stats)
+            variants.append(encodings)
+            puts.append([put])
+            plain = _plain_put(put, prepared)
+            if plain is not None:
+                puts[-1].append(plain)
+
+    put_results = []
+    if puts:
+        put_results = iter(client.put_many([pi for item_puts in puts for pi in item_puts],
+                                           force=force))
+
+    results = []
+    pending = iter(zip(puts, variants))
+    for prepared in batch:
+        if prepared.skipped:
+            _record_item(prepared, state, manifest)
+            results.append(None)
+        else:
+            item_puts, encodings = pending.next()
+            item_results = [put_results.next() for pi in item_puts]
+            _record_item(prepared, state, manifest, encodings)
+            results.append(any(item_results) or item_results[0])
+    return results
+
+def put_item(client, prepared, force=False, state=None, manifest=None, stats=None):
+    """
+    Puts a single PreparedItem, see put_items(). Returns the value of the
+    backend's put method, which is True if the file was uploaded.
+    """
+    return put_items(client, [prepared], force, state, manifest, stats)[0]
+
+def put_item_async(client, prepared, callback, force=False, state=None, manifest=None, stats=None):
+    """
+    Same as put_item(), but starts the put with the backend's put_async()
+    or put_file_async(). callback(result, error) is called from the
+    backend's poll() once the file is put and recorded.
+    """
+    if prepared.skipped:
+        _record_item(prepared, state, manifest)
+        callback(None, None)
+        return
+
+    put, variants = _put_args(client, prepared, stats)
+    puts = [put]
+    plain = _plain_put(put, prepared)
+    if plain is not None:
+        puts.append(plain)
+    timing = Timing('put', put.remote_path, put.content_type).start()
+    done_puts = []
+
+    def done(result, error):
+        done_puts.append((result, error))
+        if len(done_puts) < len(puts):
+            return
+        errors = [e for r, e in done_puts if e is not None]
+        if not errors:
+            timing.stop()
+            _record_item(prepared, state, manifest, variants)
+        results = [r for r, e in done_puts]
+        callback(any(results) or results[0], errors and errors[0] or None)
+
+    for put in puts:
+        if put.filedata is None:
+            client.put_file_async(put.filepath, put.content_type, put.remote_path, force=force,
+                                  checksum=put.checksum, callback=done)
+        else:
+            client.put_async(put.filedata, put.content_type, put.remote_path, force=force,
+                             callback=done)
+
+def sync_item(client, item, force=False, state=None, manifest=None, stats=None):
+    """
+    Read, process and put a single SyncItem. Returns the value of the
+    backend's put method, which is True if the file was uploaded.
+    
+    See prepare_item() for how the sync state is used. If a manifest dict
+    is given, the name and variants of the file are recorded in it and,
+    when FINGERPRINT is on, the file is put under a fingerprinted name.
+    """
+    from mediasync.conf import msettings
+    fingerprint = manifest is not None and msettings['FINGERPRINT']
+    prepared = prepare_item(client, item, force, state, fingerprint=fingerprint)
+    return put_item(client, prepared, force, state, manifest, stats)
+
+# client and state used by worker processes, inherited when the pool forks
+_worker_context = None
+
+def _prepare_in_worker(items, force, fingerprint):
+    client, state = _worker_context
+    return prepare_items(client, items, force, state, fingerprint, precompress=True)
+
+def _put_prepared(client, pending, force, state, manifest, stats, semaphore):
+    try:
+        return [put_item(client, prepared, force, state, manifest, stats) for prepared in pending.get()]
+    finally:
+        semaphore.release()
+
+def sync_items(client, items, force=False, state=None, manifest=None, jobs=1, processes=1,
+               stats=None, batch_size=1):
+    """
+    Syncs a list of SyncItems, yielding (item, result) in the order of the
+    list, where result is the value returned by the backend's put method.
+    
+    With a single job, files are read and processed batch_size at a time
+    and each batch is handed to the backend's put_many() in one call.
+    
+    jobs is the number of threads that put files to the backend. processes
+    is the number of worker processes that read, process, checksum and
+    compress files. Files are started largest first and put one at a time.
+    Each worker prepares up to batch_size files at once, see
+    prepare_items(), and only a bounded number of prepared batches wait to
+    be put at any time so that memory use stays capped.
+    """
+    from mediasync.conf import msettings
+
+    if jobs <= 1 and processes <= 1:
+        fingerprint = manifest is not None and msettings['FINGERPRINT']
+        batch_size = max(batch_size, 1)
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            prepared = prepare_items(client, batch, force, state, fingerprint)
+            for item, result in zip(batch, put_items(client, prepared, force, state, manifest, stats)):
+                yield item, result
+        return
+
+    from multiprocessing.pool import ThreadPool
+
+    # schedule the largest files first so that a big upload does
+    # not end up running on its own at the end of the sync
+    scheduled = sorted(range(len(items)), key=lambda i: items[i].size, reverse=True)
+    results = [None] * len(items)
+
+    threads = ThreadPool(max(jobs, 1))
+    workers = None
+
+    try:
+
+        if processes > 1:
+
+            import multiprocessing
+            global _worker_context
+
+            _worker_context = (client, state)
+            workers = multiprocessing.Pool(processes)
+            _worker_context = None
+
+            semaphore = threading.BoundedSemaphore(processes * 2 + jobs)
+            fingerprint = manifest is not None and msettings['FINGERPRINT']
+
+            # spread the files over the workers even when there are few of them
+            chunk_size = max(1, min(batch_size, -(-len(items) // processes)))
+            for start in range(0, len(scheduled), chunk_size):
+                chunk = scheduled[start:start + chunk_size]
+                semaphore.acquire()
+                pending = workers.apply_async(_prepare_in_worker,
+                                              ([items[i] for i in chunk], force, fingerprint))
+                putting = threads.apply_async(_put_prepared,
+                    (client, pending, force, state, manifest, stats, semaphore))
+                for n, i in enumerate(chunk):
+                    results[i] = (putting, n)
+
+        else:
+
+            for i in scheduled:
+                results[i] = (threads.apply_async(sync_item,
+                    (client, items[i], force, state, manifest, stats)), None)
+
+        for item, (result, n) in zip(items, results):
+            result = result.get()
+            if n is not None:
+                result = result[n]
+            yield item, result
+
+    finally:
+        threads.terminate()
+        threads.join()
+        if workers is not None:
+            workers.terminate()
+            workers.join()
+
+def sync_items_async(client, items, force=False, state=None, manifest=None, jobs=1,
+                     concurrency=100, stats=None):
+    """
+    Same as sync_items(), but puts files with the backend's asynchronous
+    interface, keeping up to concurrency puts in flight. Files are read
+    and processed in this thread while earlier ones upload. Backends that
+    only have a blocking put() run it in an executor of jobs threads.
+    """
+    from mediasync.conf import msettings
+
+    fingerprint = manifest is not None and msettings['FINGERPRINT']
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    done = [False] * len(items)
+    in_flight = [0]
+
+    def callback(i):
+        def finished(result, error):
+            results[i] = result
+            errors[i] = error
+            done[i] = True
+            in_flight[0] -= 1
+        return finished
+
+    client.start_async(jobs)
+    try:
+
+        started = 0
+        finished = 0
+
+        while finished < len(items):
+
+            # prepare the files for the free slots together, see prepare_items()
+            batch = items[started:started + concurrency - in_flight[0]]
+            for prepared in prepare_items(client, batch, force, state, fingerprint):
+                in_flight[0] += 1
+                put_item_async(client, prepared, callback(started), force, state, manifest, stats)
+                started += 1
+
+            # report files in order as soon as they and those before them are done
+            while finished < len(items) and done[finished]:
+                if errors[finished] is not None:
+                    raise errors[finished]
+                yield items[finished], results[finished]
+                finished += 1
+
+            if in_flight[0]:
+                client.poll(1)
+
+    finally:
+        client.stop_async()
+
+def _load_state(client, rebuild_state=False):
+    from mediasync.conf import msettings
+    from mediasync.state import SyncState
+    state = None
+    if msettings['SYNC_STATE'] or rebuild_state:
+        state = SyncState(client)
+        if not rebuild_state:
+            state.load()
+    return state
+
+def _all_items(client):
+    # joined media first, then static media
+    with Timing('scan'):
+        return list(joined_items(client)) + list(static_items(client))
+
+def sync(client=None, force=False, verbose=True, jobs=None, rebuild_state=False, processes=None,
+         concurrency=None, batch_size=None):
     """ Let's face it... pushing this stuff to S3 is messy.
         A lot of different things need to be calculated for each file
         and they have to be in a certain order as some variables rely
         on others.
+        
+        When jobs is greater than one, files are put by a pool of worker
+        threads, largest files first. When processes is greater than one,
+        files are read, processed, checksummed and compressed by a pool of
+        worker processes. Verbose output is still printed in the order the
+        files were found. With a single job, files are handed to the
+        backend's put_many() in batches of batch_size (SYNC_BATCH_SIZE by
+        default).
+        
+        With backends that have non-blocking I/O, or when concurrency is
+        given, files are put through the backend's asynchronous interface
+        with up to concurrency puts in flight (SYNC_CONCURRENCY by default).
+        Blocking backends then run their puts in jobs executor threads.
+        
+        When the SYNC_STATE setting is on, the local sync state is used to
+        skip files that haven't changed since the last successful sync.
+        force bypasses the state and rebuild_state discards it, but both
+        still record a fresh state at the end of the sync.
+        
+        When the FINGERPRINT setting is on, files are put under names that
+        include a checksum of their content. The manifest used by the
+        template tags is written at the end of the sync when fingerprinting
+        or when the backend uploads compressed variants, so the tags only
+        link variants that exist.
     """
     from mediasync import backends
-    from mediasync.conf import msettings
     from mediasync.signals import pre_sync, post_sync
 
     # create client connection
     if client is None:
         client = backends.client()
 
+    options = _sync_options(client, jobs, processes, concurrency, batch_size)
+
     client.open()
     client.serve_remote = True
 
     # send pre-sync signal
     pre_sync.send(sender=client)
 
-    #
-    # sync joined media
-    #
+    state = _load_state(client, rebuild_state)
+    manifest = _new_manifest(client)
 
-    for joinfile, sourcefiles in msettings['JOINED'].iteritems():
-        
-        filedata = combine_files(joinfile, sourcefiles, client)
-        if filedata is None:
-            # combine_files() is only interested in CSS/JS files.
-            continue
-        filedata, dirname = filedata
-
-        content_type = mimetypes.guess_type(joinfile)[0] or msettings['DEFAULT_MIMETYPE']
+    _sync_and_record(client, _all_items(client), force, state, manifest, verbose, *options)
+    
+    # send post-sync signal while client is still open
+    post_sync.send(sender=client)
+    
+    client.close()
 
-        remote_path = joinfile
-        if dirname:
-            remote_path = "%s/%s" % (dirname, remote_path)
+def _sync_options(client, jobs=None, processes=None, concurrency=None, batch_size=None):
+    """
+    Returns (jobs, processes, concurrency, batch_size) with the defaults
+    from settings filled in.
+    """
+    from mediasync.conf import msettings
 
-        if client.process_and_put(filedata, content_type, remote_path, force=force):
-            if verbose:
-                print "[%s] %s" % (content_type, remote_path)
+    if jobs is None:
+        jobs = msettings['SYNC_JOBS'] or 1
 
-    #
-    # sync static media
-    #
+    if processes is None:
+        processes = msettings['SYNC_PROCESSES'] or 1
 
-    for dirname in os.listdir(client.media_root):
+    if batch_size is None:
+        batch_size = msettings['SYNC_BATCH_SIZE'] or 1
 
-        dirpath = os.path.abspath(os.path.join(client.media_root, dirname))
+    if concurrency is None and client.is_async:
+        concurrency = msettings['SYNC_CONCURRENCY']
 
-        if os.path.isdir(dirpath):
+    return (jobs, processes, concurrency, batch_size)
 
-            for filename in listdir_recursive(dirpath):
+def _new_manifest(client):
+    """
+    Returns an empty manifest if one is written for this client, None
+    otherwise. The manifest records fingerprinted names and which
+    compressed variants were uploaded for each file.
+    """
+    from mediasync.conf import msettings
+    if msettings['FINGERPRINT'] or any(client.get_variants(ct) for ct in TYPES_TO_COMPRESS):
+        return {}
 
-                # calculate local and remote paths
-                filepath = os.path.join(dirpath, filename)
-                remote_path = "%s/%s" % (dirname, filename)
+def _sync_and_record(client, items, force, state, manifest, verbose, jobs, processes,
+                     concurrency, batch_size):
+    """
+    Syncs items with an open client, then saves the sync state and the
+    manifest.
+    """
+    from mediasync import manifest as media_manifest
 
-                content_type = mimetypes.guess_type(filepath)[0] or msettings['DEFAULT_MIMETYPE']
+    stats = CompressionStats()
 
-                if not is_syncable_file(os.path.basename(filename)) or not os.path.isfile(filepath):
-                    continue # hidden file or directory, do not upload
+    if concurrency:
+        synced = sync_items_async(client, items, force=force, state=state, manifest=manifest,
+                                  jobs=jobs, concurrency=concurrency, stats=stats)
+    else:
+        synced = sync_items(client, items, force=force, state=state, manifest=manifest,
+                            jobs=jobs, processes=processes, stats=stats, batch_size=batch_size)
+    
+    for item, result in synced:
+        if result and verbose:
+            print "[%s] %s" % (item.content_type, item.remote_path)
+    
+    if verbose:
+        for line in stats.summary():
+            print "[compression] %s" % line
+    
+    client.flush()
+    
+    if state is not None:
+        state.save()
+    
+    if manifest is not None:
+        media_manifest.save(manifest)
 
-                filedata = open(filepath, 'rb').read()
 
-                if client.process_and_put(filedata, content_type, remote_path, force=force):
-                    if verbose:
-                        print "[%s] %s" % (content_type, remote_path)
-    
-    # send post-sync signal while client is still open
-    post_sync.send(sender=client)
+class SyncPlan(object):
+    """
+    What a sync would do, worked out by plan() without writing anything.
     
-    client.close()
+    files has an entry for each file with the objects the backend would
+    write for it, see BaseClient.plan_put(). removed lists the files in the
+    sync state that no longer exist locally and would be dropped from it.
+    """
+
+    def __init__(self):
+        self.files = []
+        self.removed = []
+
+    def add(self, item, name, objects):
+        size = item.size
+        compressed = {}
+        for obj in objects:
+            if obj['encoding'] is None:
+                size = obj['size']
+            else:
+                compressed[obj['encoding']] = obj['size']
+        self.files.append({
+            'path': item.remote_path,
+            'name': name,
+            'content_type': item.content_type,
+            'action': 'upload' if any(obj['upload'] for obj in objects) else 'skip',
+            'size': size,
+            'compressed': compressed,
+            'objects': objects,
+        })
+
+    def totals(self):
+        totals = {'upload': 0, 'skip': 0, 'removed': len(self.removed), 'requests': 0,
+                  'size': 0, 'compressed_size': 0, 'transfer': 0}
+        for entry in self.files:
+            totals[entry['action']] += 1
+            for obj in entry['objects']:
+                totals['requests'] += obj['requests']
+                if obj['upload']:
+                    totals['transfer'] += obj['size']
+                    totals['compressed_size' if obj['encoding'] else 'size'] += obj['size']
+        return totals
+
+    def as_dict(self):
+        return {'files': self.files, 'removed': self.removed, 'totals': self.totals()}
+
+    def summary(self):
+        lines = []
+        for entry in self.files:
+            if entry['action'] == 'upload':
+                line = "[upload] %s (%d bytes" % (entry['path'], entry['size'])
+                for encoding in sorted(entry['compressed']):
+                    line += ", %s %d bytes" % (encoding, entry['compressed'][encoding])
+                lines.append(line + ")")
+        for path in self.removed:
+            lines.append("[remove] %s" % path)
+        totals = self.totals()
+        lines.append("%d files to upload, %d unchanged, %d removed" % (
+            totals['upload'], totals['skip'], totals['removed']))
+        lines.append("%d bytes raw, %d bytes compressed, %d bytes to transfer in %d requests" % (
+            totals['size'], totals['compressed_size'], totals['transfer'], totals['requests']))
+        return lines
+
+def plan(client=None, force=False, rebuild_state=False):
+    """
+    Works out what sync() would do without putting anything or saving the
+    sync state, the manifest or the processor cache, and returns it as a
+    SyncPlan. Files go
+    through the same sync state checks and processing as in a sync, and
+    the backend's plan_put() makes the same checks as its put methods to
+    tell which files changed. pre_sync and post_sync are not sent.
+    """
+    from mediasync import backends
+    from mediasync.conf import msettings
+
+    if client is None:
+        client = backends.client()
+
+    client.open()
+    client.serve_remote = True
+    client.dry_run = True
+
+    try:
+
+        state = _load_state(client, rebuild_state)
+        fingerprint = msettings['FINGERPRINT']
+        items = _all_items(client)
+        result = SyncPlan()
+
+        for item in items:
+            prepared = prepare_item(client, item, force, state, fingerprint)
+            if prepared.skipped:
+                result.add(item, state.get_name(item), [])
+            else:
+                put, variants = _put_args(client, prepared)
+                objects = client.plan_put(put, force)
+                plain = _plain_put(put, prepared)
+                if plain is not None:
+                    objects += client.plan_put(plain, force)
+                result.add(item, prepared.name, objects)
+
+        if state is not None:
+            local = set(item.remote_path for item in items)
+            result.removed = sorted(path for path in state.files if path not in local)
+
+    finally:
+        client.close()
+        client.dry_run = False
+
+    return result
 
 
 __all__ = ['sync', 'SyncException']
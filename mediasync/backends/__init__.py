@@ -1,7 +1,12 @@
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.importlib import import_module
+from mediasync.cache import ProcessorCache
 from mediasync.conf import msettings
+from mediasync.processors import processor_id
 from urlparse import urlparse
+import mediasync
+import os
+import Queue
 
 def client():
     backend_name = msettings['BACKEND']
@@ -17,6 +22,20 @@ def load_backend(backend_name):
         raise ImproperlyConfigured(("%s is not a valid mediasync backend. \n" +
             "Error was: %s") % (backend_name, e))
 
+class PutItem(object):
+    """
+    A file to put with BaseClient.put_many(). Large files that are streamed
+    from disk have a filepath and the checksum of the file instead of
+    filedata.
+    """
+
+    def __init__(self, content_type, remote_path, filedata=None, filepath=None, checksum=None):
+        self.content_type = content_type
+        self.remote_path = remote_path
+        self.filedata = filedata
+        self.filepath = filepath
+        self.checksum = checksum
+
 class BaseClient(object):
 
     def __init__(self, *args, **kwargs):
@@ -45,10 +64,29 @@ class BaseClient(object):
 
             if callable(proc):
                 self.processors.append(proc)
+
+        self.processor_ids = [processor_id(p) for p in self.processors]
+
+        self.processor_cache = None
+        if msettings['PROCESSOR_CACHE'] and self.processors:
+            self.processor_cache = ProcessorCache(
+                os.path.join(self.get_cache_dir(), 'processed'),
+                msettings['PROCESSOR_CACHE_SIZE'])
     
     def supports_gzip(self):
         return False
 
+    def supports_brotli(self):
+        return False
+
+    def get_variants(self, content_type):
+        """
+        Returns the content encodings of the pre-compressed copies the
+        backend may upload next to a file of content_type. Which of them are
+        actually uploaded is decided by mediasync.compress_variants().
+        """
+        return []
+
     def get_local_media_url(self):
         """
         Checks msettings['STATIC_URL'], then settings.STATIC_URL.
@@ -66,7 +104,16 @@ class BaseClient(object):
         """
         return msettings['STATIC_ROOT']
 
-    def media_url(self, with_ssl=False):
+    def get_cache_dir(self):
+        """
+        Checks msettings['CACHE_DIR'], then falls back to a hidden
+        .mediasync directory in the media root, which is never synced.
+        
+        Broken out to allow overriding if need be.
+        """
+        return msettings['CACHE_DIR'] or os.path.join(self.media_root, '.mediasync')
+
+    def media_url(self, with_ssl=False, remote=None):
         """
         Used to return a base media URL. Depending on whether we're serving
         media remotely or locally, this either hands the decision off to the
@@ -75,8 +122,11 @@ class BaseClient(object):
         args:
           with_ssl: (bool) If True, return an HTTPS url (depending on how
                            the backend handles it).
+          remote: (bool) If given, overrides self.serve_remote.
         """
-        if self.serve_remote:
+        if remote is None:
+            remote = self.serve_remote
+        if remote:
             # Hand this off to whichever backend is being used.
             url = self.remote_media_url(with_ssl)
         else:
@@ -85,12 +135,58 @@ class BaseClient(object):
         return url.rstrip('/')
 
     def process(self, filedata, content_type, remote_path):
-        for proc in self.processors:
-            is_active = msettings['SERVE_REMOTE'] or msettings['EMULATE_COMBO']
-            prcssd_filedata = proc(filedata, content_type, remote_path, is_active)
-            if prcssd_filedata is not None:
-                filedata = prcssd_filedata
-        return filedata
+        return self.process_many([(filedata, content_type, remote_path)])[0]
+
+    def process_many(self, files):
+        """
+        Runs a list of (filedata, content_type, remote_path) through the
+        processors and returns the processed data of each file. Processors
+        with a *batch* function are given all of the files in a single call
+        instead of one file at a time.
+        """
+        is_active = msettings['SERVE_REMOTE'] or msettings['EMULATE_COMBO']
+
+        results = [filedata for filedata, content_type, remote_path in files]
+        keys = [None] * len(files)
+        pending = []
+
+        # a dry run reads the cache but leaves it as it is
+        cache = self.processor_cache
+        for i, (filedata, content_type, remote_path) in enumerate(files):
+            if cache is not None:
+                keys[i] = cache.key(filedata, content_type, remote_path, self.processor_ids, is_active)
+                cached = cache.get(keys[i], touch=not self.dry_run)
+                if cached is not None:
+                    results[i] = cached
+                    continue
+            pending.append(i)
+
+        for proc, proc_id in zip(self.processors, self.processor_ids):
+            batch = getattr(proc, 'batch', None)
+            if batch is not None and len(pending) > 1:
+                inputs = [(results[i], files[i][1], files[i][2]) for i in pending]
+                with mediasync.Timing('process', size=sum(len(results[i]) for i in pending),
+                                      processor=proc_id, batch=len(pending)) as t:
+                    outputs = batch(inputs, is_active)
+                    for i, prcssd_filedata in zip(pending, outputs):
+                        if prcssd_filedata is not None:
+                            results[i] = prcssd_filedata
+                    t.size_out = sum(len(results[i]) for i in pending)
+                continue
+            for i in pending:
+                filedata, (content_type, remote_path) = results[i], files[i][1:]
+                with mediasync.Timing('process', remote_path, content_type, len(filedata),
+                                      processor=proc_id) as t:
+                    prcssd_filedata = proc(filedata, content_type, remote_path, is_active)
+                    if prcssd_filedata is not None:
+                        results[i] = prcssd_filedata
+                    t.size_out = len(results[i])
+
+        if cache is not None and not self.dry_run:
+            for i in pending:
+                cache.set(keys[i], results[i])
+
+        return results
 
     def process_and_put(self, filedata, content_type, remote_path, force=False):
         filedata = self.process(filedata, content_type, remote_path)
@@ -99,11 +195,153 @@ class BaseClient(object):
     def put(self, filedata, content_type, remote_path, force=False):
         raise NotImplementedError('put not defined in ' + self.__class__.__name__)
 
+    def put_file(self, filepath, content_type, remote_path, force=False, checksum=None):
+        """
+        Puts a large file that is not run through the processors. checksum
+        is the (hexdigest, b64digest) of the file if it has already been
+        calculated. Backends that can stream uploads should override this,
+        the default reads the whole file and hands it to put().
+        """
+        f = open(filepath, 'rb')
+        try:
+            filedata = f.read()
+        finally:
+            f.close()
+        return self.put(filedata, content_type, remote_path, force)
+
+    def put_many(self, items, force=False):
+        """
+        Puts a batch of PutItems and returns a list of the values put() or
+        put_file() returned for each of them. The default puts them one at
+        a time. Backends can override this to fetch the remote state of the
+        whole batch at once, pipeline the uploads or commit an index once.
+        """
+        results = []
+        for item in items:
+            with mediasync.Timing('put', item.remote_path, item.content_type):
+                if item.filedata is None:
+                    results.append(self.put_file(item.filepath, item.content_type, item.remote_path,
+                                                 force=force, checksum=item.checksum))
+                else:
+                    results.append(self.put(item.filedata, item.content_type, item.remote_path,
+                                            force=force))
+        return results
+
+    # True while mediasync.plan() works out what a sync would do,
+    # backends must not write anything to remote storage and the
+    # processor cache is only read
+    dry_run = False
+
+    def plan_objects(self, item):
+        """
+        Returns a (remote_path, encoding, size, checksum) tuple for a PutItem
+        and for each compressed variant that would be put with it. encoding
+        is None for the file itself.
+        """
+        content_type = item.content_type
+        encodings = self.get_variants(content_type)
+
+        if item.filedata is None:
+            size = os.path.getsize(item.filepath)
+            objects = [(item.remote_path, None, size,
+                        item.checksum or mediasync.checksum_file(item.filepath))]
+            variants = mediasync.measure_file_variants(item.filepath, content_type,
+                mediasync.streamed_variants(size, content_type, encodings))
+            for encoding in sorted(variants):
+                (checksum, variant_size) = variants[encoding]
+                objects.append(("%s.%s" % (item.remote_path, mediasync.ENCODING_EXTENSIONS[encoding]),
+                                encoding, variant_size, checksum))
+            return objects
+
+        objects = [(item.remote_path, None, len(item.filedata), mediasync.checksum(item.filedata))]
+        variants = mediasync.compress_variants(item.filedata, content_type, encodings, item.remote_path)
+        for encoding in sorted(variants):
+            objects.append(("%s.%s" % (item.remote_path, mediasync.ENCODING_EXTENSIONS[encoding]),
+                            encoding, len(variants[encoding]), mediasync.checksum(variants[encoding])))
+        return objects
+
+    def plan_put(self, item, force=False):
+        """
+        Returns what put_many() would do with a PutItem, without writing
+        anything. There is a dict for the file and each compressed variant
+        with its remote path, content encoding, size in bytes, whether it
+        would be uploaded and the number of requests that would take.
+        
+        The default uploads everything with a request per object. Backends
+        that skip unchanged files should override this with the same checks
+        their put methods make.
+        """
+        return [{'path': path, 'encoding': encoding, 'size': size, 'upload': True, 'requests': 1}
+                for path, encoding, size, checksum in self.plan_objects(item)]
+
+    # True for backends that implement put_async() with non-blocking I/O
+    # instead of the executor threads used by default
+    is_async = False
+
+    def start_async(self, jobs=1):
+        """
+        Prepares the client for put_async(). Blocking backends are adapted
+        with an executor of jobs threads that run put() and put_file().
+        """
+        from multiprocessing.pool import ThreadPool
+        self._executor = ThreadPool(max(jobs, 1))
+        self._completed = Queue.Queue()
+
+    def stop_async(self):
+        if getattr(self, '_executor', None) is not None:
+            self._executor.terminate()
+            self._executor.join()
+            self._executor = None
+
+    def _run_async(self, put, args, callback):
+        def run():
+            try:
+                self._completed.put((callback, put(*args), None))
+            except Exception, e:
+                self._completed.put((callback, None, e))
+        self._executor.apply_async(run)
+
+    def put_async(self, filedata, content_type, remote_path, force=False, callback=None):
+        """
+        Starts putting a file without waiting for it. callback(result, error)
+        is called from poll() once the put is done, with the value put()
+        would have returned or the exception it raised.
+        """
+        self._run_async(self.put, (filedata, content_type, remote_path, force), callback)
+
+    def put_file_async(self, filepath, content_type, remote_path, force=False, checksum=None, callback=None):
+        """
+        Same as put_async(), but for put_file().
+        """
+        self._run_async(self.put_file, (filepath, content_type, remote_path, force, checksum), callback)
+
+    def poll(self, timeout=None):
+        """
+        Waits up to timeout seconds for started puts to finish and calls
+        their callbacks.
+        """
+        completed = []
+        try:
+            completed.append(self._completed.get(timeout=timeout))
+            while True:
+                completed.append(self._completed.get_nowait())
+        except Queue.Empty:
+            pass
+        for callback, result, error in completed:
+            callback(result, error)
+
     def remote_media_url(self, with_ssl=False):
         raise NotImplementedError('remote_media_url not defined in ' + self.__class__.__name__)
 
     def open(self):
         pass
 
+    def flush(self):
+        """
+        Called at the end of each sync, and of each round of syncmedia
+        --watch, to write out anything the client keeps until then.
+        """
+        pass
+
     def close(self):
         pass
@@ -1,13 +1,46 @@
+from __future__ import absolute_import
+
 import cloudfiles
 
 from django.core.exceptions import ImproperlyConfigured
 
+from mediasync import TYPES_TO_COMPRESS
 from mediasync.backends import BaseClient
 from mediasync.conf import msettings
+import datetime
+import mediasync
+import os
+import tempfile
+
+# number of objects returned by each request when listing the container
+LISTING_LIMIT = 10000
+
+
+class ExtraHeaders(object):
+    """
+    Sends extra HTTP headers, such as Expires and Content-Encoding, along
+    with the ones a storage object sets itself. python-cloudfiles only sends
+    the ETag, Content-Type and metadata headers that _make_headers returns.
+    """
+
+    def __init__(self, container, name, headers=None):
+        self.extra_headers = headers or {}
+        super(ExtraHeaders, self).__init__(container, name)
+
+    def _make_headers(self):
+        headers = super(ExtraHeaders, self)._make_headers()
+        headers.update(self.extra_headers)
+        return headers
+
+
+class HeaderObject(ExtraHeaders, cloudfiles.storage_object.Object):
+    pass
 
 
 class Client(BaseClient):
 
+    object_class = HeaderObject
+
     def __init__(self, *args, **kwargs):
         "Set up the CloudFiles connection and grab the container."
         super(Client, self).__init__(*args, **kwargs)
@@ -31,6 +64,39 @@ class Client(BaseClient):
         if not self.container.is_public():
             self.container.make_public()
 
+        self._etags = None
+
+    def supports_gzip(self):
+        return msettings.get('CLOUDFILES_GZIP', False)
+
+    def get_variants(self, content_type):
+        if content_type in TYPES_TO_COMPRESS and self.supports_gzip():
+            return ['gzip']
+        return []
+
+    def open(self):
+        self._etags = self.list_etags()
+
+    def close(self):
+        self._etags = None
+
+    def list_etags(self):
+        """
+        Returns a dict of object name to ETag for every object in the
+        container, fetched a page at a time. ETags are the MD5 of the
+        content, so they tell which objects changed without a request per
+        object.
+        """
+        etags = {}
+        marker = None
+        while True:
+            objects = self.container.list_objects_info(limit=LISTING_LIMIT, marker=marker)
+            for obj in objects:
+                etags[obj['name']] = obj['hash']
+            if len(objects) < LISTING_LIMIT:
+                return etags
+            marker = objects[-1]['name']
+
     def remote_media_url(self, with_ssl=False):
         "Grab the remote URL for the contianer."
         if with_ssl:
@@ -38,10 +104,123 @@ class Client(BaseClient):
                     See http://bit.ly/hYV502 for more info.""")
         return self.container.public_uri()
 
+    def get_headers(self, encoding=None, filename=None):
+
+        now = datetime.datetime.utcnow()
+        then = now + datetime.timedelta(self.expiration_days)
+
+        headers = {
+            "Expires": then.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Cache-Control": 'max-age=%d, public' % (self.expiration_days * 24 * 3600),
+        }
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            headers["Content-Disposition"] = 'inline; filename="%s"' % filename
+        return headers
+
+    def is_changed(self, remote_path, hexdigest):
+        if self._etags is None:
+            with mediasync.Timing('lookup'):
+                self._etags = self.list_etags()
+        return self._etags.get(remote_path) != hexdigest
+
+    def plan_put(self, item, force=False):
+        """
+        Compares the file and each variant with the ETags in the container,
+        like put() and put_file() do.
+        """
+        planned = []
+        for path, encoding, size, (hexdigest, b64digest) in self.plan_objects(item):
+            upload = force or self.is_changed(path, hexdigest)
+            planned.append({'path': path, 'encoding': encoding, 'size': size,
+                            'upload': upload, 'requests': upload and 1 or 0})
+        return planned
+
+    def write_object(self, remote_path, content_type, data, hexdigest, encoding=None):
+        """
+        Writes data, a string or a file, to an object. The checksum is sent
+        as the ETag so that Cloud Files rejects a corrupted upload.
+        """
+        filename = None
+        if encoding:
+            filename = remote_path.split('/')[-1]
+
+        if isinstance(data, basestring):
+            size = len(data)
+        else:
+            size = os.fstat(data.fileno()).st_size
+
+        with mediasync.Timing('upload', remote_path, content_type, size, encoding=encoding):
+            obj = self.object_class(self.container, remote_path, self.get_headers(encoding, filename))
+            obj.content_type = content_type
+            obj.etag = hexdigest
+            obj.write(data)
+
+        self._etags[remote_path] = hexdigest
+
     def put(self, filedata, content_type, remote_path, force=False):
+        """
+        Puts filedata and its compressed variants, each only if its checksum
+        differs from the ETag of the object in the container. Returns True
+        if anything was uploaded.
+        """
+        (hexdigest, b64digest) = mediasync.checksum(filedata)
+        variants = mediasync.compress_variants(filedata, content_type, self.get_variants(content_type),
+                                               remote_path)
+        uploaded = False
+
+        if force or self.is_changed(remote_path, hexdigest):
+            self.write_object(remote_path, content_type, filedata, hexdigest)
+            uploaded = True
+
+        for encoding, compressed in variants.iteritems():
+            variant_path = "%s.%s" % (remote_path, mediasync.ENCODING_EXTENSIONS[encoding])
+            (variant_hexdigest, variant_b64digest) = mediasync.checksum(compressed)
+            if force or self.is_changed(variant_path, variant_hexdigest):
+                self.write_object(variant_path, content_type, compressed, variant_hexdigest, encoding)
+                uploaded = True
+
+        if uploaded:
+            return True
+
+    def put_file(self, filepath, content_type, remote_path, force=False, checksum=None):
+        """
+        Streams a large file to Cloud Files without reading it into memory,
+        compressing variants through a temporary file.
+        """
+        if checksum is None:
+            checksum = mediasync.checksum_file(filepath)
+        (hexdigest, b64digest) = checksum
+
+        size = os.path.getsize(filepath)
+        variants = mediasync.streamed_variants(size, content_type, self.get_variants(content_type))
+        uploaded = False
+
+        if force or self.is_changed(remote_path, hexdigest):
+            f = open(filepath, 'rb')
+            try:
+                self.write_object(remote_path, content_type, f, hexdigest)
+            finally:
+                f.close()
+            uploaded = True
+
+        for encoding in variants:
+
+            variant_path = "%s.%s" % (remote_path, mediasync.ENCODING_EXTENSIONS[encoding])
 
-        obj = self.container.create_object(remote_path)
-        obj.content_type = content_type
-        obj.write(filedata)
+            tmp = tempfile.TemporaryFile()
+            try:
+                with mediasync.Timing('compress', remote_path, content_type, size, encoding=encoding,
+                                      streamed=True) as t:
+                    (variant_hexdigest, variant_b64digest) = mediasync.compress_file_variant(filepath, tmp,
+                                                                                             content_type, encoding)
+                    t.size_out = tmp.tell()
+                if force or self.is_changed(variant_path, variant_hexdigest):
+                    tmp.seek(0)
+                    self.write_object(variant_path, content_type, tmp, variant_hexdigest, encoding)
+                    uploaded = True
+            finally:
+                tmp.close()
 
-        return True
+        if uploaded:
+            return True
@@ -1,12 +1,91 @@
+from mediasync import SyncException, TYPES_TO_COMPRESS
 from mediasync.backends import BaseClient
+from mediasync.conf import msettings
+import mediasync
+import random
+import threading
+import time
 
 class Client(BaseClient):
-    
+    """
+    Backend that doesn't store anything, for tests and benchmarks.
+
+    The DUMMY_* settings make it behave like a remote storage service. Each
+    request waits DUMMY_LATENCY seconds plus the time its data takes at
+    DUMMY_BANDWIDTH bytes per second, and fails with a probability of
+    DUMMY_FAILURE_RATE. Failed requests are retried up to DUMMY_RETRIES
+    times. With DUMMY_GZIP, compressible files are sent with a gzipped
+    variant, which takes a request of its own.
+    """
+
     remote_media_url_callback = lambda x: "dummy://"
-    put_callback = lambda x: None
-    
+    put_callback = lambda *args: None
+
+    def __init__(self, *args, **kwargs):
+        super(Client, self).__init__(*args, **kwargs)
+
+        self.latency = msettings.get('DUMMY_LATENCY', 0)
+        self.bandwidth = msettings.get('DUMMY_BANDWIDTH')
+        self.failure_rate = msettings.get('DUMMY_FAILURE_RATE', 0)
+        self.retries = msettings.get('DUMMY_RETRIES', 3)
+        self.random = random.Random(msettings.get('DUMMY_SEED'))
+
+        # number of files in each put_many() call
+        self.batch_sizes = []
+
+        # totals of the simulated requests
+        self.requests = 0
+        self.failures = 0
+        self.bytes_sent = 0
+        self.put_time = 0.0
+        self._lock = threading.Lock()
+
+    def supports_gzip(self):
+        return msettings.get('DUMMY_GZIP', False)
+
+    def get_variants(self, content_type):
+        if content_type in TYPES_TO_COMPRESS and self.supports_gzip():
+            return ['gzip']
+        return []
+
     def remote_media_url(self, with_ssl=False):
         return self.remote_media_url_callback()
-    
+
+    def request(self, size, remote_path=None, content_type=None, encoding=None):
+        """
+        Simulates a request that sends size bytes, retrying it when it fails.
+        """
+        timing = mediasync.Timing('upload', remote_path, content_type, size, encoding=encoding).start()
+        for attempt in range(self.retries + 1):
+            delay = self.latency
+            if self.bandwidth:
+                delay += float(size) / self.bandwidth
+            if delay:
+                time.sleep(delay)
+            with self._lock:
+                failed = self.random.random() < self.failure_rate
+                self.requests += 1
+                if failed:
+                    self.failures += 1
+                else:
+                    self.bytes_sent += size
+            if not failed:
+                timing.stop()
+                return
+        raise SyncException("dummy request failed %d times" % (self.retries + 1))
+
     def put(self, *args, **kwargs):
-        self.put_callback(*args)
\ No newline at end of file
+        started = time.time()
+        filedata, content_type, remote_path = args[0], args[1], args[2]
+        self.request(len(filedata), remote_path, content_type)
+        variants = mediasync.compress_variants(filedata, content_type, self.get_variants(content_type),
+                                               remote_path)
+        for encoding, compressed in variants.iteritems():
+            self.request(len(compressed), remote_path, content_type, encoding)
+        with self._lock:
+            self.put_time += time.time() - started
+        return self.put_callback(*args)
+
+    def put_many(self, items, force=False):
+        self.batch_sizes.append(len(items))
+        return super(Client, self).put_many(items, force)
@@ -0,0 +1,268 @@
+"""
+Backend for storage services that accept files with HTTP PUT requests, such
+as a WebDAV share or nginx with the dav module.
+
+Uploads use non-blocking sockets driven by asyncore, so a sync can keep
+hundreds of requests in flight from a single thread.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from mediasync import TYPES_TO_COMPRESS, SyncException
+from mediasync.backends import BaseClient
+from mediasync.conf import msettings
+from urlparse import urlparse
+import asyncore
+import datetime
+import mediasync
+import os
+import socket
+import sys
+import tempfile
+import time
+
+DEFAULT_TIMEOUT = 60
+
+# bytes passed to each send() call
+SEND_SIZE = 64 * 1024
+
+class PutRequest(asyncore.dispatcher):
+    """
+    A single HTTP PUT request on its own connection. The body is a string
+    or a file, which is read as it is sent and closed when the request is
+    done. callback(status, error) is called once, when the response has
+    been read or the request failed. last_activity is the time the
+    connection last made progress, which the client uses to time out
+    requests that stall.
+    """
+
+    def __init__(self, host, port, head, body, callback, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        if isinstance(body, str):
+            self.data, self.body = head + body, None
+        else:
+            self.data, self.body = head, body
+        self.offset = 0
+        self.response = []
+        self.callback = callback
+        self.started = self.last_activity = time.time()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    def finish(self, status, error=None):
+        self.close()
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+        if self.callback is not None:
+            callback, self.callback = self.callback, None
+            callback(status, error)
+
+    def handle_connect(self):
+        self.last_activity = time.time()
+
+    def writable(self):
+        return not self.connected or self.offset < len(self.data) or self.body is not None
+
+    def handle_write(self):
+        if self.offset == len(self.data):
+            self.data, self.offset = self.body.read(SEND_SIZE), 0
+            if not self.data:
+                self.body.close()
+                self.body = None
+                return
+        self.offset += self.send(buffer(self.data, self.offset, SEND_SIZE))
+        self.last_activity = time.time()
+
+    def handle_read(self):
+        self.response.append(self.recv(8192))
+        self.last_activity = time.time()
+
+    def handle_close(self):
+        # the request asks the server to close the connection when done
+        response = ''.join(self.response)
+        try:
+            status = int(response.split(' ', 2)[1])
+        except (IndexError, ValueError):
+            self.finish(None, SyncException("HTTP PUT got no valid response: %r" % response[:100]))
+            return
+        self.finish(status)
+
+    def handle_expt(self):
+        self.finish(None, SyncException("HTTP PUT connection failed"))
+
+    def handle_error(self):
+        self.finish(None, SyncException("HTTP PUT failed: %s" % sys.exc_info()[1]))
+
+class Client(BaseClient):
+
+    is_async = True
+
+    def __init__(self, *args, **kwargs):
+        super(Client, self).__init__(*args, **kwargs)
+
+        self.put_url = msettings.get('HTTP_PUT_URL')
+        if not self.put_url:
+            raise ImproperlyConfigured("HTTP_PUT_URL is a required setting.")
+
+        parsed = urlparse(self.put_url)
+        if parsed.scheme != 'http':
+            raise ImproperlyConfigured("HTTP_PUT_URL must be an http:// URL.")
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = parsed.path.rstrip('/')
+
+        self.timeout = msettings.get('HTTP_TIMEOUT', DEFAULT_TIMEOUT)
+        self._map = None
+
+    def supports_gzip(self):
+        return msettings.get('HTTP_GZIP', True)
+
+    def get_variants(self, content_type):
+        if content_type in TYPES_TO_COMPRESS and self.supports_gzip():
+            return ['gzip']
+        return []
+
+    def remote_media_url(self, with_ssl=False):
+        url = msettings.get('HTTP_MEDIA_URL') or self.put_url
+        if with_ssl:
+            url = "https://%s" % url.split('://', 1)[-1]
+        return url.rstrip('/')
+
+    def get_headers(self, content_type, length, b64digest, encoding=None):
+
+        now = datetime.datetime.utcnow()
+        then = now + datetime.timedelta(self.expiration_days)
+
+        headers = {
+            "Host": self.port == 80 and self.host or "%s:%d" % (self.host, self.port),
+            "Connection": "close",
+            "Content-Type": content_type,
+            "Content-Length": str(length),
+            "Content-MD5": b64digest,
+            "Expires": then.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Cache-Control": 'max-age=%d, public' % (self.expiration_days * 24 * 3600),
+        }
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        headers.update(msettings.get('HTTP_HEADERS') or {})
+        return headers
+
+    def start_async(self, jobs=1):
+        self._map = {}
+
+    def stop_async(self):
+        if self._map is not None:
+            for request in self._map.values():
+                request.finish(None, SyncException("HTTP PUT was cancelled"))
+            self._map = None
+
+    def send(self, remote_path, body, headers, callback):
+        lines = ["PUT %s/%s HTTP/1.0" % (self.path, remote_path)]
+        lines.extend("%s: %s" % header for header in sorted(headers.iteritems()))
+        head = "%s\r\n\r\n" % "\r\n".join(lines)
+        PutRequest(self.host, self.port, head, body, callback, self._map)
+
+    def put_requests(self, requests, remote_path, callback):
+        """
+        Sends a list of (path, body, headers) requests at the same time and
+        calls callback(True, None) once all of them have been stored.
+        """
+        pending = [len(requests)]
+        errors = []
+
+        def sent(timing):
+            def done(status, error):
+                if error is None and not 200 <= status < 300:
+                    error = SyncException("HTTP PUT of %s returned %s" % (remote_path, status))
+                if error is not None:
+                    errors.append(error)
+                else:
+                    timing.stop()
+                pending[0] -= 1
+                if not pending[0]:
+                    callback(None if errors else True, errors[0] if errors else None)
+            return done
+
+        for path, body, headers in requests:
+            timing = mediasync.Timing('upload', remote_path, headers['Content-Type'],
+                                      int(headers['Content-Length']),
+                                      encoding=headers.get('Content-Encoding')).start()
+            self.send(path, body, headers, sent(timing))
+
+    def put_async(self, filedata, content_type, remote_path, force=False, callback=None):
+        """
+        PUTs filedata and its compressed variants at the same time. There is
+        no way to ask the server what it already has, so every file is
+        sent; turn on SYNC_STATE to skip unchanged files.
+        """
+        (hexdigest, b64digest) = mediasync.checksum(filedata)
+        requests = [(remote_path, filedata, self.get_headers(content_type, len(filedata), b64digest))]
+
+        variants = mediasync.compress_variants(filedata, content_type, self.get_variants(content_type),
+                                               remote_path)
+        for encoding, compressed in variants.iteritems():
+            (hexdigest, b64digest) = mediasync.checksum(compressed)
+            requests.append(("%s.%s" % (remote_path, mediasync.ENCODING_EXTENSIONS[encoding]), compressed,
+                             self.get_headers(content_type, len(compressed), b64digest, encoding)))
+
+        self.put_requests(requests, remote_path, callback)
+
+    def put_file_async(self, filepath, content_type, remote_path, force=False, checksum=None, callback=None):
+        """
+        Same as put_async(), but the file and its variants are sent from
+        disk instead of being read into memory.
+        """
+        if checksum is None:
+            checksum = mediasync.checksum_file(filepath)
+        size = os.path.getsize(filepath)
+        requests = [(remote_path, open(filepath, 'rb'), self.get_headers(content_type, size, checksum[1]))]
+
+        for encoding in mediasync.streamed_variants(size, content_type, self.get_variants(content_type)):
+            tmp = tempfile.TemporaryFile()
+            with mediasync.Timing('compress', remote_path, content_type, size, encoding=encoding,
+                                  streamed=True) as t:
+                (hexdigest, b64digest) = mediasync.compress_file_variant(filepath, tmp, content_type, encoding)
+                variant_size = t.size_out = tmp.tell()
+            tmp.seek(0)
+            requests.append(("%s.%s" % (remote_path, mediasync.ENCODING_EXTENSIONS[encoding]), tmp,
+                             self.get_headers(content_type, variant_size, b64digest, encoding)))
+
+        self.put_requests(requests, remote_path, callback)
+
+    def poll(self, timeout=None):
+        if not self._map:
+            return
+        # a slow upload keeps going as long as it makes progress, so wake up
+        # no later than when the quietest request would time out
+        idle_until = min(request.last_activity for request in self._map.values()) + self.timeout
+        timeout = max(0, min(timeout or 0, idle_until - time.time()))
+        asyncore.loop(timeout=timeout, use_poll=True, map=self._map, count=1)
+        now = time.time()
+        for request in self._map.values():
+            if now - request.last_activity > self.timeout:
+                request.finish(None, SyncException("HTTP PUT timed out"))
+
+    def wait(self, put_async, *args):
+        outcome = []
+        started = self._map is not None
+        if not started:
+            self.start_async()
+        try:
+            put_async(*args, callback=lambda result, error: outcome.append((result, error)))
+            while not outcome:
+                self.poll(1)
+        finally:
+            if not started:
+                self.stop_async()
+        result, error = outcome[0]
+        if error is not None:
+            raise error
+        return result
+
+    def put(self, filedata, content_type, remote_path, force=False):
+        """
+        Blocking put, for use outside of an asynchronous sync.
+        """
+        return self.wait(self.put_async, filedata, content_type, remote_path, force)
+
+    def put_file(self, filepath, content_type, remote_path, force=False, checksum=None):
+        return self.wait(self.put_file_async, filepath, content_type, remote_path, force, checksum)
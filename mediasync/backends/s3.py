@@ -4,8 +4,23 @@ from django.core.exceptions import ImproperlyConfigured
 from mediasync import TYPES_TO_COMPRESS
 from mediasync.backends import BaseClient
 from mediasync.conf import msettings
-import mediasync
+import cStringIO
 import datetime
+import mediasync
+import os
+import tempfile
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+INDEX_KEY = 'mediasync-index.json'
+INDEX_VERSION = 1
+
+# files larger than this are uploaded in parts of MULTIPART_CHUNK_SIZE
+MULTIPART_THRESHOLD = 32 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
 
 class Client(BaseClient):
 
@@ -15,12 +30,37 @@ class Client(BaseClient):
         self.aws_bucket = msettings['AWS_BUCKET']
         self.aws_prefix = msettings.get('AWS_PREFIX', '').strip('/')
         self.aws_bucket_cname =  msettings.get('AWS_BUCKET_CNAME', False)
+        self.use_index = msettings.get('AWS_INDEX', True)
         
         assert self.aws_bucket
+        
+        if self.supports_brotli() and mediasync.brotli is None:
+            raise ImproperlyConfigured("AWS_BROTLI requires the brotli module.")
+        
+        self._index = None
+        self._index_dirty = False
+        self._index_rebuilt = False
+        self._index_updates = {}
+        self._keys = None
     
     def supports_gzip(self):
         return msettings.get('AWS_GZIP', True)
     
+    def supports_brotli(self):
+        return msettings.get('AWS_BROTLI', False)
+    
+    def get_variants(self, content_type):
+        """
+        Returns the content encodings of the pre-compressed copies that may
+        be uploaded next to a file of content_type.
+        """
+        variants = []
+        if content_type in TYPES_TO_COMPRESS:
+            variants.append('gzip')
+            if self.supports_brotli():
+                variants.append('br')
+        return variants
+    
     def get_connection(self):
         return self._conn
     
@@ -35,11 +75,134 @@ class Client(BaseClient):
             raise ImproperlyConfigured("S3 keys not set and no boto config found.")
                 
         self._bucket = self._conn.create_bucket(self.aws_bucket)
+        
+        if self.use_index:
+            self.load_index()
+    
+    def flush(self):
+        if self._index is not None and self._index_dirty and not self.dry_run:
+            self.save_index()
     
     def close(self):
+        self.flush()
+        self._index = None
+        self._index_dirty = False
+        self._index_rebuilt = False
+        self._index_updates = {}
+        self._keys = None
         self._bucket = None
         self._conn = None
     
+    def index_key_name(self):
+        name = msettings.get('AWS_INDEX_KEY') or INDEX_KEY
+        if self.aws_prefix:
+            name = "%s/%s" % (self.aws_prefix, name)
+        return name
+    
+    def load_index(self):
+        """
+        Loads the sync index from the bucket. The index maps each remote path
+        to the checksum, size and compressed variants that were last synced,
+        which lets put() skip unchanged files without a HEAD request per key.
+        
+        If the index is missing or unreadable, or AWS_INDEX_REBUILD is set,
+        the index is rebuilt from a full listing of the bucket instead.
+        """
+        index = None
+        
+        if not msettings.get('AWS_INDEX_REBUILD', False):
+            index = self.read_index()
+        
+        self._index_rebuilt = index is None
+        if index is None:
+            index = self.rebuild_index()
+        
+        self._index = index
+        self._index_dirty = self._index_rebuilt
+        self._index_updates = {}
+    
+    def read_index(self):
+        """
+        Returns the files of the index stored in the bucket, or None if it is
+        missing, unreadable or of another version.
+        """
+        key = self._bucket.get_key(self.index_key_name())
+        if key is None:
+            return None
+        try:
+            data = json.loads(key.get_contents_as_string())
+            if data.get('version') == INDEX_VERSION and isinstance(data['files'], dict):
+                return data['files']
+        except (ValueError, KeyError, AttributeError):
+            pass # corrupt index
+        return None
+    
+    def list_keys(self):
+        """
+        Returns a dict of key name to (ETag, size) for every key under
+        AWS_PREFIX, from a listing of the bucket that takes one request per
+        thousand keys. S3 ETags are the MD5 of the content for keys that
+        were not uploaded in parts, so they can stand in for the checksum
+        of each file.
+        """
+        keys = {}
+        prefix = "%s/" % self.aws_prefix if self.aws_prefix else ''
+        with mediasync.Timing('lookup'):
+            for key in self._bucket.list(prefix=prefix):
+                keys[key.name] = (key.etag.strip('"'), int(key.size))
+        return keys
+    
+    def rebuild_index(self):
+        """
+        Builds a sync index from the ETags of a listing of the bucket.
+        """
+        index = {}
+        
+        prefix = "%s/" % self.aws_prefix if self.aws_prefix else ''
+        index_key_name = self.index_key_name()
+        
+        for name, (checksum, size) in self.list_keys().iteritems():
+            
+            if name == index_key_name:
+                continue
+            
+            if '-' in checksum:
+                continue # multipart ETag, not an MD5 of the content
+            
+            path = name[len(prefix):]
+            
+            ext = path.rsplit('.', 1)[-1]
+            if ext in mediasync.ENCODING_EXTENSIONS.values():
+                entry = index.setdefault(path[:-len(ext) - 1], {'variants': {}})
+                entry['variants'][ext] = checksum
+            else:
+                entry = index.setdefault(path, {'variants': {}})
+                entry['checksum'] = checksum
+                entry['size'] = size
+        
+        return index
+    
+    def save_index(self):
+        """
+        Writes the index to the bucket. Unless the index was rebuilt, the
+        stored index is read again first and only the entries this client
+        changed are written over it, so that syncs of other machines to the
+        same bucket since open() are kept.
+        """
+        index = self._index
+        if not self._index_rebuilt:
+            stored = self.read_index()
+            if stored is not None:
+                stored.update(self._index_updates)
+                index = stored
+        key = Key(self._bucket, self.index_key_name())
+        data = json.dumps({'version': INDEX_VERSION, 'files': index})
+        key.set_contents_from_string(data, headers={'Content-Type': 'application/json'})
+        self._index = index
+        self._index_dirty = False
+        self._index_rebuilt = False
+        self._index_updates = {}
+    
     def remote_media_url(self, with_ssl=False):
         """
         Returns the base remote media URL. In this case, we can safely make
@@ -55,50 +218,247 @@ class Client(BaseClient):
             url = "%s/%s" % (url, self.aws_prefix)
         return url
 
-    def put(self, filedata, content_type, remote_path, force=False):
-
+    def get_headers(self, content_type):
+        
         now = datetime.datetime.utcnow()
         then = now + datetime.timedelta(self.expiration_days)
         expires = then.strftime("%a, %d %b %Y %H:%M:%S GMT")
         
-        if self.aws_prefix:
-            remote_path = "%s/%s" % (self.aws_prefix, remote_path)
-            
-        (hexdigest, b64digest) = mediasync.checksum(filedata)
-        raw_b64digest = b64digest # store raw b64digest to add as file metadata
-
-        # create initial set of headers
-        headers = {
+        return {
             "x-amz-acl": "public-read",
             "Content-Type": content_type,
             "Expires": expires,
             "Cache-Control": 'max-age=%d, public' % (self.expiration_days * 24 * 3600),
         }
+    
+    def is_changed(self, index_path, remote_path, hexdigest, b64digest, ext=None):
+        """
+        Compares a checksum with the one last synced to remote_path. The
+        index is used if there is one. Otherwise the ETags of a single
+        listing of the bucket are, and only keys that were uploaded in
+        parts are looked up for the checksum in their metadata. If ext is
+        given, remote_path is the compressed variant with that extension and
+        the checksum is compared with the one recorded for the variant.
+        """
+        if self._index is not None:
+            # compare against the index instead of asking S3 about the key
+            entry = self._index.get(index_path) or {}
+            if ext:
+                return (entry.get('variants') or {}).get(ext) != hexdigest
+            return entry.get('checksum') != hexdigest
         
-        key = self._bucket.get_key(remote_path)
+        if self._keys is None:
+            self._keys = self.list_keys()
+        listed = self._keys.get(remote_path)
+        if listed is None:
+            return True
+        if '-' not in listed[0]:
+            return listed[0] != hexdigest
         
+        with mediasync.Timing('lookup', index_path):
+            key = self._bucket.get_key(remote_path)
         if key is None:
-            key = Key(self._bucket, remote_path)
+            return True
         
         key_meta = key.get_metadata('mediasync-checksum') or ''
         s3_checksum = key_meta.replace(' ', '+')
-        if force or s3_checksum != raw_b64digest:
+        return s3_checksum != b64digest
+    
+    def upload_requests(self, size):
+        """
+        Returns the number of requests upload_file() makes for size bytes.
+        """
+        threshold = msettings.get('AWS_MULTIPART_THRESHOLD', MULTIPART_THRESHOLD)
+        chunk_size = msettings.get('AWS_MULTIPART_CHUNK_SIZE', MULTIPART_CHUNK_SIZE)
+        if size < threshold or not hasattr(self._bucket, 'initiate_multipart_upload'):
+            return 1
+        # initiate, one request per part and complete
+        return (size + chunk_size - 1) / chunk_size + 2
+    
+    def plan_put(self, item, force=False):
+        """
+        Checks the file and each variant with is_changed(), like put() and
+        put_file() do. Without an index every check is a HEAD request.
+        """
+        planned = []
+        for path, encoding, size, (hexdigest, b64digest) in self.plan_objects(item):
+            remote_path = "%s/%s" % (self.aws_prefix, path) if self.aws_prefix else path
+            ext = encoding and mediasync.ENCODING_EXTENSIONS[encoding]
+            requests = 0
+            upload = force
+            if not force:
+                upload = self.is_changed(item.remote_path, remote_path, hexdigest, b64digest, ext)
+                if self._index is None and '-' in self._keys.get(remote_path, ('', 0))[0]:
+                    requests += 1 # looked up for the checksum in its metadata
+            if upload:
+                # only streamed files are uploaded in parts
+                requests += self.upload_requests(size) if item.filedata is None else 1
+            planned.append({'path': path, 'encoding': encoding, 'size': size,
+                            'upload': upload, 'requests': requests})
+        return planned
+    
+    def uploaded(self, remote_path, hexdigest, size):
+        """
+        Records an upload in the listing that is used without an index.
+        """
+        if self._keys is not None:
+            self._keys[remote_path] = (hexdigest, size)
+    
+    def update_index(self, index_path, entry):
+        if self._index is not None and self._index.get(index_path) != entry:
+            self._index[index_path] = entry
+            self._index_updates[index_path] = entry
+            self._index_dirty = True
+    
+    def get_variant_headers(self, headers, remote_path, encoding):
+        variant_headers = dict(headers)
+        ext = mediasync.ENCODING_EXTENSIONS[encoding]
+        variant_headers["Content-Disposition"] = 'inline; filename="%s%s"' % (remote_path.split('/')[-1], ext)
+        variant_headers["Content-Encoding"] = encoding
+        return variant_headers
+
+    def put(self, filedata, content_type, remote_path, force=False):
+        """
+        Puts filedata and its compressed variants. The original and each
+        variant are compared with what was last synced on their own, so a
+        missing or stale variant is uploaded without the original and
+        unchanged keys are never sent again. Returns True if anything was
+        uploaded.
+        """
+        index_path = remote_path
+        if self.aws_prefix:
+            remote_path = "%s/%s" % (self.aws_prefix, remote_path)
             
-            key.set_metadata('mediasync-checksum', raw_b64digest)
-            key.set_contents_from_string(filedata, headers=headers, md5=(hexdigest, b64digest))
+        (hexdigest, b64digest) = mediasync.checksum(filedata)
         
-            # check to see if file should be gzipped based on content_type
-            # also check to see if filesize is greater than 1kb
-            if content_type in TYPES_TO_COMPRESS:
-                # Use a .gzt extension to avoid issues with Safari on OSX
-                key = Key(self._bucket, "%s.gzt" % remote_path)
-                
-                filedata = mediasync.compress(filedata)
-                (hexdigest, b64digest) = mediasync.checksum(filedata) # update checksum with compressed data
-                headers["Content-Disposition"] = 'inline; filename="%sgzt"' % remote_path.split('/')[-1]
-                headers["Content-Encoding"] = 'gzip'
-                
-                key.set_metadata('mediasync-checksum', raw_b64digest)
+        # create initial set of headers
+        headers = self.get_headers(content_type)
+        variants = mediasync.compress_variants(filedata, content_type, self.get_variants(content_type),
+                                               index_path)
+        
+        entry = {'checksum': hexdigest, 'size': len(filedata), 'variants': {}}
+        uploaded = False
+        
+        if force or self.is_changed(index_path, remote_path, hexdigest, b64digest):
+            with mediasync.Timing('upload', index_path, content_type, len(filedata)):
+                key = Key(self._bucket, remote_path)
+                key.set_metadata('mediasync-checksum', b64digest)
                 key.set_contents_from_string(filedata, headers=headers, md5=(hexdigest, b64digest))
+            self.uploaded(remote_path, hexdigest, len(filedata))
+            uploaded = True
+        
+        # upload a pre-compressed copy for each variant that is worth it,
+        # using .gzt and .brt extensions to avoid issues with Safari on OSX
+        for encoding, compressed in variants.iteritems():
+            
+            ext = mediasync.ENCODING_EXTENSIONS[encoding]
+            variant_path = "%s.%s" % (remote_path, ext)
+            (variant_hexdigest, variant_b64digest) = mediasync.checksum(compressed)
             
+            if force or self.is_changed(index_path, variant_path, variant_hexdigest, variant_b64digest, ext):
+                with mediasync.Timing('upload', index_path, content_type, len(compressed), encoding=encoding):
+                    key = Key(self._bucket, variant_path)
+                    key.set_metadata('mediasync-checksum', variant_b64digest)
+                    key.set_contents_from_string(compressed,
+                                                 headers=self.get_variant_headers(headers, remote_path, encoding),
+                                                 md5=(variant_hexdigest, variant_b64digest))
+                self.uploaded(variant_path, variant_hexdigest, len(compressed))
+                uploaded = True
+            
+            entry['variants'][ext] = variant_hexdigest
+        
+        self.update_index(index_path, entry)
+        
+        if uploaded:
+            return True
+    
+    def put_file(self, filepath, content_type, remote_path, force=False, checksum=None):
+        """
+        Streams a large file to S3. The file is never read into memory as a
+        whole: it is checksummed in chunks, compressed through a temporary
+        file and uploaded in parts once it is larger than
+        AWS_MULTIPART_THRESHOLD. As with put(), the original and each
+        variant are only uploaded if they changed.
+        """
+        index_path = remote_path
+        if self.aws_prefix:
+            remote_path = "%s/%s" % (self.aws_prefix, remote_path)
+        
+        if checksum is None:
+            checksum = mediasync.checksum_file(filepath)
+        (hexdigest, b64digest) = checksum
+        
+        headers = self.get_headers(content_type)
+        size = os.path.getsize(filepath)
+        variants = mediasync.streamed_variants(size, content_type, self.get_variants(content_type))
+        
+        entry = {'checksum': hexdigest, 'size': size, 'variants': {}}
+        uploaded = False
+        
+        if force or self.is_changed(index_path, remote_path, hexdigest, b64digest):
+            f = open(filepath, 'rb')
+            try:
+                with mediasync.Timing('upload', index_path, content_type, size):
+                    self.upload_file(remote_path, f, size, headers, b64digest, (hexdigest, b64digest))
+            finally:
+                f.close()
+            self.uploaded(remote_path, hexdigest, size)
+            uploaded = True
+        
+        for encoding in variants:
+            
+            ext = mediasync.ENCODING_EXTENSIONS[encoding]
+            variant_path = "%s.%s" % (remote_path, ext)
+            
+            tmp = tempfile.TemporaryFile()
+            try:
+                with mediasync.Timing('compress', index_path, content_type, size, encoding=encoding,
+                                      streamed=True) as t:
+                    (variant_hexdigest, variant_b64digest) = mediasync.compress_file_variant(filepath, tmp,
+                                                                                             content_type, encoding)
+                    variant_size = t.size_out = tmp.tell()
+                
+                if force or self.is_changed(index_path, variant_path, variant_hexdigest, variant_b64digest, ext):
+                    tmp.seek(0)
+                    with mediasync.Timing('upload', index_path, content_type, variant_size, encoding=encoding):
+                        self.upload_file(variant_path, tmp, variant_size,
+                                         self.get_variant_headers(headers, remote_path, encoding),
+                                         variant_b64digest, (variant_hexdigest, variant_b64digest))
+                    self.uploaded(variant_path, variant_hexdigest, variant_size)
+                    uploaded = True
+            finally:
+                tmp.close()
+            
+            entry['variants'][ext] = variant_hexdigest
+        
+        self.update_index(index_path, entry)
+        
+        if uploaded:
             return True
+    
+    def upload_file(self, remote_path, fileobj, size, headers, raw_b64digest, md5):
+        """
+        Uploads the contents of fileobj. Files larger than
+        AWS_MULTIPART_THRESHOLD are sent with a multipart upload when the
+        installed version of boto supports it (boto 2.0 or later).
+        """
+        threshold = msettings.get('AWS_MULTIPART_THRESHOLD', MULTIPART_THRESHOLD)
+        chunk_size = msettings.get('AWS_MULTIPART_CHUNK_SIZE', MULTIPART_CHUNK_SIZE)
+        
+        if size < threshold or not hasattr(self._bucket, 'initiate_multipart_upload'):
+            key = Key(self._bucket, remote_path)
+            key.set_metadata('mediasync-checksum', raw_b64digest)
+            key.set_contents_from_file(fileobj, headers=headers, md5=md5)
+            return
+        
+        mp = self._bucket.initiate_multipart_upload(remote_path, headers=headers,
+                metadata={'mediasync-checksum': raw_b64digest})
+        try:
+            part_num = 0
+            for chunk in iter(lambda: fileobj.read(chunk_size), ''):
+                part_num += 1
+                mp.upload_part_from_file(cStringIO.StringIO(chunk), part_num)
+            mp.complete_upload()
+        except:
+            mp.cancel_upload()
+            raise
@@ -0,0 +1,129 @@
+"""
+On-disk cache of processed file data.
+
+Entries are keyed by the checksum of the unprocessed data, the content type,
+the file extension and the identity of every processor, so the same input
+run through the same processors is only processed once. The cache is kept
+under a total byte budget by evicting the least recently used entries.
+"""
+from mediasync import checksum
+import os
+import threading
+import time
+
+class ProcessorCache(object):
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = None # key -> (last used, size), loaded on first use
+        self._size = 0
+
+    def key(self, filedata, content_type, remote_path, processor_ids, is_active):
+        ext = os.path.splitext(remote_path)[1].lower()
+        parts = [checksum(filedata)[0], content_type or '', ext,
+                 is_active and '1' or '0'] + list(processor_ids)
+        return checksum('|'.join(parts))[0]
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _load(self):
+        self._entries = {}
+        self._size = 0
+        if not os.path.isdir(self.path):
+            return
+        for dirname in os.listdir(self.path):
+            dirpath = os.path.join(self.path, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for key in os.listdir(dirpath):
+                if key.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, key))
+                except OSError:
+                    continue
+                self._entries[key] = (st.st_mtime, st.st_size)
+                self._size += st.st_size
+
+    def get(self, key, touch=True):
+        """
+        Returns the cached data for key or None on a miss. The entry is
+        marked as recently used unless touch is False.
+        """
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+        entry_path = self._entry_path(key)
+        try:
+            f = open(entry_path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            if touch:
+                os.utime(entry_path, None) # mark as recently used
+        except (IOError, OSError):
+            # evicted by another process
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            if touch and key in self._entries:
+                self._entries[key] = (time.time(), self._entries[key][1])
+        return data
+
+    def set(self, key, data):
+        """
+        Stores data for key. Processors can return unicode, which is stored
+        and later returned encoded as UTF-8.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        entry_path = self._entry_path(key)
+        dirname = os.path.dirname(entry_path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_path = "%s.%s.tmp" % (entry_path, threading.current_thread().ident)
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError):
+            return # the cache is an optimization, never fail a sync over it
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            self._forget(key)
+            self._entries[key] = (time.time(), len(data))
+            self._size += len(data)
+            self._evict()
+
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+        for key, (used, size) in sorted(self._entries.items(), key=lambda e: e[1][0]):
+            try:
+                os.remove(self._entry_path(key))
+            except OSError:
+                pass
+            self._forget(key)
+            if self._size <= self.max_size:
+                break
@@ -2,36 +2,59 @@ from django.conf import settings
 from mediasync.processors import slim
 
 _settings = {
+    'CACHE_DIR': None,
+    'COMBO_GZIP': False,
+    'COMPRESS_LEVEL': 6,
+    'COMPRESS_LEVELS': {},
+    'COMPRESS_MIN_RATIO': None,
+    'COMPRESS_MIN_SIZE': 0,
     'CSS_PATH': '',
     'DEFAULT_MIMETYPE': 'application/octet-stream',
     'DOCTYPE': 'html5',
     'EMULATE_COMBO': False,
     'EXPIRATION_DAYS': 365,
+    'FINGERPRINT': False,
     'JOINED': {},
     'JS_PATH': '',
+    'MANIFEST_FILE': None,
     'STATIC_ROOT': getattr(settings, 'STATIC_ROOT', None) or
                    getattr(settings, 'MEDIA_ROOT', None),
     'STATIC_URL': getattr(settings, 'STATIC_URL', None) or
                   getattr(settings, 'MEDIA_URL', None),
+    'STREAMING_THRESHOLD': 4 * 1024 * 1024,
     'PROCESSORS': (slim.css_minifier, slim.js_minifier),
+    'PROCESSOR_CACHE': False,
+    'PROCESSOR_CACHE_SIZE': 64 * 1024 * 1024,
     'SERVE_REMOTE': not settings.DEBUG,
+    'SYNC_BATCH_SIZE': 50,
+    'SYNC_CONCURRENCY': 100,
+    'SYNC_EXCLUDE': (),
+    'SYNC_INCLUDE': (),
+    'SYNC_JOBS': 1,
+    'SYNC_PROCESSES': 1,
+    'SYNC_STATE': False,
     'URL_PROCESSOR': lambda x: x,
 }
 
 class Settings(object):
     
     def __init__(self, conf):
+        # incremented on every change so that anything derived from the
+        # settings can tell when it needs to be recalculated
+        self.generation = 0
         for k, v in conf.iteritems():
             self[k] = v
     
     def __delitem__(self, name):
         del _settings[name]
+        self.generation += 1
     
     def __getitem__(self, name):
         return self.get(name)
     
     def __setitem__(self, name, val):
         _settings[name] = val
+        self.generation += 1
         
     def __str__(self):
         return repr(_settings)
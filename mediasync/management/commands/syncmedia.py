@@ -3,6 +3,11 @@ from optparse import make_option
 from mediasync.conf import msettings
 import mediasync
 
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
 class Command(BaseCommand):
     
     help = "Sync local media with remote client"
@@ -12,15 +17,112 @@ class Command(BaseCommand):
     
     option_list = BaseCommand.option_list + (
         make_option("-F", "--force", dest="force", help="force files to sync", action="store_true"),
+        make_option("-j", "--jobs", dest="jobs", help="number of files to sync concurrently", type="int"),
+        make_option("-p", "--processes", dest="processes", help="number of processes used to process files", type="int"),
+        make_option("-c", "--concurrency", dest="concurrency", help="number of uploads in flight when putting files asynchronously", type="int"),
+        make_option("--max-compression", dest="max_compression", help="compress variants as much as possible", action="store_true"),
+        make_option("--rebuild-state", dest="rebuild_state", help="ignore and regenerate the local sync state", action="store_true"),
+        make_option("-n", "--dry-run", dest="dry_run", help="show what would be synced without writing anything", action="store_true"),
+        make_option("--json", dest="json", help="print the --dry-run plan as JSON", action="store_true"),
+        make_option("--stats", dest="stats", help="report where the time of the sync went", action="store_true"),
+        make_option("--backend", dest="backend", help="sync with this backend instead of the BACKEND setting"),
+        make_option("--profile", dest="profile", help="profile the sync and write pstats files to this directory"),
+        make_option("--profile-top", dest="profile_top", help="number of functions listed for each stage of --profile", type="int", default=20),
+        make_option("--profile-memory", dest="profile_memory", help="sample the peak memory of each stage of --profile", action="store_true"),
+        make_option("--watch", dest="watch", help="keep syncing files as they change", action="store_true"),
+        make_option("--watch-delay", dest="watch_delay", help="seconds without changes before --watch syncs", type="float", default=0.5),
+        make_option("--watch-poll", dest="watch_poll", help="poll for changes every this many seconds instead of using inotify", type="float"),
     )
     
     def handle(self, *args, **options):
         
         msettings['SERVE_REMOTE'] = True
         
+        if options.get('backend'):
+            msettings['BACKEND'] = options['backend']
+        
+        if options.get('max_compression'):
+            msettings['COMPRESS_LEVEL'] = 'max'
+            msettings['COMPRESS_LEVELS'] = {}
+        
         force = options.get('force') or False
+        jobs = options.get('jobs')
+        processes = options.get('processes')
+        concurrency = options.get('concurrency')
+        rebuild_state = options.get('rebuild_state') or False
+        
+        if options.get('json') and not options.get('dry_run'):
+            raise CommandError('--json can only be used with --dry-run')
+        
+        if options.get('watch') and options.get('dry_run'):
+            raise CommandError('--watch can not be used with --dry-run')
+        
+        if options.get('dry_run'):
+            plan = mediasync.plan(force=force, rebuild_state=rebuild_state)
+            if options.get('json'):
+                print json.dumps(plan.as_dict(), indent=2, sort_keys=True)
+            else:
+                for line in plan.summary():
+                    print line
+            return
+        
+        stats = None
+        if options.get('stats'):
+            from mediasync.stats import SyncStats
+            stats = SyncStats()
+            stats.connect()
+        
+        if options.get('profile_memory') and not options.get('profile'):
+            raise CommandError('--profile-memory can only be used with --profile')
+        
+        if options.get('watch') and options.get('profile'):
+            raise CommandError('--watch can not be used with --profile')
         
         try:
-            mediasync.sync(force=force)
+            if options.get('watch'):
+                self.watch(options.get('watch_delay'), options.get('watch_poll'), force=force,
+                           jobs=jobs, processes=processes, concurrency=concurrency,
+                           rebuild_state=rebuild_state)
+            elif options.get('profile'):
+                self.profile(options['profile'], options.get('profile_top'),
+                             options.get('profile_memory'), force=force, concurrency=concurrency,
+                             rebuild_state=rebuild_state)
+            else:
+                mediasync.sync(force=force, jobs=jobs, processes=processes, concurrency=concurrency,
+                               rebuild_state=rebuild_state)
         except ValueError, ve:
-            raise CommandError('%s\nUsage is mediasync %s' % (ve.message, self.args))
\ No newline at end of file
+            raise CommandError('%s\nUsage is mediasync %s' % (ve.message, self.args))
+        finally:
+            if stats is not None:
+                stats.disconnect()
+        
+        if stats is not None:
+            for line in stats.summary():
+                print line
+    
+    def profile(self, directory, limit, memory, **kwargs):
+        """
+        Syncs with a single job and no worker processes, so that all of the
+        work is done in this thread where it can be profiled.
+        """
+        from mediasync import backends
+        from mediasync.profiling import SyncProfiler
+        
+        client = backends.client()
+        profiler = SyncProfiler(memory=memory)
+        profiler.run(client, mediasync.sync, client, jobs=1, processes=1, **kwargs)
+        
+        for line in profiler.summary(limit):
+            print line
+        for path in profiler.dump(directory):
+            print "[profile] %s" % path
+    
+    def watch(self, delay, interval, **kwargs):
+        from mediasync import backends
+        from mediasync.watch import get_watcher, watch
+        
+        client = backends.client()
+        try:
+            watch(client, delay=delay, watcher=get_watcher(client.media_root, interval), **kwargs)
+        except KeyboardInterrupt:
+            pass
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""
+Manifest of fingerprinted file names and compressed variants.
+
+When FINGERPRINT is on, sync() pushes each file under a name that contains
+a checksum of its content (style.css becomes style.3f9a1c2b4d5e.css) and
+writes a manifest that maps the original paths to those names. The
+template tags look names up in the manifest, which is loaded once per
+process, so URLs change whenever the content does.
+
+The manifest also records which compressed variants (.gzt, .brt) were
+uploaded for each file, so that the template tags don't link a variant the
+compression policy decided wasn't worth keeping.
+"""
+from mediasync.conf import msettings
+import os
+import threading
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+MANIFEST_FILE = 'mediasync-manifest.json'
+MANIFEST_VERSION = 1
+
+# number of checksum characters added to file names
+FINGERPRINT_LENGTH = 12
+
+_files = None
+_lock = threading.Lock()
+
+# incremented whenever the manifest entries are replaced
+generation = 0
+
+def manifest_path():
+    return msettings['MANIFEST_FILE'] or \
+           os.path.join(msettings['STATIC_ROOT'], MANIFEST_FILE)
+
+def fingerprint(remote_path, hexdigest):
+    """
+    Adds a checksum to the file name in remote_path, before the extension.
+    """
+    dirname, filename = os.path.split(remote_path)
+    name, ext = os.path.splitext(filename)
+    filename = "%s.%s%s" % (name, hexdigest[:FINGERPRINT_LENGTH], ext)
+    return "%s/%s" % (dirname, filename) if dirname else filename
+
+def load():
+    """
+    Returns the manifest entries, reading the manifest file the first
+    time it is called.
+    """
+    global _files, generation
+    if _files is None:
+        with _lock:
+            if _files is None:
+                _files = read(manifest_path())
+                generation += 1
+    return _files
+
+def reload():
+    global _files, generation
+    with _lock:
+        _files = read(manifest_path())
+        generation += 1
+
+def read(path):
+    try:
+        f = open(path)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+    if data.get('version') != MANIFEST_VERSION:
+        return {}
+    return data.get('files', {})
+
+def lookup(remote_path):
+    """
+    Returns the fingerprinted name of remote_path or None if it is not in
+    the manifest.
+    """
+    entry = load().get(remote_path.strip('/'))
+    if entry:
+        return entry['name']
+
+def variants(remote_path):
+    """
+    Returns the content encodings of the compressed variants synced for
+    remote_path, or None if the manifest doesn't record them.
+    """
+    entry = load().get(remote_path.strip('/'))
+    if entry:
+        return entry.get('variants')
+
+def save(files):
+    """
+    Writes the manifest and replaces the entries used by this process.
+    """
+    global _files, generation
+
+    path = manifest_path()
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    tmp_path = "%s.tmp" % path
+    f = open(tmp_path, 'w')
+    try:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+    with _lock:
+        _files = files
+        generation += 1
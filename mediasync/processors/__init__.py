@@ -0,0 +1,16 @@
+def processor_id(proc):
+    """
+    Returns a string that identifies a processor callable across runs. A
+    processor can define a *version* attribute so that cached output is
+    invalidated when its behavior changes. *version* can also be a function
+    that returns the version, so that it can include the settings of the
+    processor and the version of the tool it runs.
+    """
+    name = getattr(proc, '__name__', None) or proc.__class__.__name__
+    ident = "%s.%s" % (getattr(proc, '__module__', ''), name)
+    version = getattr(proc, 'version', None)
+    if callable(version):
+        version = version()
+    if version is not None:
+        ident = "%s:%s" % (ident, version)
+    return ident
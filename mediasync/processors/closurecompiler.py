@@ -1,26 +1,121 @@
-from mediasync import JS_MIMETYPES
+from mediasync import JS_MIMETYPES, SyncException
+from mediasync.conf import msettings
 from urllib import urlencode
+from urlparse import urlparse
 import httplib
+import socket
+import threading
+import time
 
 HEADERS = {"content-type": "application/x-www-form-urlencoded"}
 
+DEFAULT_URL = 'http://closure-compiler.appspot.com/compile'
+DEFAULT_LEVEL = 'SIMPLE_OPTIMIZATIONS'
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 2
+
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive connections to the compiler service so that each
+    file doesn't pay for a new connection. Each connection is only used by
+    one thread at a time.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc, timeout):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        conn_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return conn_class(netloc, timeout=timeout)
+
+    def release(self, scheme, netloc, conn):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def clear(self):
+        with self._lock:
+            for conns in self._idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+pool = ConnectionPool()
+
+def _post(url, params):
+    """
+    POSTs params to the compiler service, retrying on connection errors,
+    timeouts and server errors.
+    """
+    timeout = msettings.get('CLOSURE_COMPILER_TIMEOUT', DEFAULT_TIMEOUT)
+    retries = msettings.get('CLOSURE_COMPILER_RETRIES', DEFAULT_RETRIES)
+
+    parsed = urlparse(url)
+    path = parsed.path or '/'
+
+    error = None
+    for attempt in range(retries + 1):
+
+        if attempt:
+            time.sleep(0.5 * attempt)
+
+        conn = pool.get(parsed.scheme, parsed.netloc, timeout)
+        try:
+            conn.request('POST', path, params, HEADERS)
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            # the connection may have been closed by the server while idle
+            conn.close()
+            error = e
+            continue
+
+        if response.will_close:
+            conn.close()
+        else:
+            pool.release(parsed.scheme, parsed.netloc, conn)
+
+        if response.status >= 500:
+            error = "HTTP %s" % response.status
+            continue
+        if response.status != 200:
+            raise SyncException("Closure Compiler returned HTTP %s" % response.status)
+
+        return data
+
+    raise SyncException("Closure Compiler request failed: %s" % error)
+
 def compile(filedata, content_type, remote_path, is_active):
-    
+
     is_js = (content_type in JS_MIMETYPES or remote_path.lower().endswith('.js'))
-    
+
     if is_js:
-        
+
+        level = msettings.get('CLOSURE_COMPILER_LEVEL', DEFAULT_LEVEL)
+
         params = urlencode({
             'js_code': filedata,
-            'compilation_level': 'SIMPLE_OPTIMIZATIONS',
+            'compilation_level': level,
             'output_info': 'compiled_code',
             'output_format': 'text',
         })
 
-        conn = httplib.HTTPConnection('closure-compiler.appspot.com')
-        conn.request('POST', '/compile', params, HEADERS)
-        response = conn.getresponse()
-        data = response.read()
-        conn.close
-        
-        return data
\ No newline at end of file
+        url = msettings.get('CLOSURE_COMPILER_URL', DEFAULT_URL)
+        data = _post(url, params)
+
+        if filedata.strip() and not data.strip():
+            # the service returns nothing when the code doesn't compile
+            raise SyncException("Closure Compiler returned no code for %s" % remote_path)
+
+        return data
+
+def _version():
+    return "%s|%s" % (msettings.get('CLOSURE_COMPILER_LEVEL', DEFAULT_LEVEL),
+                      msettings.get('CLOSURE_COMPILER_URL', DEFAULT_URL))
+
+# cached output is invalidated when the level or the service changes
+compile.version = _version
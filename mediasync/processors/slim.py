@@ -13,3 +13,10 @@ def js_minifier(filedata, content_type, remote_path, is_active):
     is_js = content_type == 'text/javascript' or remote_path.lower().endswith('.js')
     if SLIMMER_INSTALLED and is_active and is_js:
         return slimmer.css_slimmer(filedata)
+
+def _version():
+    if SLIMMER_INSTALLED:
+        return "slimmer-%s" % getattr(slimmer, '__version__', '')
+
+# cached output is invalidated when slimmer is upgraded
+css_minifier.version = js_minifier.version = _version
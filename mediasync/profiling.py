@@ -0,0 +1,231 @@
+"""
+Profiles a sync, broken down by stage.
+
+SyncProfiler runs a profiler for each stage of a sync and switches between
+them as the sync moves from one stage to the next:
+
+* walk: listing the files in the media root and the JOINED files
+* combine: concatenating the sources of JOINED files
+* process: reading, processing, checksumming and compressing files
+* backend: everything the backend does, from open() to close()
+
+Time spent outside of these, such as saving the sync state and the
+manifest, is profiled as the sync stage. Only the thread that starts the
+profiler is profiled, so sync with a single job and no worker processes.
+"""
+import cProfile
+import os
+import pstats
+import StringIO
+import sys
+import threading
+import time
+
+import mediasync
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+STAGES = ('walk', 'combine', 'process', 'backend')
+OTHER_STAGE = 'sync'
+
+# functions of the mediasync module that start each stage
+SYNC_STAGES = (
+    ('_all_items', 'walk'),
+    ('combine_files', 'combine'),
+    ('prepare_items', 'process'),
+    ('_put_args', 'process'),
+)
+
+# client methods that start the backend stage
+CLIENT_METHODS = ('open', 'flush', 'close', 'put', 'put_file', 'put_many',
+                  'put_async', 'put_file_async', 'poll')
+
+def current_memory():
+    """
+    Returns the resident memory of this process in kilobytes, or its peak
+    resident memory where the current value is unknown, or None.
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * (os.sysconf('SC_PAGE_SIZE') / 1024)
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            usage /= 1024 # reported in bytes instead of kilobytes
+        return usage
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the memory of the process every interval seconds and keeps the
+    peak of each stage of a SyncProfiler.
+    """
+
+    def __init__(self, profiler, interval=0.01):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+        self.profiler = profiler
+        self.interval = interval
+        self.peaks = {}
+        self._done = threading.Event()
+
+    def sample(self):
+        memory = current_memory()
+        if memory is not None:
+            stage = self.profiler.stage
+            self.peaks[stage] = max(self.peaks.get(stage, 0), memory)
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+
+class SyncProfiler(object):
+
+    def __init__(self, memory=False, interval=0.01):
+        self.profiles = {}
+        self.times = {}
+        self.stage = None
+        self.sampler = memory and MemorySampler(self, interval) or None
+        self._thread = None
+        self._switched = None
+        self._wrapped = []
+
+    def wrap(self, obj, name, stage):
+        """
+        Replaces a function or method of obj with one that runs in stage.
+        """
+        original = getattr(obj, name)
+        own = name in getattr(obj, '__dict__', {})
+
+        def staged(*args, **kwargs):
+            if threading.current_thread() is not self._thread:
+                return original(*args, **kwargs)
+            previous = self.switch(stage)
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.switch(previous)
+
+        self._wrapped.append((obj, name, own and original))
+        setattr(obj, name, staged)
+
+    def restore(self):
+        for obj, name, original in reversed(self._wrapped):
+            if original:
+                setattr(obj, name, original)
+            else:
+                delattr(obj, name)
+        self._wrapped = []
+
+    def switch(self, stage):
+        """
+        Stops profiling the current stage and starts profiling stage.
+        Returns the stage that was running.
+        """
+        previous = self.stage
+        if stage == previous:
+            return previous
+        now = time.time()
+        if previous is not None:
+            self.profiles[previous].disable()
+            self.times[previous] = self.times.get(previous, 0.0) + now - self._switched
+        self.stage = stage
+        self._switched = now
+        if stage is not None:
+            if stage not in self.profiles:
+                self.profiles[stage] = cProfile.Profile()
+            self.profiles[stage].enable()
+        return previous
+
+    def run(self, client, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs), usually mediasync.sync(client, ...),
+        with the stages of the sync and of client profiled.
+        """
+        for name, stage in SYNC_STAGES:
+            self.wrap(mediasync, name, stage)
+        for name in CLIENT_METHODS:
+            self.wrap(client, name, 'backend')
+
+        self._thread = threading.current_thread()
+        self.switch(OTHER_STAGE)
+        if self.sampler is not None:
+            self.sampler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if self.sampler is not None:
+                self.sampler.stop()
+            self.switch(None)
+            self.restore()
+
+    def stats(self, stage=None):
+        """
+        Returns the pstats.Stats of a stage, or of the whole sync.
+        """
+        stages = stage and [stage] or [s for s in STAGES + (OTHER_STAGE,) if s in self.profiles]
+        stats = pstats.Stats(self.profiles[stages[0]])
+        for other in stages[1:]:
+            stats.add(self.profiles[other])
+        return stats
+
+    def dump(self, directory):
+        """
+        Writes a pstats file for each stage and one for the whole sync to
+        directory. Returns the paths of the files.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = []
+        for stage in STAGES + (OTHER_STAGE,):
+            if stage in self.profiles:
+                path = os.path.join(directory, "%s.pstats" % stage)
+                self.stats(stage).dump_stats(path)
+                paths.append(path)
+        if paths:
+            path = os.path.join(directory, "all.pstats")
+            self.stats().dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def summary(self, limit=20, sort='cumulative'):
+        """
+        Returns lines with the time, and the peak memory when it was
+        sampled, of each stage and the limit functions of each stage with
+        the most time sorted by sort.
+        """
+        total = sum(self.times.itervalues()) or 1.0
+        peaks = self.sampler is not None and self.sampler.peaks or {}
+        lines = []
+        for stage in STAGES + (OTHER_STAGE,):
+            if stage not in self.times:
+                continue
+            line = "%-8s %8.3fs %5.1f%%" % (stage, self.times[stage], 100 * self.times[stage] / total)
+            if stage in peaks:
+                line += "  peak memory %d KB" % peaks[stage]
+            lines.append(line)
+        for stage in STAGES + (OTHER_STAGE,):
+            if stage not in self.profiles:
+                continue
+            out = StringIO.StringIO()
+            stats = self.stats(stage)
+            stats.stream = out
+            stats.strip_dirs().sort_stats(sort).print_stats(limit)
+            lines.append('')
+            lines.append("%s stage:" % stage)
+            lines.extend(line for line in out.getvalue().splitlines() if line.strip())
+        return lines
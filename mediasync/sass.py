@@ -0,0 +1,226 @@
+"""
+Incremental compilation of Sass stylesheets for the SASS receiver.
+
+Each .sass or .scss file in the static root is compiled to a .css file
+next to it. A stylesheet is only compiled when its CSS is missing or older
+than the stylesheet or any of the files it imports, directly or through
+other imports. Partials, whose names start with an underscore, are only
+compiled as part of the stylesheets that import them.
+
+Stale stylesheets are compiled with as few runs of SASS_COMMAND as
+possible: with SASS_BATCH on, each run is given several files with
+--update, and up to SASS_JOBS runs happen at once. If a batched run fails,
+its files are compiled one at a time to find the ones that don't compile.
+"""
+from __future__ import absolute_import
+
+from mediasync import SyncException
+from mediasync.conf import msettings
+from mediasync.tree import scan
+from subprocess import Popen, PIPE
+import os
+import re
+import shlex
+import threading
+
+SASS_EXTENSIONS = ('.scss', '.sass')
+
+IMPORT_RE = re.compile(r'^\s*@(?:import|use|forward)\s+([^;\n]+)', re.MULTILINE)
+QUOTED_RE = re.compile(r'''["']([^"']+)["']''')
+
+# imports of each stylesheet, keyed by path and checked against its mtime
+_imports = {}
+_lock = threading.Lock()
+
+def is_sass(path):
+    return os.path.splitext(path)[1] in SASS_EXTENSIONS
+
+def css_path(sass_path):
+    return sass_path[:-4] + "css"
+
+def sass_command():
+    return shlex.split(msettings.get('SASS_COMMAND', 'sass'))
+
+def load_paths(command):
+    """
+    Returns the directories given to the command with -I or --load-path.
+    """
+    paths = []
+    args = iter(command)
+    for arg in args:
+        if arg in ('-I', '--load-path'):
+            paths.append(next(args, ''))
+        elif arg.startswith('--load-path='):
+            paths.append(arg[len('--load-path='):])
+        elif arg.startswith('-I'):
+            paths.append(arg[2:])
+    return [path for path in paths if path]
+
+def parse_imports(source):
+    """
+    Returns the names imported by a stylesheet. Imports of plain CSS and of
+    URLs are left out since they are not compiled in.
+    """
+    names = []
+    for statement in IMPORT_RE.findall(source):
+        quoted = QUOTED_RE.findall(statement)
+        if not quoted and 'url(' not in statement:
+            # the indented syntax allows unquoted imports
+            quoted = [name.strip() for name in statement.split(',')]
+        for name in quoted:
+            if name.endswith('.css') or name.startswith('url(') or '://' in name or \
+                    name.startswith('sass:'):
+                continue
+            names.append(name)
+    return names
+
+def resolve_import(name, dirs):
+    """
+    Finds the file an import refers to the way Sass does: as a stylesheet or
+    a partial, with either extension, or as the index of a directory.
+    """
+    dirname, basename = os.path.split(name)
+    candidates = []
+    for ext in ('',) + SASS_EXTENSIONS:
+        candidates.append(os.path.join(dirname, basename + ext))
+        candidates.append(os.path.join(dirname, '_' + basename + ext))
+    for ext in SASS_EXTENSIONS:
+        candidates.append(os.path.join(name, 'index' + ext))
+        candidates.append(os.path.join(name, '_index' + ext))
+    for directory in dirs:
+        for candidate in candidates:
+            path = os.path.join(directory, candidate)
+            if is_sass(path) and os.path.isfile(path):
+                return os.path.abspath(path)
+
+def imports(path, paths=()):
+    """
+    Returns the paths of the stylesheets imported by the one at path.
+    Imports that can't be found, such as those from Compass, are ignored.
+    """
+    mtime = os.path.getmtime(path)
+    with _lock:
+        cached = _imports.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    f = open(path)
+    try:
+        source = f.read()
+    finally:
+        f.close()
+
+    dirs = [os.path.dirname(path)] + list(paths)
+    resolved = []
+    for name in parse_imports(source):
+        imported = resolve_import(name, dirs)
+        if imported is not None:
+            resolved.append(imported)
+
+    with _lock:
+        _imports[path] = (mtime, resolved)
+    return resolved
+
+def newest_mtime(path, paths=(), seen=None):
+    """
+    Returns the latest mtime of a stylesheet and everything it imports.
+    """
+    if seen is None:
+        seen = set()
+    seen.add(path)
+    mtime = os.path.getmtime(path)
+    for imported in imports(path, paths):
+        if imported not in seen:
+            mtime = max(mtime, newest_mtime(imported, paths, seen))
+    return mtime
+
+def stale_stylesheets(root, paths=()):
+    """
+    Returns the stylesheets in root whose CSS is missing or out of date.
+    """
+    stale = []
+    for media_file in scan(root):
+        # partials start with an underscore, so scan() leaves them out
+        if not is_sass(media_file.path):
+            continue
+        sass_path = media_file.filepath
+        output = css_path(sass_path)
+        if not os.path.exists(output) or \
+                os.path.getmtime(output) < newest_mtime(sass_path, paths):
+            stale.append(sass_path)
+    return stale
+
+def run(args):
+    """
+    Runs a Sass command and returns its exit code and error output.
+    """
+    try:
+        proc = Popen(args, stdout=PIPE, stderr=PIPE)
+    except OSError, e:
+        raise SyncException("SASS_COMMAND %s could not be run: %s" % (args[0], e))
+    stdout, stderr = proc.communicate()
+    return proc.returncode, (stderr or stdout).strip()
+
+def compile_one(command, sass_path):
+    """
+    Compiles a single stylesheet. Returns None or an error message.
+    """
+    returncode, output = run(command + [sass_path, css_path(sass_path)])
+    if returncode != 0:
+        return "%s: exit code %s: %s" % (sass_path, returncode, output)
+
+def compile_batch(command, sass_paths, batch=True):
+    """
+    Compiles stylesheets and returns a list of error messages.
+    """
+    if batch and len(sass_paths) > 1:
+        pairs = ["%s:%s" % (path, css_path(path)) for path in sass_paths]
+        returncode, output = run(command + ['--update'] + pairs)
+        if returncode == 0:
+            return []
+    errors = []
+    for path in sass_paths:
+        error = compile_one(command, path)
+        if error is not None:
+            errors.append(error)
+    return errors
+
+def compile_stale(root, command=None, batch=None, jobs=None):
+    """
+    Compiles the stale stylesheets in root and returns their paths. Raises
+    SyncException listing the stylesheets that failed to compile.
+    """
+    if command is None:
+        command = sass_command()
+    if batch is None:
+        batch = msettings.get('SASS_BATCH', True)
+    if jobs is None:
+        jobs = msettings.get('SASS_JOBS') or 1
+
+    stale = stale_stylesheets(root, load_paths(command))
+    if not stale:
+        return stale
+
+    if not batch:
+        chunks = [[path] for path in stale]
+    else:
+        # a batch for each job, so batches are compiled at the same time
+        size = -(-len(stale) // max(jobs, 1))
+        chunks = [stale[i:i + size] for i in range(0, len(stale), size)]
+
+    if jobs > 1 and len(chunks) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(jobs, len(chunks)))
+        try:
+            results = pool.map(lambda chunk: compile_batch(command, chunk, batch), chunks)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [compile_batch(command, chunk, batch) for chunk in chunks]
+
+    errors = [error for result in results for error in result]
+    if errors:
+        raise SyncException("%d of %d Sass stylesheets failed to compile:\n%s" %
+                            (len(errors), len(stale), "\n".join(errors)))
+    return stale
@@ -1,13 +1,12 @@
 from django.core import management
 from django.core.management.base import CommandError
 from django.dispatch import Signal
-from mediasync import SyncException, listdir_recursive
+from mediasync import SyncException
 from mediasync.conf import msettings
-import os
-import subprocess
 
 pre_sync = Signal()
 post_sync = Signal()
+sync_timing = Signal(providing_args=['phase', 'remote_path', 'content_type', 'duration', 'size', 'size_out'])
 
 def collectstatic_receiver(sender, **kwargs):
     try:
@@ -16,17 +15,9 @@ def collectstatic_receiver(sender, **kwargs):
         raise SyncException("collectstatic management command not found")
 
 def sass_receiver(sender, **kwargs):
-    
-    sass_cmd = msettings.get("SASS_COMMAND", "sass")
-    
-    root = msettings['STATIC_ROOT']
-    
-    for filename in listdir_recursive(root):
-        
-        if filename.endswith('.sass') or filename.endswith('.scss'):
-            
-            sass_path = os.path.join(root, filename)
-            css_path = sass_path[:-4] + "css"
-            
-            cmd = "%s %s %s" % (sass_cmd, sass_path, css_path)
-            subprocess.call(cmd.split(' '))
\ No newline at end of file
+    """
+    Compiles the Sass stylesheets in the static root whose CSS is missing
+    or out of date, see mediasync.sass.
+    """
+    from mediasync.sass import compile_stale
+    compile_stale(msettings['STATIC_ROOT'])
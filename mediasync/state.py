@@ -0,0 +1,148 @@
+"""
+Local record of what was pushed by the last successful sync.
+
+The state file maps each remote path to the mtime and size of the local
+files it was built from, the checksum of the unprocessed source and the
+checksum of the processed data that was put to the backend. sync() uses it
+to skip files that haven't changed without reading or processing them.
+"""
+from mediasync import checksum
+from mediasync.conf import msettings
+import os
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+STATE_FILE = 'state.json'
+STATE_VERSION = 1
+
+class SyncState(object):
+
+    def __init__(self, client):
+        self.path = os.path.join(client.get_cache_dir(), STATE_FILE)
+        self.target = self.get_target(client)
+        self.files = {}
+        self._seen = set()
+
+    def get_target(self, client):
+        """
+        Identifies where and how files were synced. The saved state is
+        ignored if the remote location, the processors or the compression
+        settings have changed.
+        """
+        target = "%s|%s|%s" % (client.remote_media_url(), ','.join(client.processor_ids),
+                               msettings['FINGERPRINT'] and 'fingerprint+original' or '')
+        if client.supports_brotli():
+            target = "%s|brotli" % target
+        target = "%s|%r|%r|%r|%r" % (target, msettings['COMPRESS_LEVEL'],
+                                     sorted((msettings['COMPRESS_LEVELS'] or {}).items()),
+                                     msettings['COMPRESS_MIN_SIZE'], msettings['COMPRESS_MIN_RATIO'])
+        return checksum(target)[0]
+
+    def load(self):
+        try:
+            f = open(self.path)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return # no usable state, everything will be synced
+        if data.get('version') == STATE_VERSION and data.get('target') == self.target:
+            self.files = data.get('files', {})
+
+    def save(self):
+        """
+        Writes the state of every file seen during this sync. The file is
+        replaced atomically so an interrupted save leaves the old state.
+        """
+        files = dict((path, entry) for path, entry in self.files.iteritems()
+                     if path in self._seen)
+        data = {'version': STATE_VERSION, 'target': self.target, 'files': files}
+
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        tmp_path = "%s.tmp" % self.path
+        f = open(tmp_path, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+
+    def stat(self, item):
+        """
+        Returns a list of [path, mtime, size] for each source of the item.
+        Missing sources are recorded with None for mtime and size.
+        """
+        if item.mtime is not None:
+            # listed by mediasync.tree.scan(), which already stat'ed it
+            return [[item.filepath, item.mtime, item.size]]
+        stats = []
+        for path in item.sources:
+            try:
+                st = os.stat(path)
+                stats.append([path, st.st_mtime, st.st_size])
+            except OSError:
+                stats.append([path, None, None])
+        return stats
+
+    def is_fresh(self, item):
+        """
+        True if none of the item's sources changed since it was last synced.
+        """
+        entry = self.files.get(item.remote_path)
+        return bool(entry and entry.get('checksum') and
+                    entry.get('sources') == self.stat(item))
+
+    def keep(self, item):
+        """
+        Keeps the entry of an item that was skipped because it is fresh.
+        """
+        self._seen.add(item.remote_path)
+
+    def has_source(self, item, source_checksum):
+        """
+        True if the item was last synced from identical unprocessed data.
+        """
+        entry = self.files.get(item.remote_path)
+        return bool(entry and entry.get('checksum') and
+                    entry.get('source') == source_checksum)
+
+    def get_name(self, item):
+        """
+        Returns the name the item was last put under, which differs from
+        its remote path when FINGERPRINT is on.
+        """
+        entry = self.files.get(item.remote_path) or {}
+        return entry.get('name') or item.remote_path
+
+    def get_variants(self, item):
+        """
+        Returns the content encodings of the compressed variants that were
+        last uploaded for the item.
+        """
+        entry = self.files.get(item.remote_path) or {}
+        return entry.get('variants') or []
+
+    def forget(self, remote_path):
+        """
+        Drops the entry of a file that no longer exists locally.
+        """
+        self.files.pop(remote_path, None)
+        self._seen.discard(remote_path)
+
+    def update(self, item, source_checksum, processed_checksum=None, name=None, variants=None):
+        entry = self.files.get(item.remote_path) or {}
+        entry['sources'] = self.stat(item)
+        entry['source'] = source_checksum
+        if processed_checksum is not None:
+            entry['checksum'] = processed_checksum
+            entry['name'] = name or item.remote_path
+            entry['variants'] = variants or []
+        self.files[item.remote_path] = entry
+        self._seen.add(item.remote_path)
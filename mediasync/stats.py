@@ -0,0 +1,88 @@
+"""
+Where the time of a sync goes.
+
+SyncStats collects the sync_timing signals sent while files are read,
+processed, compressed and put, and sums them up per phase, per processor,
+per file and per content type. Work done in the worker processes of a
+sync with more than one process sends its signals in those processes and
+is not included.
+"""
+from mediasync.signals import sync_timing
+import threading
+
+# phases that make up the time spent on a file; lookup and upload are
+# part of put, as is compression done by the backend while streaming
+FILE_PHASES = ('read', 'checksum', 'process', 'compress', 'put')
+
+class SyncStats(object):
+
+    def __init__(self):
+        self.phases = {}
+        self.processors = {}
+        self.files = {}
+        self.types = {}
+        self._lock = threading.Lock()
+
+    def connect(self):
+        sync_timing.connect(self.receiver, weak=False)
+
+    def disconnect(self):
+        sync_timing.disconnect(self.receiver)
+
+    def _add(self, totals, key, duration, size=None, size_out=None):
+        entry = totals.setdefault(key, [0, 0.0, 0, 0])
+        entry[0] += 1
+        entry[1] += duration
+        entry[2] += size or 0
+        entry[3] += size_out or 0
+
+    def receiver(self, sender, phase, remote_path, content_type, duration, size=None, size_out=None,
+                 **kwargs):
+        with self._lock:
+            self._add(self.phases, phase, duration, size, size_out)
+            if phase == 'process':
+                self._add(self.processors, kwargs.get('processor'), duration, size, size_out)
+            if remote_path and phase in FILE_PHASES and not (phase == 'compress' and kwargs.get('streamed')):
+                self.files[remote_path] = self.files.get(remote_path, 0.0) + duration
+            if content_type:
+                totals = self.types.setdefault(content_type, [0, 0])
+                if phase == 'read':
+                    totals[0] += size or 0
+                elif phase == 'upload':
+                    totals[1] += size or 0
+
+    def slowest(self, limit=10):
+        """
+        Returns (seconds, remote_path) of the limit files that took longest.
+        """
+        files = sorted(((duration, path) for path, duration in self.files.iteritems()), reverse=True)
+        return files[:limit]
+
+    def summary(self, limit=10):
+        lines = ["%-12s %8s %10s %14s %14s" % ('phase', 'count', 'seconds', 'bytes in', 'bytes out')]
+        for phase in sorted(self.phases):
+            count, duration, size, size_out = self.phases[phase]
+            lines.append("%-12s %8d %10.3f %14d %14d" % (phase, count, duration, size, size_out))
+
+        if self.processors:
+            lines.append('')
+            lines.append("%-40s %8s %10s %14s %14s" % ('processor', 'count', 'seconds', 'bytes in', 'bytes out'))
+            for proc_id in sorted(self.processors):
+                count, duration, size, size_out = self.processors[proc_id]
+                lines.append("%-40s %8d %10.3f %14d %14d" % (proc_id, count, duration, size, size_out))
+
+        slowest = self.slowest(limit)
+        if slowest:
+            lines.append('')
+            lines.append("%-60s %10s" % ('slowest files', 'seconds'))
+            for duration, path in slowest:
+                lines.append("%-60s %10.3f" % (path, duration))
+
+        if self.types:
+            lines.append('')
+            lines.append("%-40s %14s %14s" % ('content type', 'bytes in', 'bytes out'))
+            for content_type in sorted(self.types):
+                size, size_out = self.types[content_type]
+                lines.append("%-40s %14d %14d" % (content_type, size, size_out))
+
+        return lines
@@ -1,5 +1,5 @@
 from django import template
-from mediasync import backends
+from mediasync import backends, manifest
 from mediasync.conf import msettings
 import mediasync
 import mimetypes
@@ -13,10 +13,42 @@ class BaseTagNode(template.Node):
     """
     Base class for all mediasync nodes.
     """
-    def __init__(self, path):
+    def __init__(self, path, literal=False):
         super(BaseTagNode, self).__init__()
         # This is the filename or path+filename supplied by the template call.
         self.path = path
+        # True if the path is a quoted string rather than a variable, in
+        # which case the rendered markup can be memoized.
+        self.literal = literal
+        # (key, markup by variant), replaced as a whole when the key changes
+        # so that a render from another thread can't mix in stale markup
+        self._rendered = (None, {})
+
+    def render(self, context):
+        """
+        Renders the tag, reusing the markup from an earlier render when the
+        path is a string. Markup is kept for each combination of SSL and
+        content encoding and is thrown away when the mediasync settings or the
+        manifest change. A callable CACHE_BUSTER is called on every render.
+        """
+        if not self.literal or callable(msettings['CACHE_BUSTER']):
+            return self.render_tag(context)
+
+        rendered_key = (msettings.generation, manifest.generation)
+        rendered = self._rendered
+        if rendered[0] != rendered_key:
+            rendered = (rendered_key, {})
+            self._rendered = rendered
+
+        variant = (self.use_ssl(context), self.content_encodings(context))
+        markup = rendered[1].get(variant)
+        if markup is None:
+            markup = self.render_tag(context)
+            rendered[1][variant] = markup
+        return markup
+
+    def render_tag(self, context):
+        raise NotImplementedError('render_tag not defined in ' + self.__class__.__name__)
 
     def is_secure(self, context):
         """
@@ -41,6 +73,30 @@ class BaseTagNode(template.Node):
             return 'gzip' in enc and msettings['SERVE_REMOTE']
         return False
 
+    def content_encodings(self, context):
+        """
+        Returns the pre-compressed variants that both the backend and the
+        client support, best first: 'br' goes before 'gzip' if the client
+        accepts Brotli at least as much as gzip. Only remote media has
+        compressed variants.
+        """
+        if 'request' not in context or not msettings['SERVE_REMOTE']:
+            return ()
+        accepted = accepted_encodings(context['request'].META.get('HTTP_ACCEPT_ENCODING', ''))
+        gzip_q = accepted.get('gzip', 0) if client.supports_gzip() else 0
+        br_q = accepted.get('br', 0) if client.supports_brotli() else 0
+        # sorting is stable, so Brotli wins a tie
+        ranked = sorted([(br_q, 'br'), (gzip_q, 'gzip')], key=lambda q_enc: -q_enc[0])
+        return tuple(enc for q, enc in ranked if q)
+
+    def use_ssl(self, context):
+        """
+        The USE_SSL setting can be used to force HTTPS (True) or HTTP (False),
+        otherwise SSL is used if the current page view is secure.
+        """
+        use_ssl = msettings['USE_SSL']
+        return use_ssl if use_ssl is not None else self.is_secure(context)
+
     def get_media_url(self, context):
         """
         Checks to see whether to use the normal or the secure media source,
@@ -49,12 +105,13 @@ class BaseTagNode(template.Node):
         
         NOTE: Not all backends implement SSL media. In this case, they'll just
         return an unencrypted URL.
+        
+        Remote media is used if SERVE_REMOTE is on, regardless of the shared
+        client's serve_remote, which sync() sets on the client it is given.
         """
-        use_ssl = msettings['USE_SSL']
-        is_secure = use_ssl if use_ssl is not None else self.is_secure(context)
-        return client.media_url(with_ssl=True) if is_secure else client.media_url()
+        return client.media_url(with_ssl=self.use_ssl(context), remote=msettings['SERVE_REMOTE'])
 
-    def mkpath(self, url, path, filename=None, gzip=False):
+    def mkpath(self, url, path, filename=None, gzip=False, encoding=None):
         """
         Assembles various components to form a complete resource URL.
         
@@ -64,7 +121,28 @@ class BaseTagNode(template.Node):
                       to the file.
           filename: (str) The file name to serve.
           gzip: (bool) True if client should receive *.gzt version of file.
+          encoding: (str or sequence) Content encoding of the version of the
+                    file the client should receive, 'gzip' for *.gzt or 'br'
+                    for *.brt, or a sequence of them in order of preference.
+                    The first one that was synced is used. Overrides gzip.
         """
+        if encoding is None:
+            encodings = ('gzip',) if gzip else ()
+        elif isinstance(encoding, basestring):
+            encodings = (encoding,)
+        else:
+            encodings = encoding
+
+        remote_path = '/'.join(p.strip('/') for p in (path, filename) if p)
+
+        fingerprinted = None
+        if msettings['FINGERPRINT'] and msettings['SERVE_REMOTE']:
+            # Files were synced under fingerprinted names, look up the
+            # name of this one in the manifest.
+            fingerprinted = manifest.lookup(remote_path)
+            if fingerprinted:
+                path, filename = fingerprinted, None
+
         if path:
             url = "%s/%s" % (url.rstrip('/'), path.strip('/'))
 
@@ -72,11 +150,20 @@ class BaseTagNode(template.Node):
             url = "%s/%s" % (url, filename.lstrip('/'))
         
         content_type = mimetypes.guess_type(url)[0]
-        if gzip and content_type in mediasync.TYPES_TO_COMPRESS:
-            url = "%s.gzt" % url
+        if encodings and content_type in mediasync.TYPES_TO_COMPRESS:
+            synced = manifest.variants(remote_path) if msettings['SERVE_REMOTE'] else None
+            if synced is None and mediasync.may_skip_variants():
+                # no record of the synced variants and the compression
+                # policy may have left them out, only link the plain file
+                synced = ()
+            for enc in encodings:
+                # without a record of the synced variants, assume they exist
+                if synced is None or enc in synced:
+                    url = "%s.%s" % (url, mediasync.ENCODING_EXTENSIONS[enc])
+                    break
 
         cb = msettings['CACHE_BUSTER']
-        if cb:
+        if cb and not fingerprinted:
             # Cache busters help tell the client to re-download the file after
             # a change. This can either be a callable or a constant defined
             # in settings.py.
@@ -93,6 +180,29 @@ class BaseTagNode(template.Node):
                 path = self.path
             return path
 
+def accepted_encodings(header):
+    """
+    Parses an Accept-Encoding header into a dict of content encoding to
+    quality value. Encodings with a quality of 0 are left out.
+    """
+    accepted = {}
+    for part in header.split(','):
+        params = part.strip().split(';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if q > 0:
+            accepted[name] = q
+    return accepted
+
 def get_path_from_tokens(token):
     """
     Just yanks the path out of a list of template tokens. Ignores any
@@ -107,6 +217,13 @@ def get_path_from_tokens(token):
         # No path provided in the tag call.
         return None
 
+def is_literal_path(token):
+    """
+    True if the path argument is a quoted string or there is no path at all.
+    """
+    tokens = token.split_contents()
+    return len(tokens) < 2 or tokens[1][0] in "\"'"
+
 def media_url_tag(parser, token):
     """
     If msettings['SERVE_REMOTE'] == False, returns your STATIC_URL. 
@@ -128,7 +245,7 @@ def media_url_tag(parser, token):
         {% media_url "images/bunny.gif" %}
         {% media_url %}/themes/{{ theme_variable }}/style.css
     """
-    return MediaUrlTagNode(get_path_from_tokens(token))
+    return MediaUrlTagNode(get_path_from_tokens(token), literal=is_literal_path(token))
 register.tag('media_url', media_url_tag)
 
 class MediaUrlTagNode(BaseTagNode):
@@ -136,7 +253,7 @@ class MediaUrlTagNode(BaseTagNode):
     Node for the {% media_url %} tag. See the media_url_tag method above for
     documentation and examples.
     """
-    def render(self, context):
+    def render_tag(self, context):
         path = self.resolve_path(context)
         media_url = self.get_media_url(context)
 
@@ -145,7 +262,7 @@ class MediaUrlTagNode(BaseTagNode):
             return media_url
         else:
             # File/path provided, return the assembled URL.
-            return self.mkpath(media_url, path, gzip=self.supports_gzip(context))
+            return self.mkpath(media_url, path, encoding=self.content_encodings(context))
 
 """
 # CSS related tags
@@ -175,7 +292,7 @@ def css_tag(parser, token):
         # Default values.
         media_type = "screen, projection"
 
-    return CssTagNode(path, media_type=media_type)
+    return CssTagNode(path, media_type=media_type, literal=is_literal_path(token))
 register.tag('css', css_tag)
 
 def css_print_tag(parser, token):
@@ -194,7 +311,7 @@ def css_print_tag(parser, token):
     # Hard wired media type, since this is for media type of 'print'.
     media_type = "print"
 
-    return CssTagNode(path, media_type=media_type)
+    return CssTagNode(path, media_type=media_type, literal=is_literal_path(token))
 register.tag('css_print', css_print_tag)
 
 class CssTagNode(BaseTagNode):
@@ -203,10 +320,10 @@ class CssTagNode(BaseTagNode):
     documentation and examples.
     """
     def __init__(self, *args, **kwargs):
-        super(CssTagNode, self).__init__(*args)
+        super(CssTagNode, self).__init__(*args, literal=kwargs.get('literal', False))
         self.media_type = kwargs.get('media_type', "screen, projection")
 
-    def render(self, context):
+    def render_tag(self, context):
         path = self.resolve_path(context)
         media_url = self.get_media_url(context)
         css_path = msettings['CSS_PATH']
@@ -237,7 +354,7 @@ class CssTagNode(BaseTagNode):
             markup = """<link rel="stylesheet" href="%s" media="%s">"""
         else:
             markup = """<link rel="stylesheet" href="%s" type="text/css" media="%s">"""
-        return markup % (self.mkpath(url, path, filename, gzip=self.supports_gzip(context)), media)
+        return markup % (self.mkpath(url, path, filename, encoding=self.content_encodings(context)), media)
 
 """
 # JavaScript related tags
@@ -252,7 +369,7 @@ def js_tag(parser, token):
         {% js "somefile.js" %}
         
     """
-    return JsTagNode(get_path_from_tokens(token))
+    return JsTagNode(get_path_from_tokens(token), literal=is_literal_path(token))
 register.tag('js', js_tag)
 
 class JsTagNode(BaseTagNode):
@@ -260,7 +377,7 @@ class JsTagNode(BaseTagNode):
     Node for the {% js %} tag. See the js_tag method above for
     documentation and examples.
     """
-    def render(self, context):
+    def render_tag(self, context):
         path = self.resolve_path(context)
         media_url = self.get_media_url(context)
         js_path = msettings['JS_PATH']
@@ -289,4 +406,4 @@ class JsTagNode(BaseTagNode):
             markup = """<script src="%s"></script>"""
         else:
             markup = """<script type="text/javascript" charset="utf-8" src="%s"></script>"""
-        return markup % self.mkpath(url, path, filename, gzip=self.supports_gzip(context))
+        return markup % self.mkpath(url, path, filename, encoding=self.content_encodings(context))
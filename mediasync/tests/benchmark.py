@@ -0,0 +1,236 @@
+"""
+Benchmarks mediasync.sync() against a synthetic media tree.
+
+Files are put to the dummy backend, which can simulate the latency,
+bandwidth and failures of a remote storage service. Run it from the
+directory that contains the mediasync package::
+
+    python -m mediasync.tests.benchmark --files 5000 --latency 0.02 --jobs 8
+
+Each run reports its wall time, the time spent in each phase, the requests
+issued and the peak memory of the process. Phases are timed with the
+sync_timing signal, so they are the ones syncmedia --stats reports. Phase
+times add up the time spent in every thread, and work done in --processes
+workers is not included in them.
+"""
+from optparse import OptionParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'mediasync.tests.settings'
+
+from mediasync.backends import dummy
+from mediasync.conf import msettings
+from mediasync.stats import SyncStats
+import mediasync
+
+EXTENSIONS = {
+    'css': 'css',
+    'js': 'js',
+    'png': 'png',
+}
+
+WORDS = ("body div span color margin padding border width height function "
+         "return var this document window prototype length").split()
+
+class MediaTree(object):
+    """
+    A temporary directory of generated CSS, JavaScript and image files.
+
+    Sizes follow a log-normal distribution around median_size. Text files
+    are made of random words so they compress like real code, images are
+    random bytes that don't compress. bundles JOINED entries are defined,
+    each combining bundle_files of the generated files of one type.
+    """
+
+    def __init__(self, files=1000, mix=None, median_size=8192, sigma=1.0, max_size=None,
+                 bundles=0, bundle_files=5, seed=0, root=None):
+        self.random = random.Random(seed)
+        self.root = root or tempfile.mkdtemp(prefix='mediasync-benchmark-')
+        self.mix = mix or {'css': 2, 'js': 3, 'png': 5}
+        self.median_size = median_size
+        self.sigma = sigma
+        self.max_size = max_size or 64 * median_size
+        self.paths = {}
+        self.size = 0
+        self.joined = {}
+
+        self._text = ' '.join(self.random.choice(WORDS) for i in range(64 * 1024))
+
+        types = sorted(self.mix)
+        weights = [self.mix[t] for t in types]
+        for i in range(files):
+            filetype = self.choose(types, weights)
+            path = "%s/%d/%d.%s" % (filetype, i % 100, i, EXTENSIONS[filetype])
+            self.write(path, self.content(filetype))
+            self.paths.setdefault(filetype, []).append(path)
+
+        for i in range(bundles):
+            filetype = self.random.choice([t for t in ('css', 'js') if self.paths.get(t)])
+            sources = self.random.sample(self.paths[filetype],
+                                         min(bundle_files, len(self.paths[filetype])))
+            self.joined["%s/bundle-%d.%s" % (filetype, i, filetype)] = tuple(sources)
+
+    def choose(self, types, weights):
+        n = self.random.random() * sum(weights)
+        for filetype, weight in zip(types, weights):
+            n -= weight
+            if n < 0:
+                return filetype
+        return types[-1]
+
+    def content(self, filetype):
+        size = int(self.random.lognormvariate(0, self.sigma) * self.median_size)
+        size = max(1, min(size, self.max_size))
+        if filetype == 'png':
+            return os.urandom(size)
+        data = []
+        while size > 0:
+            start = self.random.randint(0, len(self._text) - 1)
+            chunk = self._text[start:start + size]
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def write(self, path, content):
+        filepath = os.path.join(self.root, path)
+        dirname = os.path.dirname(filepath)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        f = open(filepath, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        self.size += len(content)
+
+    def count(self):
+        return sum(len(paths) for paths in self.paths.itervalues())
+
+    def remove(self):
+        shutil.rmtree(self.root)
+
+def peak_memory():
+    """
+    Returns the peak resident memory of this process and of the worker
+    processes it waited for, in kilobytes, or None if it is unknown.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes instead of kilobytes
+        usage, children = usage / 1024, children / 1024
+    return max(usage, children)
+
+def run(jobs=None, processes=None, concurrency=None, batch_size=None):
+    """
+    Syncs STATIC_ROOT with the dummy backend and returns the measurements.
+    """
+    client = dummy.Client()
+    stats = SyncStats()
+
+    started = time.time()
+    stats.connect()
+    try:
+        mediasync.sync(client, verbose=False, jobs=jobs, processes=processes,
+                       concurrency=concurrency, batch_size=batch_size)
+    finally:
+        stats.disconnect()
+    wall = time.time() - started
+
+    return {
+        'wall': wall,
+        'phases': dict((phase, totals[1]) for phase, totals in stats.phases.iteritems()),
+        'processors': dict((proc_id, totals[1]) for proc_id, totals in stats.processors.iteritems()),
+        'requests': client.requests,
+        'failures': client.failures,
+        'bytes': client.bytes_sent,
+        'memory': peak_memory(),
+    }
+
+def report(number, result, out=sys.stdout):
+    print >> out, "run %d: %.2fs wall" % (number, result['wall'])
+    for phase in sorted(result['phases']):
+        print >> out, "  %-10s %.2fs" % (phase, result['phases'][phase])
+    for proc_id in sorted(result['processors']):
+        print >> out, "    %s %.2fs" % (proc_id, result['processors'][proc_id])
+    print >> out, "  %d requests (%d failed), %d bytes sent" % (
+        result['requests'], result['failures'], result['bytes'])
+    if result['memory'] is not None:
+        print >> out, "  peak memory %d KB" % result['memory']
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        filetype, weight = part.split(':')
+        if filetype not in EXTENSIONS:
+            raise ValueError("unknown file type %s" % filetype)
+        mix[filetype] = float(weight)
+    return mix
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m mediasync.tests.benchmark [options]")
+    parser.add_option("--files", type="int", default=1000, help="number of files to generate")
+    parser.add_option("--mix", default="css:2,js:3,png:5", help="relative number of each file type")
+    parser.add_option("--median-size", type="int", default=8192, help="median file size in bytes")
+    parser.add_option("--sigma", type="float", default=1.0, help="spread of the log-normal file sizes")
+    parser.add_option("--max-size", type="int", help="largest file size in bytes")
+    parser.add_option("--bundles", type="int", default=0, help="number of JOINED bundles")
+    parser.add_option("--bundle-files", type="int", default=5, help="number of files in each bundle")
+    parser.add_option("--seed", type="int", default=0, help="seed for the generated tree and failures")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds added to each request")
+    parser.add_option("--bandwidth", type="int", help="bytes per second of each request")
+    parser.add_option("--failure-rate", type="float", default=0.0, help="probability that a request fails")
+    parser.add_option("--gzip", action="store_true", help="put gzipped variants of text files")
+    parser.add_option("--minify", action="store_true", help="run the default processors")
+    parser.add_option("--state", action="store_true", help="turn on SYNC_STATE so later runs are incremental")
+    parser.add_option("--runs", type="int", default=1, help="number of syncs to run")
+    parser.add_option("-j", "--jobs", type="int")
+    parser.add_option("-p", "--processes", type="int")
+    parser.add_option("-c", "--concurrency", type="int")
+    parser.add_option("--batch-size", type="int")
+    parser.add_option("--keep", action="store_true", help="don't remove the generated tree")
+    options, args = parser.parse_args(argv)
+
+    tree = MediaTree(files=options.files, mix=parse_mix(options.mix),
+                     median_size=options.median_size, sigma=options.sigma,
+                     max_size=options.max_size, bundles=options.bundles,
+                     bundle_files=options.bundle_files, seed=options.seed)
+    print "%d files, %d bytes in %s" % (tree.count(), tree.size, tree.root)
+
+    msettings['STATIC_ROOT'] = tree.root
+    msettings['JOINED'] = tree.joined
+    msettings['CACHE_DIR'] = os.path.join(tree.root, '.mediasync')
+    msettings['MANIFEST_FILE'] = os.path.join(msettings['CACHE_DIR'], 'manifest.json')
+    msettings['SYNC_STATE'] = bool(options.state)
+    msettings['DUMMY_LATENCY'] = options.latency
+    msettings['DUMMY_BANDWIDTH'] = options.bandwidth
+    msettings['DUMMY_FAILURE_RATE'] = options.failure_rate
+    msettings['DUMMY_GZIP'] = bool(options.gzip)
+    msettings['DUMMY_SEED'] = options.seed
+    if not options.minify:
+        msettings['PROCESSORS'] = ()
+
+    try:
+        for number in range(1, options.runs + 1):
+            result = run(jobs=options.jobs, processes=options.processes,
+                         concurrency=options.concurrency, batch_size=options.batch_size)
+            report(number, result)
+    finally:
+        if not options.keep:
+            tree.remove()
+
+if __name__ == '__main__':
+    main()
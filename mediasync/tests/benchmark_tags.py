@@ -0,0 +1,217 @@
+"""
+Benchmarks the css, js and media_url template tags, and checks that they
+render consistently when the same templates are rendered from many threads.
+
+Run it from the directory that contains the mediasync package::
+
+    python -m mediasync.tests.benchmark_tags --tags 50 --renders 200
+    python -m mediasync.tests.benchmark_tags --stress --threads 16
+
+The benchmark renders each kind of tag under every combination of the
+SERVE_REMOTE, EMULATE_COMBO and CACHE_BUSTER settings and of SSL and gzip
+requests, and reports the cost of a single tag in microseconds. The first
+render of each combination is not timed, so tags with a quoted path show
+the cost of their memoized markup.
+"""
+from optparse import OptionParser
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'mediasync.tests.settings'
+
+from django.template import Context, Template
+from django.test.client import RequestFactory
+from mediasync.conf import msettings
+
+def cache_buster(url):
+    return "v=%d" % len(url)
+
+SETTINGS = [
+    {'SERVE_REMOTE': serve_remote, 'EMULATE_COMBO': emulate_combo, 'CACHE_BUSTER': cb}
+    for serve_remote, emulate_combo, cb
+    in itertools.product((True, False), (False, True), (None, 'v1', cache_buster))
+]
+
+# (ssl, gzip) of the requests the templates are rendered for
+REQUESTS = list(itertools.product((False, True), (False, True)))
+
+JOINED = {
+    'css/joined.css': ('css/a.css', 'css/b.css', 'css/c.css'),
+    'js/joined.js': ('js/a.js', 'js/b.js', 'js/c.js'),
+}
+
+TAGS = [
+    ('css', '{%% css "css/%(i)d.css" %%}'),
+    ('css var', '{%% css css%(i)d %%}'),
+    ('css joined', '{%% css "css/joined.css" %%}'),
+    ('js', '{%% js "js/%(i)d.js" %%}'),
+    ('js var', '{%% js js%(i)d %%}'),
+    ('js joined', '{%% js "js/joined.js" %%}'),
+    ('media_url', '{%% media_url "img/%(i)d.png" %%}'),
+    ('media_url var', '{%% media_url img%(i)d %%}'),
+]
+
+def template(tags, count):
+    """
+    Returns a Template with count of each of tags, a list of (name, markup)
+    pairs from TAGS.
+    """
+    source = ['{% load media %}']
+    for i in range(count):
+        for name, markup in tags:
+            source.append(markup % {'i': i})
+    return Template(''.join(source))
+
+def context(count, ssl=False, gzip=False):
+    """
+    Returns a Context with the variables used by TAGS and a request.
+    """
+    extra = {}
+    if ssl:
+        extra['wsgi.url_scheme'] = 'https'
+    if gzip:
+        extra['HTTP_ACCEPT_ENCODING'] = 'gzip, deflate'
+    values = {'request': RequestFactory().get('/', **extra)}
+    for i in range(count):
+        values['css%d' % i] = 'css/%d.css' % i
+        values['js%d' % i] = 'js/%d.js' % i
+        values['img%d' % i] = 'img/%d.png' % i
+    return Context(values)
+
+def configure(settings):
+    """
+    Applies a dict of settings and returns the previous values.
+    """
+    previous = {}
+    for name, value in settings.iteritems():
+        previous[name] = msettings[name]
+        msettings[name] = value
+    return previous
+
+def describe(settings, ssl=None, gzip=None):
+    parts = []
+    parts.append(settings['SERVE_REMOTE'] and 'remote' or 'local')
+    if settings['EMULATE_COMBO']:
+        parts.append('combo')
+    cb = settings['CACHE_BUSTER']
+    if cb:
+        parts.append(callable(cb) and 'cb()' or 'cb')
+    if ssl:
+        parts.append('ssl')
+    if gzip:
+        parts.append('gzip')
+    return ' '.join(parts)
+
+def benchmark(count=20, renders=100):
+    """
+    Returns a list of (description, {tag name: microseconds per tag}).
+    """
+    templates = [(name, template([(name, markup)], count)) for name, markup in TAGS]
+    contexts = dict((request, context(count, *request)) for request in REQUESTS)
+    results = []
+
+    previous = configure(dict(SETTINGS[0], JOINED=JOINED, DUMMY_GZIP=True))
+    try:
+        for settings in SETTINGS:
+            configure(settings)
+            for request in REQUESTS:
+                c = contexts[request]
+                costs = {}
+                for name, t in templates:
+                    t.render(c)
+                    started = time.time()
+                    for i in range(renders):
+                        t.render(c)
+                    costs[name] = (time.time() - started) * 1000000 / (renders * count)
+                results.append((describe(settings, *request), costs))
+    finally:
+        configure(previous)
+
+    return results
+
+def stress(count=5, threads=8, renders=200, seed=0):
+    """
+    Renders a template with every kind of tag from several threads for each
+    combination of settings, while another thread keeps flipping the shared
+    client's serve_remote the way sync() does. Returns a list of
+    (description, expected, rendered) for every render that didn't match
+    the markup rendered by a single thread.
+    """
+    from mediasync.templatetags import media
+
+    t = template(TAGS, count)
+    contexts = dict((request, context(count, *request)) for request in REQUESTS)
+    mismatches = []
+    lock = threading.Lock()
+
+    previous = configure(dict(SETTINGS[0], JOINED=JOINED, DUMMY_GZIP=True))
+    serve_remote = media.client.serve_remote
+    try:
+        for settings in SETTINGS:
+
+            configure(settings)
+            # expected markup, rendered by a fresh template in this thread
+            expected = dict((request, template(TAGS, count).render(contexts[request]))
+                            for request in REQUESTS)
+
+            stop = threading.Event()
+
+            def flip():
+                while not stop.is_set():
+                    media.client.serve_remote = not media.client.serve_remote
+                    time.sleep(0.0001)
+
+            def render(number):
+                rnd = random.Random(seed + number)
+                for i in range(renders):
+                    request = rnd.choice(REQUESTS)
+                    rendered = t.render(contexts[request])
+                    if rendered != expected[request]:
+                        with lock:
+                            mismatches.append((describe(settings, *request),
+                                               expected[request], rendered))
+
+            flipper = threading.Thread(target=flip)
+            flipper.start()
+            workers = [threading.Thread(target=render, args=(n,)) for n in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            stop.set()
+            flipper.join()
+
+    finally:
+        media.client.serve_remote = serve_remote
+        configure(previous)
+
+    return mismatches
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m mediasync.tests.benchmark_tags [options]")
+    parser.add_option("--tags", type="int", default=20, help="number of each kind of tag in a template")
+    parser.add_option("--renders", type="int", default=100, help="number of renders of each template")
+    parser.add_option("--stress", action="store_true", help="check renders from many threads instead")
+    parser.add_option("--threads", type="int", default=8, help="number of threads rendering with --stress")
+    options, args = parser.parse_args(argv)
+
+    if options.stress:
+        mismatches = stress(options.tags, options.threads, options.renders)
+        for description, expected, rendered in mismatches[:10]:
+            print "[%s] expected %r" % (description, expected)
+            print "[%s] rendered %r" % (description, rendered)
+        print "%d mismatched renders" % len(mismatches)
+        sys.exit(mismatches and 1 or 0)
+
+    names = [name for name, markup in TAGS]
+    print "%-24s %s" % ('us per tag', ' '.join("%13s" % name for name in names))
+    for description, costs in benchmark(options.tags, options.renders):
+        print "%-24s %s" % (description, ' '.join("%13.1f" % costs[name] for name in names))
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,38 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.dispatch import receiver
 from django.template import Context, Template
+from django.test.client import RequestFactory
 from hashlib import md5
+import BaseHTTPServer
 import glob
+import gzip
 import httplib
 import itertools
 import os
 import re
+import shutil
+import socket
+import SocketServer
+import StringIO
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import urlparse
 
-from mediasync import backends, JS_MIMETYPES, listdir_recursive
+from mediasync import backends, manifest, views, JS_MIMETYPES, listdir_recursive
 from mediasync.backends import BaseClient
 from mediasync.conf import msettings
 from mediasync.signals import pre_sync, post_sync, sass_receiver
 import mediasync
 import mimetypes
 
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
 PWD = os.path.abspath(os.path.dirname(__file__))
 
 EXPIRES_RE = re.compile(r'^\w{3}, \d{2} \w{3} \d{4} \d{2}:\d{2}:\d{2} GMT$')
@@ -57,6 +73,46 @@ class BackendTestCase(unittest.TestCase):
     def testInvalidBackend(self):
         self.assertRaises(ImproperlyConfigured, backends.client)
 
+class DummyClientTestCase(unittest.TestCase):
+    
+    def tearDown(self):
+        for name in ('DUMMY_GZIP', 'DUMMY_FAILURE_RATE', 'DUMMY_RETRIES', 'DUMMY_SEED'):
+            try:
+                del msettings[name]
+            except KeyError:
+                pass
+    
+    def testSimulatedRequests(self):
+        
+        from mediasync.backends import dummy
+        
+        msettings['DUMMY_GZIP'] = True
+        client = dummy.Client()
+        
+        # compressible files are sent with a gzipped variant
+        content = 'body { color: red; }\n' * 100
+        client.put(content, 'text/css', 'css/x.css')
+        client.put('\x89PNG', 'image/png', 'img/x.png')
+        self.assertEqual(client.requests, 3)
+        self.assertEqual(client.bytes_sent, len(content) + len(mediasync.compress(content)) + 4)
+        
+        # failed requests are retried, then the put fails
+        msettings['DUMMY_FAILURE_RATE'] = 1.0
+        msettings['DUMMY_RETRIES'] = 2
+        client = dummy.Client()
+        self.assertRaises(mediasync.SyncException, client.put, content, 'text/css', 'css/x.css')
+        self.assertEqual((client.requests, client.failures, client.bytes_sent), (3, 3, 0))
+        
+        msettings['DUMMY_FAILURE_RATE'] = 0.5
+        msettings['DUMMY_SEED'] = 1
+        client = dummy.Client()
+        for i in range(20):
+            try:
+                client.put('x', 'image/png', 'img/x.png')
+            except mediasync.SyncException:
+                pass
+        self.assertTrue(0 < client.failures < client.requests)
+
 class MockClientTestCase(unittest.TestCase):
     
     def setUp(self):
@@ -114,6 +170,114 @@ class MockClientTestCase(unittest.TestCase):
         listed_files = list(mediasync.listdir_recursive(media_dir))
         self.assertListEqual(allowed_files, listed_files)
     
+    def testIndexer(self):
+        
+        from mediasync import tree
+        
+        root = tempfile.mkdtemp()
+        try:
+            
+            # hidden directories next to each other are all skipped
+            for path in ('css/b.css', 'css/a.min.css', 'css/.c.css', '.git/x', '.svn/x',
+                         '_build/x.js', 'img/originals/big.psd', 'img/logo.png', 'js/app.js',
+                         'top.txt'):
+                filepath = os.path.join(root, *path.split('/'))
+                if not os.path.isdir(os.path.dirname(filepath)):
+                    os.makedirs(os.path.dirname(filepath))
+                fp = open(filepath, 'w')
+                fp.write(path)
+                fp.close()
+            
+            listed = list(tree.scan(root))
+            self.assertEqual([f.path for f in listed], [
+                'top.txt', 'css/a.min.css', 'css/b.css', 'img/logo.png',
+                'img/originals/big.psd', 'js/app.js'])
+            self.assertEqual(list(listdir_recursive(root)), [f.path for f in listed])
+            self.assertEqual(listed[1].content_type, 'text/css')
+            self.assertEqual(listed[1].size, len('css/a.min.css'))
+            self.assertEqual(listed[1].filepath, os.path.join(root, 'css', 'a.min.css'))
+            self.assertEqual(listed[1].mtime, os.path.getmtime(listed[1].filepath))
+            
+            rules = tree.Rules(exclude=['img/originals', '*.min.css'])
+            self.assertEqual([f.path for f in tree.scan(root, rules)],
+                             ['top.txt', 'css/b.css', 'img/logo.png', 'js/app.js'])
+            self.assertFalse(rules.allows('img/originals/big.psd'))
+            self.assertFalse(rules.allows('css/.c.css'))
+            self.assertTrue(rules.allows('img/logo.png'))
+            
+            rules = tree.Rules(include=[r're:.*\.(css|js)$'], exclude=['js/*'])
+            self.assertEqual([f.path for f in tree.scan(root, rules)], ['css/a.min.css', 'css/b.css'])
+            
+            # the settings are used by sync() and the local views
+            msettings['SYNC_EXCLUDE'] = ('css/2.css', 'img')
+            try:
+                items = [item.remote_path for item in mediasync.static_items(self.client)]
+                self.assertEqual(items, ['css/1.css', 'css/3.scss', 'js/1.js', 'js/2.js'])
+                self.assertEqual(mediasync.static_item(self.client, 'img/black.png'), None)
+                
+                msettings['SERVE_REMOTE'] = False
+                request = RequestFactory().get('/media/css/2.css')
+                self.assertRaises(views.Http404, views.static_serve, request, 'css/2.css', self.client)
+                response = views.static_serve(request, 'css/1.css', self.client)
+                self.assertEqual(response.status_code, 200)
+                
+                # the rules apply to files in the media root too
+                msettings['SYNC_EXCLUDE'] = ('*.psd',)
+                created = [os.path.join(self.client.media_root, *path.split('/'))
+                           for path in ('secret.psd', 'img/secret.psd', 'root.txt')]
+                try:
+                    for filepath in created:
+                        f = open(filepath, 'w')
+                        f.write('secret')
+                        f.close()
+                    request = RequestFactory().get('/media/secret.psd')
+                    self.assertRaises(views.Http404, views.static_serve, request, 'secret.psd', self.client)
+                    self.assertRaises(views.Http404, views.static_serve, request, 'img/secret.psd', self.client)
+                    response = views.static_serve(request, 'root.txt', self.client)
+                    self.assertEqual(response.status_code, 200)
+                finally:
+                    for filepath in created:
+                        os.remove(filepath)
+            finally:
+                msettings['SYNC_EXCLUDE'] = ()
+                msettings['SERVE_REMOTE'] = True
+            
+        finally:
+            shutil.rmtree(root)
+    
+    def testIndexerSymlinks(self):
+        
+        from mediasync import tree
+        
+        root = tempfile.mkdtemp()
+        try:
+            for path in ('real/css/x.css', 'other/y.js'):
+                filepath = os.path.join(root, *path.split('/'))
+                os.makedirs(os.path.dirname(filepath))
+                fp = open(filepath, 'w')
+                fp.write(path)
+                fp.close()
+            
+            # symlinked directories are followed at any depth, but not the
+            # ones that lead back to a directory that is being listed
+            os.symlink(os.path.join(root, 'real', 'css'), os.path.join(root, 'admin'))
+            os.symlink(os.path.join('..', '..', 'other'), os.path.join(root, 'real', 'css', 'nested'))
+            os.symlink('..', os.path.join(root, 'real', 'css', 'loop'))
+            os.symlink(root, os.path.join(root, 'real', 'up'))
+            
+            self.assertEqual([f.path for f in tree.scan(root)], [
+                'admin/x.css', 'admin/nested/y.js', 'other/y.js', 'real/css/x.css',
+                'real/css/nested/y.js'])
+            self.assertEqual(list(listdir_recursive(os.path.join(root, 'admin'))), ['x.css', 'nested/y.js'])
+            
+            # rules match the path under the name of the link
+            rules = tree.Rules(exclude=['real'])
+            self.assertEqual([f.path for f in tree.scan(root, rules)],
+                             ['admin/x.css', 'admin/nested/y.js', 'other/y.js'])
+            
+        finally:
+            shutil.rmtree(root)
+    
     def testSync(self):
         
         to_sync = {
@@ -150,7 +314,755 @@ class MockClientTestCase(unittest.TestCase):
         # forced sync
         self.client.put_callback = generate_callback(is_forced=True)
         mediasync.sync(self.client, force=True, verbose=False)
+    
+    def testParallelSync(self):
+        
+        serial = []
+        def serial_put(filedata, content_type, remote_path, force):
+            serial.append((remote_path, filedata))
+            return True
+        
+        self.client.put_callback = serial_put
+        mediasync.sync(self.client, verbose=False)
+        
+        parallel = []
+        def parallel_put(filedata, content_type, remote_path, force):
+            parallel.append((remote_path, filedata))
+            return True
+        
+        self.client.put_callback = parallel_put
+        
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            mediasync.sync(self.client, verbose=True, jobs=4)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        
+        # every file is put exactly once with the same content
+        self.assertEqual(sorted(serial), sorted(parallel))
+        
+        # verbose output follows the serial order
+        printed = [line.split(' ', 1)[1] for line in output.splitlines()]
+        self.assertEqual(printed, [path for path, filedata in serial])
+        
+    def testBatchedSync(self):
+        
+        msettings['BACKEND'] = 'mediasync.backends.dummy'
+        client = backends.client()
+        
+        put = []
+        client.put_callback = lambda filedata, content_type, remote_path: put.append(remote_path)
+        mediasync.sync(client, verbose=False, batch_size=3)
+        
+        # every file is put once, in batches of up to three
+        self.assertEqual(sum(client.batch_sizes), len(put))
+        self.assertEqual(len(set(put)), len(put))
+        self.assertEqual(client.batch_sizes[:-1], [3] * (len(client.batch_sizes) - 1))
+        self.assertTrue(0 < client.batch_sizes[-1] <= 3)
+        
+        # worker threads put files one at a time
+        count = len(put)
+        client.batch_sizes = []
+        mediasync.sync(client, verbose=False, jobs=2)
+        self.assertEqual(client.batch_sizes, [1] * count)
+        
+    def testTimingSignals(self):
+        
+        from mediasync.signals import sync_timing
+        from mediasync.stats import SyncStats
+        
+        def upper(filedata, content_type, remote_path, is_active):
+            return filedata.upper()
+        
+        msettings['BACKEND'] = 'mediasync.backends.dummy'
+        msettings['PROCESSORS'] = (upper,)
+        client = backends.client()
+        
+        timings = []
+        def timing_receiver(sender, **kwargs):
+            timings.append(kwargs)
+        
+        stats = SyncStats()
+        sync_timing.connect(timing_receiver)
+        stats.connect()
+        try:
+            mediasync.sync(client, verbose=False)
+        finally:
+            sync_timing.disconnect(timing_receiver)
+            stats.disconnect()
+        
+        # each file is read, processed, put and uploaded
+        phases = {}
+        for timing in timings:
+            self.assertTrue(timing['duration'] >= 0)
+            phases.setdefault(timing['phase'], set()).add(timing['remote_path'])
+        self.assertEqual(phases['read'], phases['put'])
+        self.assertEqual(phases['read'], phases['upload'])
+        self.assertTrue('css/joined.css' in phases['process'])
+        
+        read = [timing for timing in timings
+                if timing['phase'] == 'read' and timing['remote_path'] == 'css/joined.css'][0]
+        process = [timing for timing in timings
+                   if timing['phase'] == 'process' and timing['remote_path'] == 'css/joined.css'][0]
+        self.assertEqual(process['size'], read['size'])
+        self.assertEqual(process['size_out'], read['size'])
+        self.assertTrue(process['processor'].endswith('upper'))
+        
+        # the stats add up the same signals
+        self.assertEqual(stats.phases['put'][0], len(phases['put']))
+        self.assertEqual(sum(size_out for size, size_out in stats.types.values()), client.bytes_sent)
+        self.assertEqual(len(stats.slowest(3)), 3)
+        lines = stats.summary()
+        self.assertTrue(lines[0].startswith('phase'))
+        self.assertTrue(any(line.startswith('slowest files') for line in lines))
+        
+    def testBenchmarkPhases(self):
+        
+        from mediasync.tests import benchmark
+        
+        def upper(filedata, content_type, remote_path, is_active):
+            return filedata.upper()
+        
+        msettings['PROCESSORS'] = (upper,)
+        result = benchmark.run()
+        
+        # the phases are the ones sent with sync_timing
+        for phase in ('scan', 'read', 'process', 'put', 'upload'):
+            self.assertTrue(phase in result['phases'], phase)
+        self.assertTrue(result['phases']['process'] > 0)
+        self.assertEqual(len(result['processors']), 1)
+        self.assertTrue(result['requests'] > 0)
+        
+    def testProfiledSync(self):
+        
+        from mediasync.profiling import SyncProfiler, STAGES
+        
+        msettings['BACKEND'] = 'mediasync.backends.dummy'
+        client = backends.client()
+        
+        put = []
+        client.put_callback = lambda filedata, content_type, remote_path: put.append(remote_path)
+        
+        profiler = SyncProfiler(memory=True)
+        profiler.run(client, mediasync.sync, client, verbose=False)
+        self.assertTrue(put)
+        
+        # every stage ran and the original functions are back in place
+        self.assertEqual(set(profiler.times), set(STAGES + ('sync',)))
+        self.assertFalse('put_many' in client.__dict__)
+        self.assertEqual(mediasync.combine_files.__name__, 'combine_files')
+        self.assertTrue(profiler.sampler.peaks)
+        self.assertTrue(min(profiler.sampler.peaks.values()) > 0)
+        
+        stats = profiler.stats('combine')
+        self.assertTrue(any(func[2] == 'combine_files' for func in stats.stats))
+        stats = profiler.stats('backend')
+        self.assertFalse(any(func[2] == 'combine_files' for func in stats.stats))
+        
+        directory = tempfile.mkdtemp()
+        try:
+            paths = profiler.dump(directory)
+            self.assertEqual(sorted(os.path.basename(path) for path in paths),
+                             sorted(['%s.pstats' % stage for stage in STAGES] + ['sync.pstats', 'all.pstats']))
+        finally:
+            shutil.rmtree(directory)
+        
+        lines = profiler.summary(5)
+        self.assertTrue(lines[0].startswith('walk'))
+        self.assertTrue('combine stage:' in lines)
+        
+    def testWatch(self):
+        
+        from mediasync.watch import PollingWatcher, watch
+        
+        media = os.path.join(PWD, 'media')
+        
+        class ScriptedWatcher(object):
+            name = 'script'
+            def __init__(self, changes):
+                self.pending = list(changes)
+            def start(self):
+                pass
+            def stop(self):
+                self.stopped = True
+            def changes(self, timeout=None):
+                if timeout is None:
+                    return self.pending.pop(0)
+                return set()
+        
+        synced = []
+        def myput(filedata, content_type, remote_path, force):
+            synced.append(remote_path)
+            return True
+        self.client.put_callback = myput
+        
+        # the first sync puts everything, then only what changed and the
+        # joined files built from it, hidden files are ignored
+        watcher = ScriptedWatcher([
+            set([os.path.join(media, 'css', '1.css')]),
+            set([os.path.join(media, '.mediasync', 'state.json')]),
+            set([os.path.join(media, 'img', 'black.png'), os.path.join(media, 'img', 'gone.png')]),
+        ])
+        watch(self.client, verbose=False, watcher=watcher, rounds=2)
+        self.assertTrue(watcher.stopped)
+        self.assertEqual(watcher.pending, [])
+        
+        count = len(list(mediasync._all_items(self.client)))
+        joined = [item.remote_path for item in mediasync.joined_items(self.client)
+                  if os.path.join(media, 'css', '1.css') in item.sources]
+        self.assertEqual(joined, ['css/joined.css'])
+        self.assertEqual(len(synced), count + len(joined) + 2)
+        self.assertEqual(synced[count:], joined + ['css/1.css', 'img/black.png'])
+        
+        # polling finds added, changed and removed files
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'css'))
+            path = os.path.join(root, 'css', 'a.css')
+            open(path, 'w').close()
+            
+            watcher = PollingWatcher(root, interval=0.01)
+            watcher.start()
+            self.assertEqual(watcher.changes(0), set())
+            
+            f = open(path, 'w')
+            f.write('body {}')
+            f.close()
+            open(os.path.join(root, 'css', 'b.css'), 'w').close()
+            self.assertEqual(watcher.changes(0), set([path, os.path.join(root, 'css', 'b.css')]))
+            
+            os.remove(path)
+            os.mkdir(os.path.join(root, '.mediasync'))
+            open(os.path.join(root, '.mediasync', 'state.json'), 'w').close()
+            self.assertEqual(watcher.changes(0.05), set([path]))
+            
+            # files that sync() leaves out aren't watched either
+            msettings['SYNC_EXCLUDE'] = ('*.psd', 'drafts')
+            for dirname in ('_build', 'drafts', 'img'):
+                os.mkdir(os.path.join(root, dirname))
+            for name in ('_build/x.css', 'drafts/y.css', 'img/z.psd', 'img/logo.png'):
+                open(os.path.join(root, *name.split('/')), 'w').close()
+            self.assertEqual(watcher.changes(0.05), set([os.path.join(root, 'img', 'logo.png')]))
+            
+            # new directories are listed with the rules of the media root
+            from mediasync import tree
+            rules = tree.sync_rules()
+            self.assertEqual([mf.path for mf in tree.scan(os.path.join(root, 'img'), rules, 'img/')],
+                             ['img/logo.png'])
+            self.assertTrue(rules.allows_dirs('img'))
+            self.assertFalse(rules.allows_dirs('drafts'))
+            self.assertFalse(rules.allows_dirs('img/_build'))
+        finally:
+            msettings['SYNC_EXCLUDE'] = ()
+            shutil.rmtree(root)
+        
+    def testMultiprocessSync(self):
+        
+        def upper(filedata, content_type, remote_path, is_active):
+            return filedata.upper()
+        
+        msettings['PROCESSORS'] = (upper,)
+        self.client = backends.client()
+        
+        serial = []
+        def serial_put(filedata, content_type, remote_path, force):
+            serial.append((remote_path, str(filedata)))
+            return True
+        
+        self.client.put_callback = serial_put
+        mediasync.sync(self.client, verbose=False)
+        
+        self.client.get_variants = lambda content_type: \
+            ['gzip'] if content_type in mediasync.TYPES_TO_COMPRESS else []
+        
+        pooled = []
+        def pooled_put(filedata, content_type, remote_path, force):
+            # data of compressed types is gzipped by the worker processes
+            if content_type in mediasync.TYPES_TO_COMPRESS:
+                self.assertTrue('gzip' in filedata.variants)
+            self.assertEqual(filedata.checksum, mediasync.checksum(str(filedata)))
+            pooled.append((remote_path, str(filedata)))
+            return True
+        
+        self.client.put_callback = pooled_put
+        
+        # variants are recorded in the manifest, keep it out of the media
+        tmpdir = tempfile.mkdtemp()
+        msettings['MANIFEST_FILE'] = os.path.join(tmpdir, 'manifest.json')
+        
+        # batches are processed in the workers, so they are logged to a file
+        batch_log = os.path.join(tmpdir, 'batches')
+        def upper_batch(files, is_active):
+            f = open(batch_log, 'a')
+            f.write("%d\n" % len(files))
+            f.close()
+            return [filedata.upper() for filedata, content_type, remote_path in files]
+        upper.batch = upper_batch
+        
+        try:
+            mediasync.sync(self.client, verbose=False, jobs=2, processes=2)
+            batches = sorted(int(line) for line in readfile(batch_log).split())
+        finally:
+            shutil.rmtree(tmpdir)
+            msettings['MANIFEST_FILE'] = None
+        
+        # files are processed in the workers and put once each
+        self.assertEqual(sorted(serial), sorted(pooled))
+        
+        # each worker processes its share of the files in one batch
+        self.assertEqual(batches, [4, 4])
+        
+    def testStreamingSync(self):
+        
+        def upper(filedata, content_type, remote_path, is_active):
+            return filedata.upper()
+        
+        msettings['PROCESSORS'] = (upper,)
+        msettings['STREAMING_THRESHOLD'] = 0
+        
+        synced = {}
+        def myput(filedata, content_type, remote_path, force):
+            synced[remote_path] = filedata
+        
+        try:
+            client = backends.client()
+            client.put_callback = myput
+            mediasync.sync(client, verbose=False)
+        finally:
+            msettings['PROCESSORS'] = []
+            msettings['STREAMING_THRESHOLD'] = 4 * 1024 * 1024
+        
+        # CSS is still processed, the image is streamed as-is
+        css = readfile(os.path.join(PWD, 'media', 'css', '1.css'))
+        self.assertEqual(synced['css/1.css'], css.upper())
+        png = readfile(os.path.join(PWD, 'media', 'img', 'black.png'))
+        self.assertEqual(synced['img/black.png'], png)
+    
+    def testStreamingChecksumAndCompress(self):
+        
+        path = os.path.join(PWD, 'media', 'js', '1.js')
+        content = readfile(path)
+        self.assertEqual(mediasync.checksum_file(path, chunk_size=7), mediasync.checksum(content))
+        
+        zbuf = StringIO.StringIO()
+        (hexdigest, b64digest) = mediasync.compress_file(path, zbuf, chunk_size=7)
+        self.assertEqual((hexdigest, b64digest), mediasync.checksum(zbuf.getvalue()))
+        
+        zbuf.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=zbuf).read(), content)
+        
+        # the gzip header has no timestamp or file name, so the output only
+        # depends on the content
+        compressed = mediasync.compress(content)
+        self.assertEqual(compressed[3:8], '\x00' * 5)
+        self.assertEqual(zbuf.getvalue(), compressed)
+        
+        # variants are compressed at the level for their content type
+        zbuf = StringIO.StringIO()
+        digest = mediasync.compress_file_variant(path, zbuf, 'application/javascript', 'gzip')
+        self.assertEqual(digest, mediasync.checksum(zbuf.getvalue()))
+        level = mediasync.compression_level('application/javascript', 'gzip')
+        self.assertEqual(zbuf.getvalue(), mediasync.compress(content, level))
+    
+    def testCompressionPolicy(self):
         
+        text = 'body { color: red; }\n' * 100
+        noise = os.urandom(2000)
+        
+        # by default every file gets its variants
+        self.assertEqual(mediasync.compress_variants(noise, 'text/plain', ['gzip']).keys(), ['gzip'])
+        
+        # compression that doesn't pay off is dropped
+        msettings['COMPRESS_MIN_RATIO'] = 1.0
+        self.assertEqual(mediasync.compress_variants(noise, 'text/plain', ['gzip']), {})
+        variants = mediasync.compress_variants(text, 'text/css', ['gzip'])
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(variants['gzip'])).read(), text)
+        
+        msettings['COMPRESS_MIN_SIZE'] = len(text) + 1
+        self.assertEqual(mediasync.compress_variants(text, 'text/css', ['gzip']), {})
+        msettings['COMPRESS_MIN_SIZE'] = 0
+        
+        msettings['COMPRESS_MIN_RATIO'] = 1000
+        self.assertEqual(mediasync.compress_variants(text, 'text/css', ['gzip']), {})
+        msettings['COMPRESS_MIN_RATIO'] = None
+        
+        # per type levels, with 'max' for the best the encoding can do
+        msettings['COMPRESS_LEVELS'] = {'text/css': 'max', 'text/plain': 1}
+        self.assertEqual(mediasync.compression_level('text/css'), 9)
+        self.assertEqual(mediasync.compression_level('text/plain'), 1)
+        self.assertEqual(mediasync.compression_level('text/html'), 6)
+        msettings['COMPRESS_LEVELS'] = {}
+        
+        # the manifest records which variants were synced
+        tmpdir = tempfile.mkdtemp()
+        msettings['MANIFEST_FILE'] = os.path.join(tmpdir, 'manifest.json')
+        msettings['COMPRESS_MIN_SIZE'] = 100
+        self.client.get_variants = lambda content_type: \
+            ['gzip'] if content_type in mediasync.TYPES_TO_COMPRESS else []
+        
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            mediasync.sync(self.client, verbose=True)
+            output = sys.stdout.getvalue()
+            files = manifest.read(msettings['MANIFEST_FILE'])
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(tmpdir)
+            msettings['MANIFEST_FILE'] = None
+            msettings['COMPRESS_MIN_SIZE'] = 0
+            manifest.reload()
+        
+        for item in mediasync.static_items(self.client):
+            entry = files[item.remote_path]
+            self.assertEqual(entry['name'], item.remote_path)
+            if item.content_type in mediasync.TYPES_TO_COMPRESS and item.size >= 100:
+                self.assertEqual(entry['variants'], ['gzip'])
+            else:
+                self.assertEqual(entry['variants'], [])
+        
+        # the bytes saved are reported per content type
+        self.assertTrue('[compression] text/css: ' in output)
+    
+    @unittest.skipIf(mediasync.brotli is None, "brotli is not installed")
+    def testBrotliCompress(self):
+        
+        path = os.path.join(PWD, 'media', 'js', '1.js')
+        content = readfile(path)
+        
+        compressed = mediasync.compress_brotli(content)
+        self.assertEqual(mediasync.brotli.decompress(compressed), content)
+        
+        zbuf = StringIO.StringIO()
+        (hexdigest, b64digest) = mediasync.compress_file_brotli(path, zbuf, chunk_size=7)
+        self.assertEqual((hexdigest, b64digest), mediasync.checksum(zbuf.getvalue()))
+        self.assertEqual(mediasync.brotli.decompress(zbuf.getvalue()), content)
+    
+    def testFingerprint(self):
+        
+        tmpdir = tempfile.mkdtemp()
+        msettings['FINGERPRINT'] = True
+        msettings['MANIFEST_FILE'] = os.path.join(tmpdir, 'manifest.json')
+        
+        synced = {}
+        def myput(filedata, content_type, remote_path, force):
+            synced[remote_path] = filedata
+        self.client.put_callback = myput
+        
+        try:
+            mediasync.sync(self.client, verbose=False)
+            files = manifest.read(msettings['MANIFEST_FILE'])
+        finally:
+            shutil.rmtree(tmpdir)
+            msettings['FINGERPRINT'] = False
+            msettings['MANIFEST_FILE'] = None
+            manifest.reload()
+        
+        self.assertEqual(len(files), 8)
+        
+        for remote_path, entry in files.iteritems():
+            filedata = synced[entry['name']]
+            (hexdigest, b64digest) = mediasync.checksum(filedata)
+            self.assertEqual(entry['name'], manifest.fingerprint(remote_path, hexdigest))
+            # the original name is put as well for references that don't
+            # go through the manifest, such as url() in CSS
+            self.assertEqual(synced[remote_path], filedata)
+        
+        self.assertEqual(len(synced), 16)
+        
+        self.assertEqual(manifest.fingerprint('css/joined.css', 'abcdef0123456789'),
+                         'css/joined.abcdef012345.css')
+    
+    def testSyncState(self):
+        
+        msettings['SYNC_STATE'] = True
+        msettings['CACHE_DIR'] = tempfile.mkdtemp()
+        
+        synced = []
+        def myput(filedata, content_type, remote_path, force):
+            synced.append(remote_path)
+            return True
+        self.client.put_callback = myput
+        
+        try:
+            
+            # first sync puts everything and records the state
+            mediasync.sync(self.client, verbose=False)
+            self.assertEqual(len(synced), 8)
+            self.assertTrue(os.path.exists(os.path.join(msettings['CACHE_DIR'], 'state.json')))
+            
+            # nothing has changed
+            del synced[:]
+            mediasync.sync(self.client, verbose=False)
+            self.assertEqual(synced, [])
+            
+            # a touched file with the same content is not put again
+            os.utime(os.path.join(PWD, 'media', 'css', '1.css'), None)
+            mediasync.sync(self.client, verbose=False)
+            self.assertEqual(synced, [])
+            
+            # force and rebuild_state bypass the state
+            mediasync.sync(self.client, force=True, verbose=False)
+            self.assertEqual(len(synced), 8)
+            
+            del synced[:]
+            mediasync.sync(self.client, verbose=False, rebuild_state=True)
+            self.assertEqual(len(synced), 8)
+            
+        finally:
+            shutil.rmtree(msettings['CACHE_DIR'])
+            msettings['CACHE_DIR'] = None
+            msettings['SYNC_STATE'] = False
+        
+    def testDryRun(self):
+        
+        def unchanged(filedata, content_type, remote_path, is_active):
+            return filedata
+        
+        msettings['SYNC_STATE'] = True
+        msettings['CACHE_DIR'] = tempfile.mkdtemp()
+        msettings['MANIFEST_FILE'] = os.path.join(msettings['CACHE_DIR'], 'manifest.json')
+        msettings['PROCESSORS'] = (unchanged,)
+        msettings['PROCESSOR_CACHE'] = True
+        state_path = os.path.join(msettings['CACHE_DIR'], 'state.json')
+        self.client = backends.client()
+        
+        def cache_files():
+            listed = {}
+            for dirpath, dirnames, filenames in os.walk(self.client.processor_cache.path):
+                for name in filenames:
+                    st = os.stat(os.path.join(dirpath, name))
+                    listed[os.path.join(dirpath, name)] = (st.st_mtime, st.st_size)
+            return listed
+        
+        self.client.get_variants = lambda content_type: \
+            ['gzip'] if content_type in mediasync.TYPES_TO_COMPRESS else []
+        
+        synced = []
+        def myput(filedata, content_type, remote_path, force):
+            synced.append(remote_path)
+            return True
+        self.client.put_callback = myput
+        
+        try:
+            
+            # nothing is put and neither the state, the manifest nor the
+            # processor cache is written
+            plan = mediasync.plan(self.client)
+            self.assertEqual(synced, [])
+            self.assertFalse(os.path.exists(state_path))
+            self.assertFalse(os.path.exists(msettings['MANIFEST_FILE']))
+            self.assertEqual(cache_files(), {})
+            
+            # the plan matches what a sync does
+            mediasync.sync(self.client, verbose=False)
+            totals = plan.totals()
+            self.assertEqual(sorted(entry['path'] for entry in plan.files), sorted(synced))
+            self.assertEqual(totals['upload'], len(synced))
+            self.assertEqual(totals['requests'], sum(len(entry['objects']) for entry in plan.files))
+            self.assertEqual(totals['transfer'], totals['size'] + totals['compressed_size'])
+            
+            # sizes follow the compression policy
+            entry = [entry for entry in plan.files if entry['path'] == 'css/joined.css'][0]
+            filedata = mediasync.combine_files('joined.css', msettings['JOINED']['css/joined.css'], self.client)[0]
+            variants = mediasync.compress_variants(filedata, 'text/css', ['gzip'])
+            self.assertEqual(entry['size'], len(filedata))
+            self.assertEqual(entry['compressed'],
+                             dict((encoding, len(data)) for encoding, data in variants.iteritems()))
+            
+            # after the sync nothing would be uploaded, and cached entries
+            # are used without being touched
+            cached = cache_files()
+            self.assertTrue(cached)
+            plan = mediasync.plan(self.client)
+            hits = self.client.processor_cache.hits
+            mediasync.plan(self.client, force=True)
+            self.assertTrue(self.client.processor_cache.hits > hits)
+            self.assertEqual(cache_files(), cached)
+            totals = plan.totals()
+            self.assertEqual((totals['upload'], totals['skip']), (0, len(synced)))
+            self.assertEqual((totals['requests'], totals['transfer']), (0, 0))
+            
+            # files in the state that no longer exist would be removed
+            f = open(state_path)
+            data = json.load(f)
+            f.close()
+            data['files']['css/gone.css'] = data['files']['css/1.css']
+            f = open(state_path, 'w')
+            json.dump(data, f)
+            f.close()
+            
+            plan = mediasync.plan(self.client)
+            self.assertEqual(plan.removed, ['css/gone.css'])
+            self.assertEqual(plan.as_dict()['totals']['removed'], 1)
+            
+        finally:
+            shutil.rmtree(msettings['CACHE_DIR'])
+            msettings['CACHE_DIR'] = None
+            msettings['MANIFEST_FILE'] = None
+            msettings['SYNC_STATE'] = False
+            msettings['PROCESSOR_CACHE'] = False
+        
+class ComboServeTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        msettings['BACKEND'] = 'mediasync.tests.tests'
+        msettings['PROCESSORS'] = []
+        msettings['SERVE_REMOTE'] = False
+        msettings['EMULATE_COMBO'] = True
+        msettings['JOINED'] = {
+            'css/joined.css': ('css/1.css', 'css/2.css'),
+        }
+        self.client = backends.client()
+        self.factory = RequestFactory()
+        
+        self.combined = []
+        def counting_combine_files(*args):
+            self.combined.append(args)
+            return mediasync.combine_files(*args)
+        views.combine_files = counting_combine_files
+    
+    def tearDown(self):
+        views.combine_files = mediasync.combine_files
+        views._combo_cache.clear()
+        msettings['JOINED'] = {}
+        msettings['EMULATE_COMBO'] = False
+        msettings['SERVE_REMOTE'] = True
+        msettings['COMBO_GZIP'] = False
+    
+    def testComboServe(self):
+        
+        expected = readfile(os.path.join(PWD, 'media', '_test', 'joined.css'))
+        
+        response = views.static_serve(self.factory.get('/media/css/joined.css'),
+                                      'css/joined.css', self.client)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, expected)
+        
+        etag = response['ETag']
+        self.assertEqual(etag, '"%s"' % mediasync.checksum(expected)[0])
+        self.assertTrue(response.has_header('Last-Modified'))
+        
+        # the cached combo is reused
+        response = views.static_serve(self.factory.get('/media/css/joined.css'),
+                                      'css/joined.css', self.client)
+        self.assertEqual(response.content, expected)
+        self.assertEqual(len(self.combined), 1)
+        
+        # conditional requests get a 304
+        request = self.factory.get('/media/css/joined.css', HTTP_IF_NONE_MATCH=etag)
+        response = views.static_serve(request, 'css/joined.css', self.client)
+        self.assertEqual(response.status_code, 304)
+        
+        # touching a source regenerates the combo
+        os.utime(os.path.join(PWD, 'media', 'css', '2.css'), (time.time() + 5,) * 2)
+        response = views.static_serve(self.factory.get('/media/css/joined.css'),
+                                      'css/joined.css', self.client)
+        self.assertEqual(response.content, expected)
+        self.assertEqual(len(self.combined), 2)
+    
+    def testComboServeGzip(self):
+        
+        msettings['COMBO_GZIP'] = True
+        expected = readfile(os.path.join(PWD, 'media', '_test', 'joined.css'))
+        
+        request = self.factory.get('/media/css/joined.css', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = views.static_serve(request, 'css/joined.css', self.client)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(response.content)).read(), expected)
+        
+        response = views.static_serve(self.factory.get('/media/css/joined.css'),
+                                      'css/joined.css', self.client)
+        self.assertEqual(response.content, expected)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+class FakeS3Key(object):
+    """
+    Stands in for boto.s3.key.Key, keeping its contents in a FakeS3Bucket.
+    """
+    
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = {}
+        self.data = None
+        self.etag = None
+        self.size = 0
+    
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+    
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+    
+    def set_contents_from_string(self, data, headers=None, md5=None):
+        self.data = data
+        self.size = len(data)
+        self.etag = '"%s"' % mediasync.checksum(data)[0]
+        self.bucket.keys[self.name] = self
+        self.bucket.uploads.append(self.name)
+    
+    def set_contents_from_file(self, fileobj, headers=None, md5=None):
+        self.set_contents_from_string(fileobj.read(), headers, md5)
+    
+    def get_contents_as_string(self):
+        return self.data
+
+class FakeS3Bucket(object):
+    
+    def __init__(self):
+        self.keys = {}
+        self.uploads = []
+        self.lookups = []
+    
+    def get_key(self, name):
+        self.lookups.append(name)
+        return self.keys.get(name)
+    
+    def list(self, prefix=''):
+        return [key for name, key in sorted(self.keys.items()) if name.startswith(prefix)]
+
+class FakeS3MultiPartUpload(object):
+    
+    def __init__(self, bucket, name, headers=None, metadata=None):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = metadata or {}
+        self.parts = []
+        self.cancelled = False
+    
+    def upload_part_from_file(self, fp, part_num):
+        if self.bucket.fail_part == part_num:
+            raise IOError("connection reset")
+        self.parts.append((part_num, fp.read()))
+    
+    def complete_upload(self):
+        key = FakeS3Key(self.bucket, self.name)
+        key.metadata = self.metadata
+        key.set_contents_from_string(''.join(data for num, data in self.parts))
+        key.etag = '"%s-%d"' % (key.etag.strip('"'), len(self.parts))
+    
+    def cancel_upload(self):
+        self.cancelled = True
+
+class FakeS3MultiPartBucket(FakeS3Bucket):
+    """
+    A FakeS3Bucket with the multipart uploads of boto 2.
+    """
+    
+    def __init__(self):
+        super(FakeS3MultiPartBucket, self).__init__()
+        self.multipart_uploads = []
+        self.fail_part = None
+    
+    def initiate_multipart_upload(self, name, headers=None, metadata=None):
+        mp = FakeS3MultiPartUpload(self, name, headers, metadata)
+        self.multipart_uploads.append(mp)
+        return mp
+
 class S3ClientTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -179,6 +1091,188 @@ class S3ClientTestCase(unittest.TestCase):
         msettings['SERVE_REMOTE'] = True
         self.assertEqual(backends.client().media_url(), 'http://s3.amazonaws.com/%s' % self.bucket_name)
     
+    def testVariantChanges(self):
+        
+        from mediasync.backends import s3
+        
+        content = 'var x = 1;\n' * 100
+        key = s3.Key
+        s3.Key = FakeS3Key
+        
+        try:
+            
+            for index in (None, {}):
+                
+                bucket = FakeS3Bucket()
+                self.client._bucket = bucket
+                self.client._index = index
+                self.client._keys = None
+                
+                self.assertTrue(self.client.put(content, 'application/javascript', 'js/x.js'))
+                self.assertEqual(sorted(bucket.uploads), ['js/x.js', 'js/x.js.gzt'])
+                
+                # nothing is sent again while both are unchanged
+                del bucket.uploads[:]
+                self.assertEqual(self.client.put(content, 'application/javascript', 'js/x.js'), None)
+                self.assertEqual(bucket.uploads, [])
+                
+                # a missing or stale variant is repaired without the original
+                if index is None:
+                    del bucket.keys['js/x.js.gzt']
+                    self.client._keys = None
+                else:
+                    index['js/x.js']['variants']['gzt'] = 'stale'
+                
+                # and a dry run plans the same, from the ETags listed without an index
+                planned = self.client.plan_put(backends.PutItem('application/javascript', 'js/x.js', content))
+                self.assertEqual([(obj['path'], obj['upload']) for obj in planned],
+                                 [('js/x.js', False), ('js/x.js.gzt', True)])
+                self.assertEqual([obj['requests'] for obj in planned], [0, 1])
+                self.assertEqual(bucket.uploads, [])
+                
+                self.assertTrue(self.client.put(content, 'application/javascript', 'js/x.js'))
+                self.assertEqual(bucket.uploads, ['js/x.js.gzt'])
+                
+                # no key is looked up on its own
+                self.assertEqual(bucket.lookups, [])
+            
+        finally:
+            s3.Key = key
+            self.client._bucket = None
+            self.client._index = None
+            self.client._keys = None
+    
+    def testIndex(self):
+        
+        from mediasync.backends import s3
+        
+        def stored_index(bucket):
+            return json.loads(bucket.get_key(s3.INDEX_KEY).data)
+        
+        content = 'var x = 1;\n' * 100
+        key = s3.Key
+        s3.Key = FakeS3Key
+        
+        try:
+            
+            # without an index, one is rebuilt from the keys in the bucket,
+            # leaving out keys uploaded in parts since their ETag isn't an MD5
+            bucket = FakeS3Bucket()
+            FakeS3Key(bucket, 'js/x.js').set_contents_from_string(content)
+            FakeS3Key(bucket, 'js/x.js.gzt').set_contents_from_string('gzipped')
+            FakeS3Key(bucket, 'big.mov').set_contents_from_string('movie')
+            bucket.keys['big.mov'].etag = '"0123456789abcdef-3"'
+            
+            self.client._bucket = bucket
+            self.client.load_index()
+            self.assertEqual(self.client._index, {
+                'js/x.js': {'checksum': mediasync.checksum(content)[0], 'size': len(content),
+                            'variants': {'gzt': mediasync.checksum('gzipped')[0]}},
+            })
+            
+            # a rebuilt index is saved at the end of the sync
+            self.client.flush()
+            self.assertEqual(stored_index(bucket)['files'], self.client._index)
+            self.assertEqual(stored_index(bucket)['version'], s3.INDEX_VERSION)
+            
+            # and then loaded instead of listing the bucket
+            del bucket.keys['js/x.js']
+            del bucket.keys['js/x.js.gzt']
+            self.client.load_index()
+            self.assertTrue('js/x.js' in self.client._index)
+            
+            # nothing is written when nothing changed
+            del bucket.uploads[:]
+            self.client.flush()
+            self.assertEqual(bucket.uploads, [])
+            
+            # a corrupt index or one of another version is rebuilt
+            for data in ('{"files": ', json.dumps({'version': s3.INDEX_VERSION + 1, 'files': {}})):
+                bucket.keys[s3.INDEX_KEY].data = data
+                self.client.load_index()
+                self.assertEqual(self.client._index, {})
+                self.assertTrue(self.client._index_dirty)
+            
+            # changed entries are written over the stored index, keeping the
+            # entries another sync added since this one loaded it
+            self.client.flush()
+            self.client.load_index()
+            other = FakeS3Key(bucket, s3.INDEX_KEY)
+            other.set_contents_from_string(json.dumps({'version': s3.INDEX_VERSION,
+                'files': {'css/other.css': {'checksum': 'abc', 'size': 3, 'variants': {}}}}))
+            self.client.put(content, 'application/javascript', 'js/x.js')
+            self.client.flush()
+            self.assertEqual(sorted(stored_index(bucket)['files']), ['css/other.css', 'js/x.js'])
+            
+        finally:
+            s3.Key = key
+            self.client._bucket = None
+            self.client._index = None
+    
+    def testMultipartUpload(self):
+        
+        from mediasync.backends import s3
+        
+        msettings['AWS_MULTIPART_THRESHOLD'] = 1000
+        msettings['AWS_MULTIPART_CHUNK_SIZE'] = 400
+        msettings['AWS_GZIP'] = False
+        key = s3.Key
+        s3.Key = FakeS3Key
+        
+        fd, filepath = tempfile.mkstemp()
+        os.write(fd, 'x' * 1000)
+        os.close(fd)
+        
+        try:
+            
+            # boto before 2.0 can't upload in parts
+            bucket = FakeS3Bucket()
+            self.client._bucket = bucket
+            self.client._index = {}
+            self.assertEqual(self.client.upload_requests(1000), 1)
+            self.assertTrue(self.client.put_file(filepath, 'video/mp4', 'big.mp4'))
+            self.assertEqual(bucket.uploads, ['big.mp4'])
+            
+            # boto 2 uploads files from the threshold up in parts
+            bucket = FakeS3MultiPartBucket()
+            self.client._bucket = bucket
+            self.client._index = {}
+            self.assertEqual(self.client.upload_requests(999), 1)
+            self.assertEqual(self.client.upload_requests(1000), 5)
+            self.assertTrue(self.client.put_file(filepath, 'video/mp4', 'big.mp4'))
+            mp = bucket.multipart_uploads[0]
+            self.assertEqual([(num, len(data)) for num, data in mp.parts], [(1, 400), (2, 400), (3, 200)])
+            self.assertEqual(bucket.get_key('big.mp4').data, 'x' * 1000)
+            self.assertEqual(bucket.get_key('big.mp4').metadata['mediasync-checksum'],
+                             mediasync.checksum('x' * 1000)[1])
+            
+            # the index has the checksum of the content, not the multipart ETag
+            self.assertEqual(self.client._index['big.mp4']['checksum'], mediasync.checksum('x' * 1000)[0])
+            self.assertEqual(self.client.put_file(filepath, 'video/mp4', 'big.mp4'), None)
+            self.assertEqual(len(bucket.multipart_uploads), 1)
+            
+            # without an index, only keys with a multipart ETag are looked up
+            self.client._index = None
+            del bucket.lookups[:]
+            self.assertEqual(self.client.put_file(filepath, 'video/mp4', 'big.mp4'), None)
+            self.assertEqual(bucket.lookups, ['big.mp4'])
+            self.client._index = {}
+            
+            # a failed part cancels the upload
+            bucket.fail_part = 2
+            self.assertRaises(IOError, self.client.put_file, filepath, 'video/mp4', 'big.mp4', True)
+            self.assertTrue(bucket.multipart_uploads[1].cancelled)
+            
+        finally:
+            os.remove(filepath)
+            s3.Key = key
+            self.client._bucket = None
+            self.client._index = None
+            self.client._keys = None
+            del msettings['AWS_MULTIPART_THRESHOLD']
+            del msettings['AWS_MULTIPART_CHUNK_SIZE']
+            del msettings['AWS_GZIP']
+    
     def testSync(self):
         
         # calculate cache control
@@ -217,6 +1311,9 @@ class S3ClientTestCase(unittest.TestCase):
             (hexdigest, b64digest) = mediasync.checksum(local_content)
             self.assertEqual(s3_checksum, b64digest)
             
+            # verify the sync index entry
+            self.assertEqual(self.client._index[path]['checksum'], hexdigest)
+            
             # do a HEAD request on the file
             http_conn.request('HEAD', "/%s/%s" % (self.bucket_name, path))
             response = http_conn.getresponse()
@@ -237,7 +1334,8 @@ class S3ClientTestCase(unittest.TestCase):
             # done with the file, delete it from S3
             key.delete()
             
-            if content_type in mediasync.TYPES_TO_COMPRESS:
+            variants = self.client._index[path]['variants']
+            if content_type in mediasync.TYPES_TO_COMPRESS and 'gzt' in variants:
                 
                 key = bucket.get_key("%s.gzt" % path)
                 
@@ -246,14 +1344,21 @@ class S3ClientTestCase(unittest.TestCase):
                 response = http_conn.getresponse()
                 response.read()
                 
+                # the variant carries the checksum of the compressed data
+                compressed = mediasync.compress(local_content, mediasync.compression_level(content_type))
+                (gzt_hexdigest, gzt_b64digest) = mediasync.checksum(compressed)
                 key_meta = key.get_metadata('mediasync-checksum') or ''
                 s3_checksum = key_meta.replace(' ', '+')
-                self.assertEqual(s3_checksum, b64digest)
+                self.assertEqual(s3_checksum, gzt_b64digest)
+                self.assertEqual(variants['gzt'], gzt_hexdigest)
                 
                 key.delete()
         
         http_conn.close()
         
+        # delete the sync index
+        bucket.get_key(self.client.index_key_name()).delete()
+        
         # wait a moment then delete temporary bucket
         time.sleep(2)
         conn.delete_bucket(self.bucket_name)
@@ -265,6 +1370,143 @@ class S3ClientTestCase(unittest.TestCase):
         del msettings['AWS_BUCKET']
         self.assertRaises(AssertionError, backends.client)
 
+class FakeCloudFilesObject(object):
+    """ Mirrors cloudfiles.storage_object.Object, which has no headers attribute """
+    
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+        self.content_type = None
+        self.etag = None
+    
+    def _make_headers(self):
+        return {'ETag': self.etag, 'Content-Type': self.content_type}
+    
+    def write(self, data):
+        if hasattr(data, 'read'):
+            data = data.read()
+        self.container.objects[self.name] = data
+        self.container.headers[self.name] = self._make_headers()
+        self.container.uploads.append(self.name)
+
+class FakeCloudFilesContainer(object):
+    
+    def __init__(self):
+        self.objects = {}
+        self.headers = {}
+        self.uploads = []
+    
+    def create_object(self, name):
+        return FakeCloudFilesObject(self, name)
+    
+    def public_uri(self):
+        return 'http://cdn.example.com'
+    
+    def list_objects_info(self, limit=None, marker=None):
+        names = sorted(n for n in self.objects if marker is None or n > marker)[:limit]
+        return [{'name': n, 'hash': md5(self.objects[n]).hexdigest()} for n in names]
+
+class CloudFilesClientTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        try:
+            from mediasync.backends import cloudfiles
+        except ImportError:
+            self.skipTest("python-cloudfiles is not installed, skipping test")
+        
+        # skip __init__, which connects to Cloud Files
+        self.client = cloudfiles.Client.__new__(cloudfiles.Client)
+        BaseClient.__init__(self.client)
+        self.client.container = FakeCloudFilesContainer()
+        self.client._etags = None
+        
+        class FakeHeaderObject(cloudfiles.ExtraHeaders, FakeCloudFilesObject):
+            pass
+        self.client.object_class = FakeHeaderObject
+    
+    def tearDown(self):
+        try:
+            del msettings['CLOUDFILES_GZIP']
+        except KeyError:
+            pass
+    
+    def testPut(self):
+        
+        from mediasync.backends import cloudfiles
+        msettings['CLOUDFILES_GZIP'] = True
+        container = self.client.container
+        content = 'var x = 1;\n' * 100
+        
+        self.assertTrue(self.client.put(content, 'application/javascript', 'js/x.js'))
+        self.assertEqual(sorted(container.uploads), ['js/x.js', 'js/x.js.gzt'])
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(container.objects['js/x.js.gzt'])).read(), content)
+        
+        # unchanged objects are skipped using a single listing
+        self.client.open()
+        del container.uploads[:]
+        self.assertEqual(self.client.put(content, 'application/javascript', 'js/x.js'), None)
+        self.assertEqual(container.uploads, [])
+        
+        # a missing variant is uploaded on its own, and force uploads both
+        del self.client._etags['js/x.js.gzt']
+        self.assertTrue(self.client.put(content, 'application/javascript', 'js/x.js'))
+        self.assertEqual(container.uploads, ['js/x.js.gzt'])
+        self.assertTrue(self.client.put(content, 'application/javascript', 'js/x.js', force=True))
+        self.assertEqual(len(container.uploads), 3)
+        
+        # listings are fetched a page at a time
+        limit = cloudfiles.LISTING_LIMIT
+        cloudfiles.LISTING_LIMIT = 1
+        try:
+            self.assertEqual(sorted(self.client.list_etags()), ['js/x.js', 'js/x.js.gzt'])
+        finally:
+            cloudfiles.LISTING_LIMIT = limit
+    
+    def testGzipSetting(self):
+        
+        from mediasync.templatetags import media
+        
+        t = Template('{% load media %}{% js "scripts/jquery.js" %}')
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        tag_client = media.client
+        media.client = self.client
+        msettings['SERVE_REMOTE'] = True
+        try:
+            
+            # variants are opt in, so that upgrading doesn't link .gzt
+            # objects that haven't been uploaded yet
+            self.assertEqual(self.client.get_variants('application/javascript'), [])
+            self.assertEqual(t.render(Context({'request': request})),
+                '<script src="http://cdn.example.com/scripts/jquery.js"></script>')
+            
+            msettings['CLOUDFILES_GZIP'] = True
+            self.assertEqual(self.client.get_variants('application/javascript'), ['gzip'])
+            self.assertEqual(t.render(Context({'request': request})),
+                '<script src="http://cdn.example.com/scripts/jquery.js.gzt"></script>')
+            
+        finally:
+            media.client = tag_client
+    
+    def testHeaders(self):
+        
+        msettings['CLOUDFILES_GZIP'] = True
+        headers = self.client.get_headers('gzip', 'x.js.gzt')
+        self.assertEqual(headers['Cache-Control'], 'max-age=%d, public' % (self.client.expiration_days * 24 * 3600))
+        self.assertRegexpMatches(headers['Expires'], EXPIRES_RE)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        
+        # the headers are sent with the objects themselves
+        container = self.client.container
+        self.client.put('var x = 1;\n' * 100, 'application/javascript', 'js/x.js')
+        sent = container.headers['js/x.js']
+        self.assertEqual(sent['Content-Type'], 'application/javascript')
+        self.assertEqual(sent['ETag'], md5(container.objects['js/x.js']).hexdigest())
+        self.assertRegexpMatches(sent['Expires'], EXPIRES_RE)
+        self.assertFalse('Content-Encoding' in sent)
+        sent = container.headers['js/x.js.gzt']
+        self.assertEqual(sent['Content-Encoding'], 'gzip')
+        self.assertEqual(sent['Content-Disposition'], 'inline; filename="x.js.gzt"')
+
 class ProcessorTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -311,6 +1553,137 @@ class ProcessorTestCase(unittest.TestCase):
     def testCustomProcessor(self):
         procd = self.client.process('asdf', 'text/plain', 'asdf.txt')
         self.assertEqual(procd, "ASDF")
+    
+    def testBatchProcessor(self):
+        
+        def upper(filedata, content_type, remote_path, is_active):
+            return filedata.upper()
+        
+        def tagged(filedata, content_type, remote_path, is_active):
+            return "/*%s*/%s" % (remote_path, filedata)
+        
+        batches = []
+        def tagged_batch(files, is_active):
+            batches.append(files)
+            return [tagged(*(f + (is_active,))) for f in files]
+        tagged.batch = tagged_batch
+        
+        msettings['PROCESSORS'] = (upper, tagged)
+        msettings['SYNC_STATE'] = True
+        msettings['CACHE_DIR'] = tempfile.mkdtemp()
+        media_root = os.path.join(msettings['CACHE_DIR'], 'media')
+        shutil.copytree(os.path.join(PWD, 'media'), media_root)
+        
+        synced = {}
+        def myput(filedata, content_type, remote_path, force):
+            synced[remote_path] = filedata
+        
+        try:
+            
+            client = backends.client()
+            client.media_root = media_root
+            client.put_callback = myput
+            
+            # the files of a batch are processed with a single call, which
+            # gets the data returned by the processors before it
+            mediasync.sync(client, verbose=False, batch_size=50)
+            self.assertEqual(len(batches), 1)
+            self.assertEqual(sorted(path for data, ct, path in batches[0]), sorted(synced))
+            self.assertTrue(all(data == data.upper() for data, ct, path in batches[0]))
+            self.assertEqual(synced['css/1.css'],
+                             '/*css/1.css*/' + readfile(os.path.join(media_root, 'css', '1.css')).upper())
+            
+            # files skipped by the sync state aren't processed at all
+            del batches[:]
+            mediasync.sync(client, verbose=False, batch_size=50)
+            self.assertEqual(batches, [])
+            
+            # a single changed file is processed on its own
+            f = open(os.path.join(media_root, 'css', '1.css'), 'a')
+            f.write('\n')
+            f.close()
+            synced.clear()
+            mediasync.sync(client, verbose=False, batch_size=50)
+            self.assertEqual(batches, [])
+            self.assertEqual(sorted(synced), ['css/1.css'])
+            self.assertTrue(synced['css/1.css'].startswith('/*css/1.css*/'))
+            
+        finally:
+            shutil.rmtree(msettings['CACHE_DIR'])
+            msettings['CACHE_DIR'] = None
+            msettings['SYNC_STATE'] = False
+    
+    def testProcessorCache(self):
+        
+        calls = []
+        def counting_processor(filedata, content_type, remote_path, is_active):
+            calls.append(remote_path)
+            return filedata.upper()
+        
+        msettings['PROCESSORS'] = (counting_processor,)
+        msettings['PROCESSOR_CACHE'] = True
+        msettings['PROCESSOR_CACHE_SIZE'] = 10
+        msettings['CACHE_DIR'] = tempfile.mkdtemp()
+        
+        try:
+            
+            client = backends.client()
+            cache = client.processor_cache
+            
+            self.assertEqual(client.process('asdfasdf', 'text/plain', 'a.txt'), 'ASDFASDF')
+            self.assertEqual(client.process('asdfasdf', 'text/plain', 'a.txt'), 'ASDFASDF')
+            self.assertEqual(len(calls), 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            
+            # a new client picks up entries from disk
+            client = backends.client()
+            self.assertEqual(client.process('asdfasdf', 'text/plain', 'a.txt'), 'ASDFASDF')
+            self.assertEqual(len(calls), 1)
+            
+            # content type is part of the key
+            client.process('asdfasdf', 'text/css', 'a.txt')
+            self.assertEqual(len(calls), 2)
+            
+            # the byte budget only fits one entry, so the oldest is evicted
+            client.process('asdfasdf', 'text/plain', 'a.txt')
+            self.assertEqual(len(calls), 3)
+            
+            # the settings of a processor are part of the key
+            counting_processor.version = lambda: msettings['CLOSURE_COMPILER_LEVEL']
+            msettings['CLOSURE_COMPILER_LEVEL'] = 'WHITESPACE_ONLY'
+            client = backends.client()
+            client.process('asdfasdf', 'text/plain', 'a.txt')
+            client.process('asdfasdf', 'text/plain', 'a.txt')
+            self.assertEqual(len(calls), 4)
+            
+            msettings['CLOSURE_COMPILER_LEVEL'] = 'ADVANCED_OPTIMIZATIONS'
+            client = backends.client()
+            client.process('asdfasdf', 'text/plain', 'a.txt')
+            self.assertEqual(len(calls), 5)
+            
+            from mediasync.processors import closurecompiler, processor_id
+            self.assertTrue(processor_id(closurecompiler.compile).endswith(':ADVANCED_OPTIMIZATIONS|%s' %
+                                                                          closurecompiler.DEFAULT_URL))
+            
+            # unicode results are cached as UTF-8 instead of failing the sync
+            def unicode_processor(filedata, content_type, remote_path, is_active):
+                return u'caf\xe9 { }'
+            msettings['PROCESSORS'] = (unicode_processor,)
+            msettings['PROCESSOR_CACHE_SIZE'] = 64 * 1024 * 1024
+            client = backends.client()
+            self.assertEqual(client.process('cafe { }', 'text/css', 'a.css'), u'caf\xe9 { }')
+            self.assertEqual(client.process('cafe { }', 'text/css', 'a.css'), 'caf\xc3\xa9 { }')
+            self.assertEqual(client.processor_cache.hits, 1)
+            
+        finally:
+            shutil.rmtree(msettings['CACHE_DIR'])
+            msettings['CACHE_DIR'] = None
+            msettings['PROCESSOR_CACHE'] = False
+            msettings['PROCESSOR_CACHE_SIZE'] = 64 * 1024 * 1024
+            try:
+                del msettings['CLOSURE_COMPILER_LEVEL']
+            except KeyError:
+                pass
 
 class ClosureCompilerTestCase(unittest.TestCase):
     
@@ -342,6 +1715,336 @@ class ClosureCompilerTestCase(unittest.TestCase):
         procd = self.client.process(content, 'text/css', 'test.css')
         self.assertEqual(procd, content)
 
+class YUICompressorTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.yui_path = os.environ.get('YUI_COMPRESSOR_PATH')
+        if not self.yui_path:
+            self.skipTest("YUI_COMPRESSOR_PATH not set, skipping test")
+        msettings['SERVE_REMOTE'] = True
+        msettings['BACKEND'] = 'mediasync.tests.tests'
+        msettings['PROCESSORS'] = (
+            'mediasync.processors.yuicompressor.css_minifier',
+            'mediasync.processors.yuicompressor.js_minifier',
+        )
+        settings.MEDIASYNC['YUI_COMPRESSOR_PATH'] = self.yui_path
+        self.client = backends.client()
+    
+    def tearDown(self):
+        settings.MEDIASYNC.pop('YUI_COMPRESSOR_PATH', None)
+        settings.MEDIASYNC.pop('YUI_COMPRESSOR_BATCH', None)
+        msettings['PROCESSORS'] = []
+    
+    def testBatchMatchesSingle(self):
+        
+        settings.MEDIASYNC['YUI_COMPRESSOR_BATCH'] = False
+        single = {}
+        def single_put(filedata, content_type, remote_path, force):
+            single[remote_path] = filedata
+        self.client.put_callback = single_put
+        mediasync.sync(self.client, verbose=False)
+        
+        settings.MEDIASYNC['YUI_COMPRESSOR_BATCH'] = True
+        batched = {}
+        def batched_put(filedata, content_type, remote_path, force):
+            batched[remote_path] = filedata
+        self.client.put_callback = batched_put
+        mediasync.sync(self.client, verbose=False)
+        
+        self.assertEqual(single, batched)
+    
+    def testFailure(self):
+        
+        from mediasync.processors import yuicompressor
+        
+        settings.MEDIASYNC['YUI_COMPRESSOR_PATH'] = '/not/a/compressor.jar'
+        self.assertRaises(mediasync.SyncException, yuicompressor.js_minifier,
+                          'var a = 1;', 'application/javascript', 'a.js', True)
+
+class CompilerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for the Closure Compiler service that upper cases the code it
+    is sent. The server's failures attribute is the number of requests to
+    answer with a server error before succeeding.
+    """
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def do_POST(self):
+        self.server.requests.append(self.client_address)
+        params = urlparse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(503)
+            body = ''
+        else:
+            self.send_response(200)
+            body = ("%s /* %s */" % (params['js_code'][0], params['compilation_level'][0])).upper()
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+class ClosureCompilerStandInTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        
+        from mediasync.processors import closurecompiler
+        self.closurecompiler = closurecompiler
+        
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CompilerRequestHandler)
+        self.server.requests = []
+        self.server.failures = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        
+        msettings['SERVE_REMOTE'] = True
+        msettings['BACKEND'] = 'mediasync.tests.tests'
+        msettings['PROCESSORS'] = ('mediasync.processors.closurecompiler.compile',)
+        msettings['CLOSURE_COMPILER_URL'] = 'http://127.0.0.1:%d/compile' % self.server.server_port
+        self.client = backends.client()
+    
+    def tearDown(self):
+        self.closurecompiler.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        del msettings['CLOSURE_COMPILER_URL']
+        msettings['CLOSURE_COMPILER_LEVEL'] = 'SIMPLE_OPTIMIZATIONS'
+    
+    def testCompiler(self):
+        
+        procd = self.client.process('var a = 1;', 'application/javascript', 'a.js')
+        self.assertEqual(procd, 'VAR A = 1; /* SIMPLE_OPTIMIZATIONS */')
+        
+        # a different file reuses the same connection
+        self.client.process('var b = 2;', 'application/javascript', 'b.js')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(set(self.server.requests)), 1)
+        
+        # without the processor cache every file is compiled
+        self.client.process('var a = 1;', 'application/javascript', 'c.js')
+        self.assertEqual(len(self.server.requests), 3)
+        
+        # with it, compiled code is cached by source, level and service URL
+        cache_dir = tempfile.mkdtemp()
+        msettings['PROCESSOR_CACHE'] = True
+        msettings['CACHE_DIR'] = cache_dir
+        try:
+            client = backends.client()
+            client.process('var a = 1;', 'application/javascript', 'a.js')
+            client.process('var a = 1;', 'application/javascript', 'c.js')
+            self.assertEqual(len(self.server.requests), 4)
+            
+            # processors are identified when a client is created
+            msettings['CLOSURE_COMPILER_LEVEL'] = 'WHITESPACE_ONLY'
+            client = backends.client()
+            procd = client.process('var a = 1;', 'application/javascript', 'a.js')
+            self.assertEqual(procd, 'VAR A = 1; /* WHITESPACE_ONLY */')
+            self.assertEqual(len(self.server.requests), 5)
+            
+            msettings['CLOSURE_COMPILER_URL'] += '?other'
+            client = backends.client()
+            client.process('var a = 1;', 'application/javascript', 'a.js')
+            self.assertEqual(len(self.server.requests), 6)
+        finally:
+            msettings['PROCESSOR_CACHE'] = False
+            msettings['CACHE_DIR'] = None
+            shutil.rmtree(cache_dir)
+    
+    def testRetry(self):
+        
+        self.server.failures = 2
+        procd = self.client.process('var a = 1;', 'application/javascript', 'a.js')
+        self.assertEqual(procd, 'VAR A = 1; /* SIMPLE_OPTIMIZATIONS */')
+        self.assertEqual(len(self.server.requests), 3)
+        
+        self.server.failures = 3
+        self.assertRaises(mediasync.SyncException, self.client.process,
+                          'var b = 2;', 'application/javascript', 'b.js')
+
+class StorageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for a storage service that keeps every file it is PUT. The
+    server tracks the largest number of requests it handled at once.
+    """
+    
+    def do_PUT(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            # give other requests a chance to overlap with this one
+            time.sleep(0.01)
+            self.server.files[self.path] = (body, dict(self.headers))
+            self.send_response(201)
+            self.end_headers()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+    
+    def log_message(self, *args):
+        pass
+
+class TricklingRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers a PUT a line at a time, pausing before each line for the
+    number of seconds given in server.pauses.
+    """
+    
+    def do_PUT(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        lines = ('HTTP/1.0 201 Created\r\n', 'Server: trickle\r\n', 'X-Slow: 1\r\n', '\r\n')
+        for pause, line in zip(self.server.pauses, lines):
+            time.sleep(pause)
+            self.wfile.write(line)
+    
+    def log_message(self, *args):
+        pass
+
+class StorageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+class AsyncSyncTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        
+        self.server = StorageServer(('127.0.0.1', 0), StorageRequestHandler)
+        self.server.files = {}
+        self.server.lock = threading.Lock()
+        self.server.active = 0
+        self.server.max_active = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        
+        self.tmpdir = tempfile.mkdtemp()
+        
+        msettings['SERVE_REMOTE'] = True
+        msettings['MANIFEST_FILE'] = os.path.join(self.tmpdir, 'manifest.json')
+        msettings['BACKEND'] = 'mediasync.backends.http'
+        msettings['HTTP_PUT_URL'] = 'http://127.0.0.1:%d/storage' % self.server.server_port
+        msettings['PROCESSORS'] = []
+        msettings['JOINED'] = {
+            'css/joined.css': ('css/1.css', 'css/2.css'),
+            'js/joined.js': ('js/1.js', 'js/2.js'),
+        }
+        self.client = backends.client()
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        del msettings['HTTP_PUT_URL']
+        msettings['MANIFEST_FILE'] = None
+        msettings['BACKEND'] = 'mediasync.tests.tests'
+        msettings['JOINED'] = {}
+    
+    def testSync(self):
+        
+        msettings['STREAMING_THRESHOLD'] = 100
+        try:
+            mediasync.sync(self.client, verbose=False, concurrency=4)
+        finally:
+            msettings['STREAMING_THRESHOLD'] = 4 * 1024 * 1024
+        
+        expected = {}
+        for item in itertools.chain(mediasync.joined_items(self.client), mediasync.static_items(self.client)):
+            expected["/storage/%s" % item.remote_path] = item.read(self.client)
+        
+        for path, content in expected.iteritems():
+            body, headers = self.server.files[path]
+            self.assertEqual(body, content)
+            self.assertEqual(headers['content-md5'], mediasync.checksum(content)[1])
+            self.assertRegexpMatches(headers['expires'], EXPIRES_RE)
+            
+            gzt = self.server.files.get("%s.gzt" % path)
+            if gzt is not None:
+                self.assertEqual(gzt[1]['content-encoding'], 'gzip')
+                self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(gzt[0])).read(), content)
+        
+        self.assertTrue(self.server.max_active > 1)
+        self.assertTrue(self.server.max_active <= 8) # 4 files with a variant each
+        
+        # a blocking put works outside of a sync
+        self.assertTrue(self.client.put('abc', 'text/plain', 'a.txt'))
+        self.assertEqual(self.server.files['/storage/a.txt'][0], 'abc')
+    
+    def testFailure(self):
+        
+        # nothing listens on a port that was just closed
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        
+        msettings['HTTP_PUT_URL'] = 'http://127.0.0.1:%d/storage' % port
+        client = backends.client()
+        self.assertRaises(mediasync.SyncException, client.put, 'abc', 'text/plain', 'a.txt')
+    
+    def testTimeout(self):
+        
+        server = StorageServer(('127.0.0.1', 0), TricklingRequestHandler)
+        # the client hangs up on requests that time out; let their handlers
+        # finish quietly
+        server.handle_error = lambda request, client_address: None
+        server.daemon_threads = False
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            msettings['HTTP_PUT_URL'] = 'http://127.0.0.1:%d/storage' % server.server_port
+            client = backends.client()
+            client.timeout = 0.3
+            
+            # the response takes longer than the timeout, but keeps coming
+            server.pauses = (0.1, 0.1, 0.1, 0.1)
+            self.assertTrue(client.put('abc', 'text/plain', 'a.txt'))
+            
+            # a connection that goes quiet for longer times out
+            server.pauses = (0, 0.6, 0, 0)
+            self.assertRaises(mediasync.SyncException, client.put, 'abc', 'text/plain', 'a.txt')
+        finally:
+            server.shutdown()
+            server.server_close()
+    
+    def testBlockingBackend(self):
+        
+        msettings['BACKEND'] = 'mediasync.tests.tests'
+        client = backends.client()
+        
+        serial = []
+        def serial_put(filedata, content_type, remote_path, force):
+            serial.append((remote_path, str(filedata)))
+            return True
+        
+        client.put_callback = serial_put
+        mediasync.sync(client, verbose=False)
+        
+        adapted = []
+        def adapted_put(filedata, content_type, remote_path, force):
+            adapted.append((remote_path, str(filedata)))
+            return True
+        
+        client.put_callback = adapted_put
+        
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            mediasync.sync(client, verbose=True, jobs=3, concurrency=5)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        
+        # blocking puts run in the executor, output keeps the serial order
+        self.assertEqual(sorted(serial), sorted(adapted))
+        printed = [line.split(' ', 1)[1] for line in output.splitlines()]
+        self.assertEqual(printed, [path for path, filedata in serial])
+
 class SignalTestCase(unittest.TestCase):
     
     def setUp(self):
@@ -386,6 +2089,96 @@ class SignalTestCase(unittest.TestCase):
         for sass_path in glob.glob(os.path.join(root, "*/*.s[ac]ss")):
             css_path = sass_path[:-4] + "css"
             self.assertTrue(os.path.exists(css_path))
+    
+    def testIncrementalSass(self):
+        
+        from mediasync import sass
+        
+        root = tempfile.mkdtemp()
+        bindir = os.path.join(root, '_bin dir')
+        os.mkdir(bindir)
+        
+        # stands in for sass: copies each stylesheet to its CSS, logs
+        # its arguments and fails on stylesheets that contain "error"
+        script = os.path.join(bindir, 'fake_sass.py')
+        log = os.path.join(root, 'log')
+        f = open(script, 'w')
+        f.write("import sys\n"
+                "args = sys.argv[1:]\n"
+                "open(%r, 'a').write(' '.join(args) + '\\n')\n"
+                "if args[0] == '--update':\n"
+                "    pairs = [arg.split(':') for arg in args[1:]]\n"
+                "else:\n"
+                "    pairs = [args]\n"
+                "for src, dst in pairs:\n"
+                "    data = open(src).read()\n"
+                "    if 'error' in data:\n"
+                "        sys.stderr.write('bad stylesheet')\n"
+                "        sys.exit(1)\n"
+                "    open(dst, 'w').write(data)\n" % log)
+        f.close()
+        
+        def write(path, data, mtime=None):
+            path = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = open(path, 'w')
+            f.write(data)
+            f.close()
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+        
+        def runs():
+            if not os.path.exists(log):
+                return []
+            lines = readfile(log).splitlines()
+            os.unlink(log)
+            return lines
+        
+        past = time.time() - 100
+        write('css/a.scss', '@import "partials/colors", "reset.css";\na { color: $red; }', past)
+        write('css/partials/_colors.scss', '$red: #f00;', past)
+        write('css/b.sass', '@import colors\nb\n  color: red', past)
+        write('css/_colors.sass', '$red: #f00', past)
+        
+        msettings['SASS_COMMAND'] = '%s "%s"' % (sys.executable, script)
+        
+        try:
+            
+            # stale stylesheets are compiled with one run, partials aren't
+            self.assertEqual(sorted(sass.compile_stale(root)),
+                             [os.path.join(root, 'css', 'a.scss'), os.path.join(root, 'css', 'b.sass')])
+            self.assertEqual(len(runs()), 1)
+            self.assertTrue(os.path.exists(os.path.join(root, 'css', 'a.css')))
+            self.assertFalse(os.path.exists(os.path.join(root, 'css', '_colors.css')))
+            
+            # nothing is compiled until an import changes
+            self.assertEqual(sass.compile_stale(root), [])
+            self.assertEqual(runs(), [])
+            write('css/partials/_colors.scss', '$red: #e00;', time.time() + 10)
+            self.assertEqual(sass.compile_stale(root), [os.path.join(root, 'css', 'a.scss')])
+            self.assertEqual(len(runs()), 1)
+            
+            # failures are reported with the stylesheets that caused them
+            write('css/a.scss', 'error', time.time() + 20)
+            write('css/b.sass', 'b\n  color: blue', time.time() + 20)
+            try:
+                sass.compile_stale(root)
+            except mediasync.SyncException, e:
+                self.assertTrue('1 of 2' in str(e))
+                self.assertTrue('a.scss: exit code 1: bad stylesheet' in str(e))
+            else:
+                self.fail("no SyncException")
+            self.assertEqual(len(runs()), 3) # the batch, then one run per file
+            
+            # without batching each stylesheet is compiled on its own
+            write('css/a.scss', 'a { color: red; }', time.time() + 30)
+            self.assertEqual(len(sass.compile_stale(root, batch=False, jobs=2)), 2)
+            self.assertEqual(len(runs()), 2)
+        
+        finally:
+            del msettings['SASS_COMMAND']
+            shutil.rmtree(root)
 
 class TemplateTagTestCase(unittest.TestCase):
     
@@ -457,6 +2250,157 @@ class TemplateTagTestCase(unittest.TestCase):
             t.render(c),
             '<script src="http://localhost/%s"></script>' % pathvar)
     
+    def testFingerprintedTags(self):
+        
+        tmpdir = tempfile.mkdtemp()
+        msettings['SERVE_REMOTE'] = True
+        msettings['FINGERPRINT'] = True
+        msettings['MANIFEST_FILE'] = os.path.join(tmpdir, 'manifest.json')
+        msettings['CACHE_BUSTER'] = 1234
+        
+        try:
+            
+            manifest.save({
+                'scripts/jquery.js': {'name': 'scripts/jquery.0123456789ab.js'},
+                'images/logo.png': {'name': 'images/logo.ba9876543210.png'},
+            })
+            
+            c = Context({})
+            
+            t = Template('{% load media %}{% js "scripts/jquery.js" %}')
+            self.assertEqual(t.render(c),
+                '<script src="http://localhost/scripts/jquery.0123456789ab.js"></script>')
+            
+            t = Template('{% load media %}{% media_url "images/logo.png" %}')
+            self.assertEqual(t.render(c), 'http://localhost/images/logo.ba9876543210.png')
+            
+            # files missing from the manifest keep their name and cache buster
+            t = Template('{% load media %}{% media_url "images/other.png" %}')
+            self.assertEqual(t.render(c), 'http://localhost/images/other.png?1234')
+            
+        finally:
+            shutil.rmtree(tmpdir)
+            msettings['FINGERPRINT'] = False
+            msettings['MANIFEST_FILE'] = None
+            msettings['CACHE_BUSTER'] = None
+            manifest.reload()
+    
+    def testMemoizedTags(self):
+        
+        from mediasync.templatetags import media
+        
+        calls = []
+        media_url = media.client.media_url
+        def counting_media_url(*args, **kwargs):
+            calls.append(args)
+            return media_url(*args, **kwargs)
+        media.client.media_url = counting_media_url
+        
+        try:
+            
+            t = Template('{% load media %}{% js "scripts/jquery.js" %}{% js pathvar %}')
+            
+            c = Context({'pathvar': 'scripts/1.js'})
+            self.assertEqual(t.render(c),
+                '<script src="http://localhost/scripts/jquery.js"></script>'
+                '<script src="http://localhost/scripts/1.js"></script>')
+            self.assertEqual(len(calls), 2)
+            
+            # only the variable path is rendered again
+            c = Context({'pathvar': 'scripts/2.js'})
+            self.assertEqual(t.render(c),
+                '<script src="http://localhost/scripts/jquery.js"></script>'
+                '<script src="http://localhost/scripts/2.js"></script>')
+            self.assertEqual(len(calls), 3)
+            
+            # changing a setting throws away the memoized markup
+            msettings['DOCTYPE'] = 'xhtml'
+            self.assertEqual(t.render(c),
+                '<script type="text/javascript" charset="utf-8" src="http://localhost/scripts/jquery.js"></script>'
+                '<script type="text/javascript" charset="utf-8" src="http://localhost/scripts/2.js"></script>')
+            
+        finally:
+            del media.client.media_url
+            msettings['DOCTYPE'] = 'html5'
+    
+    def testConcurrentRenders(self):
+        
+        from mediasync.tests import benchmark_tags
+        
+        # renders from many threads match those from a single one, even
+        # while sync() changes serve_remote on the shared client
+        mismatches = benchmark_tags.stress(count=2, threads=4, renders=20)
+        self.assertEqual(mismatches, [])
+    
+    def testContentEncoding(self):
+        
+        from mediasync.templatetags import media
+        
+        self.assertEqual(media.accepted_encodings('gzip, deflate, br;q=0.8, identity;q=0'),
+                         {'gzip': 1.0, 'deflate': 1.0, 'br': 0.8})
+        
+        factory = RequestFactory()
+        t = Template('{% load media %}{% js "scripts/jquery.js" %}{% media_url "images/logo.png" %}')
+        
+        def render(accept_encoding):
+            request = factory.get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+            return t.render(Context({'request': request}))
+        
+        media.client.supports_gzip = lambda: True
+        media.client.supports_brotli = lambda: True
+        msettings['SERVE_REMOTE'] = True
+        tmpdir = tempfile.mkdtemp()
+        
+        try:
+            
+            # Brotli is preferred unless the client prefers gzip
+            self.assertEqual(render('gzip, deflate, br'),
+                '<script src="http://localhost/scripts/jquery.js.brt"></script>'
+                'http://localhost/images/logo.png')
+            self.assertEqual(render('gzip, br;q=0.5'),
+                '<script src="http://localhost/scripts/jquery.js.gzt"></script>'
+                'http://localhost/images/logo.png')
+            self.assertEqual(render('identity'),
+                '<script src="http://localhost/scripts/jquery.js"></script>'
+                'http://localhost/images/logo.png')
+            
+            # backends without Brotli variants fall back to gzip
+            media.client.supports_brotli = lambda: False
+            self.assertEqual(render('br, gzip'),
+                '<script src="http://localhost/scripts/jquery.js.gzt"></script>'
+                'http://localhost/images/logo.png')
+            
+            # only variants recorded in the manifest are linked
+            msettings['MANIFEST_FILE'] = os.path.join(tmpdir, 'manifest.json')
+            media.client.supports_brotli = lambda: True
+            manifest.save({'scripts/jquery.js': {'name': 'scripts/jquery.js', 'variants': ['gzip']}})
+            self.assertEqual(render('br, gzip'),
+                '<script src="http://localhost/scripts/jquery.js.gzt"></script>'
+                'http://localhost/images/logo.png')
+            manifest.save({'scripts/jquery.js': {'name': 'scripts/jquery.js', 'variants': []}})
+            self.assertEqual(render('br, gzip'),
+                '<script src="http://localhost/scripts/jquery.js"></script>'
+                'http://localhost/images/logo.png')
+            
+            # without a manifest entry, variants are only assumed to exist
+            # when the compression policy can't have left them out
+            manifest.save({})
+            self.assertEqual(render('gzip'),
+                '<script src="http://localhost/scripts/jquery.js.gzt"></script>'
+                'http://localhost/images/logo.png')
+            msettings['COMPRESS_MIN_SIZE'] = 256
+            self.assertEqual(render('gzip'),
+                '<script src="http://localhost/scripts/jquery.js"></script>'
+                'http://localhost/images/logo.png')
+            
+        finally:
+            del media.client.supports_gzip
+            del media.client.supports_brotli
+            shutil.rmtree(tmpdir)
+            msettings['MANIFEST_FILE'] = None
+            msettings['COMPRESS_MIN_SIZE'] = 0
+            manifest.reload()
+    
     def testMultipleTags(self):
         
         paths = ('scripts/1.js','scripts/2.js')
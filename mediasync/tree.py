@@ -0,0 +1,239 @@
+"""
+Single pass index of the files in the media root.
+
+scan() lists a directory tree with one stat per entry and yields a
+MediaFile with the relative path, size, mtime and content type of each
+file. Directories and files whose names start with a dot or an underscore
+are skipped, and the SYNC_INCLUDE and SYNC_EXCLUDE rules decide which of
+the remaining files are synced. Symlinked directories are followed, except
+for links back into a directory that is already being listed.
+
+Rules are glob patterns matched against the path of a file relative to the
+media root, such as ``*.psd`` or ``img/originals/*``, or regular
+expressions when they start with ``re:``. An excluded directory is not
+listed at all. When there are include rules, only the files that match
+one of them are synced.
+"""
+from mediasync.conf import msettings
+import fnmatch
+import mimetypes
+import os
+import re
+import stat
+import threading
+
+try:
+    scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None # listdir() and a stat per entry are used instead
+
+def is_hidden(name):
+    return name.startswith('.') or name.startswith('_')
+
+def compile_rule(rule):
+    """
+    Returns a compiled regular expression for a glob pattern, a pattern
+    that starts with re: or an already compiled expression.
+    """
+    if not isinstance(rule, basestring):
+        return rule
+    if rule.startswith('re:'):
+        return re.compile(rule[3:])
+    return re.compile(fnmatch.translate(rule.strip('/')))
+
+class Rules(object):
+    """
+    Compiled include and exclude rules.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = [compile_rule(rule) for rule in include or ()]
+        self.exclude = [compile_rule(rule) for rule in exclude or ()]
+
+    def _matches(self, rules, path):
+        for rule in rules:
+            if rule.match(path):
+                return True
+        return False
+
+    def allows_dir(self, path):
+        return not self._matches(self.exclude, path)
+
+    def allows_file(self, path):
+        if self.include and not self._matches(self.include, path):
+            return False
+        return not self._matches(self.exclude, path)
+
+    def allows_dirs(self, path):
+        """
+        True if the files in the directory at path, relative to the media
+        root, can be synced: neither it nor any directory above it is
+        hidden or excluded.
+        """
+        parts = path.strip('/').split('/')
+        for i in range(1, len(parts) + 1):
+            if is_hidden(parts[i - 1]) or not self.allows_dir('/'.join(parts[:i])):
+                return False
+        return True
+
+    def allows(self, path):
+        """
+        True if the file at path, relative to the media root, is synced:
+        neither it nor any of its directories is hidden or excluded.
+        """
+        parts = path.strip('/').split('/')
+        if is_hidden(parts[-1]):
+            return False
+        if len(parts) > 1 and not self.allows_dirs('/'.join(parts[:-1])):
+            return False
+        return self.allows_file('/'.join(parts))
+
+_rules = None
+_rules_lock = threading.Lock()
+
+def sync_rules():
+    """
+    Returns the Rules of the SYNC_INCLUDE and SYNC_EXCLUDE settings. They
+    are compiled again only when the settings change.
+    """
+    global _rules
+    generation = msettings.generation
+    rules = _rules
+    if rules is None or rules[0] != generation:
+        compiled = Rules(msettings['SYNC_INCLUDE'], msettings['SYNC_EXCLUDE'])
+        with _rules_lock:
+            _rules = rules = (generation, compiled)
+    return rules[1]
+
+# content types by file extension, mimetypes.guess_type() is slow
+_content_types = {}
+
+def guess_type(path):
+    """
+    Returns the content type of path, or None. Same as
+    mimetypes.guess_type(), but cached by the last two extensions so that
+    the type of style.min.css and of archive.tar.gz are still found.
+    """
+    extensions = os.path.basename(path).split('.')[1:]
+    key = '.'.join(extensions[-2:])
+    try:
+        return _content_types[key]
+    except KeyError:
+        content_type = key and mimetypes.guess_type("file.%s" % key)[0] or None
+        _content_types[key] = content_type
+        return content_type
+
+class MediaFile(object):
+
+    __slots__ = ('path', 'filepath', 'size', 'mtime', 'content_type')
+
+    def __init__(self, path, filepath, size, mtime, content_type):
+        self.path = path
+        self.filepath = filepath
+        self.size = size
+        self.mtime = mtime
+        self.content_type = content_type
+
+    def __repr__(self):
+        return "<MediaFile %s>" % self.path
+
+def media_file(filepath, path, st=None):
+    """
+    Returns a MediaFile for the file at filepath, stat'ing it unless st is
+    given, or None if it is not a regular file.
+    """
+    if st is None:
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    content_type = guess_type(path) or msettings['DEFAULT_MIMETYPE']
+    return MediaFile(path, filepath, st.st_size, st.st_mtime, content_type)
+
+def _entries(dirpath):
+    """
+    Returns (name, path, is_dir, is_link, stat) for each entry of a
+    directory, in order of name. is_link is True for symlinked directories
+    and stat is None for directories.
+    """
+    entries = []
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    entries.append((entry.name, entry.path, True, False, None))
+                elif entry.is_symlink() and entry.is_dir():
+                    entries.append((entry.name, entry.path, True, True, None))
+                else:
+                    entries.append((entry.name, entry.path, False, False, entry.stat()))
+            except OSError:
+                continue # removed while listing
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                entries.append((name, path, True, os.path.islink(path), None))
+            else:
+                entries.append((name, path, False, False, st))
+    entries.sort()
+    return entries
+
+def _loops(realpath, parents):
+    """
+    True if a symlink to the directory realpath leads back to one of
+    parents, the real paths of the directories being listed, or to a
+    directory above them.
+    """
+    prefix = realpath.rstrip(os.sep) + os.sep
+    for parent in parents:
+        if parent == realpath or parent.startswith(prefix):
+            return True
+    return False
+
+def scan(root, rules=None, prefix=''):
+    """
+    Yields a MediaFile for each file under root that isn't hidden and is
+    allowed by rules, directory by directory in order of name. Paths are
+    relative to root and separated with slashes. Files in symlinked
+    directories are listed under the name of the link. prefix is put in
+    front of the paths, so that a directory in the media root can be
+    listed with the rules of the whole media root.
+    """
+    if rules is None:
+        rules = Rules()
+    root = os.path.abspath(root)
+    # pending directories carry the real paths of themselves and of the
+    # directories above them, to stop at symlinks that loop
+    pending = [(root, prefix, (os.path.realpath(root),))]
+    while pending:
+        dirpath, prefix, parents = pending.pop()
+        subdirs = []
+        for name, path, is_dir, is_link, st in _entries(dirpath):
+            if is_hidden(name):
+                continue
+            relpath = prefix + name
+            if is_dir:
+                if not rules.allows_dir(relpath):
+                    continue
+                if is_link:
+                    realpath = os.path.realpath(path)
+                    if _loops(realpath, parents):
+                        continue
+                else:
+                    realpath = os.path.join(parents[-1], name)
+                subdirs.append((path, relpath + '/', parents + (realpath,)))
+            elif rules.allows_file(relpath):
+                item = media_file(path, relpath, st)
+                if item is not None:
+                    yield item
+        # visit subdirectories in order of name
+        pending.extend(reversed(subdirs))
@@ -5,11 +5,68 @@ these are shimmed in.
 
 The static_serve() function is where the party starts.
 """
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.shortcuts import redirect
+from django.utils.http import http_date, parse_http_date_safe
 from django.views.static import serve
-from mediasync import combine_files
+from mediasync import checksum, combine_files, compress, joined_sources
 from mediasync.conf import msettings
+from mediasync.tree import sync_rules
+import os
+import threading
+
+# Generated combo files, keyed by the JOINED entry. Each entry is only used
+# while the sources and the mediasync settings are unchanged.
+_combo_cache = {}
+_combo_lock = threading.Lock()
+
+def _combo_signature(joinfile, sourcefiles, client):
+    """
+    Returns the mtime and size of each source of a combo file, along with
+    the settings generation, so that a change to either is noticed.
+    """
+    signature = [msettings.generation]
+    for sourcepath in joined_sources(joinfile, sourcefiles, client):
+        try:
+            st = os.stat(sourcepath)
+            signature.append((sourcepath, st.st_mtime, st.st_size))
+        except OSError:
+            signature.append((sourcepath, None, None))
+    return tuple(signature)
+
+def _build_combo(joinfile, sourcefiles, mime_type, client):
+    """
+    Combines and processes a combo file. Returns a dict with the data, its
+    ETag and the last modified time of its newest source.
+    """
+    combo_data, dirname = combine_files(joinfile, sourcefiles, client)
+
+    remote_path = joinfile.strip('/')
+    if dirname:
+        remote_path = "%s/%s" % (dirname, remote_path)
+    combo_data = client.process(combo_data, mime_type, remote_path)
+
+    mtimes = [os.path.getmtime(path) for path in joined_sources(joinfile, sourcefiles, client)
+              if os.path.isfile(path)]
+
+    return {
+        'data': combo_data,
+        'etag': '"%s"' % checksum(combo_data)[0],
+        'last_modified': int(max(mtimes)) if mtimes else None,
+    }
+
+def _not_modified(request, etag, last_modified):
+    """
+    True if the conditional headers of the request match the combo file.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date_safe(if_modified_since.split(';')[0])
+        return since is not None and last_modified <= since
+    return False
 
 def combo_serve(request, path, client):
     """
@@ -18,18 +75,53 @@ def combo_serve(request, path, client):
     the value that we would if we were serving from S3. This is a good way
     to make sure combo files work as intended before rolling out
     to production.
+    
+    Generated combo files are kept in memory until one of their sources
+    changes, and are sent with ETag and Last-Modified headers so that
+    browsers can make conditional requests. If COMBO_GZIP is on, clients
+    that accept gzip are sent a compressed response.
     """
     joinfile = path
     sourcefiles = msettings['JOINED'][path]
-    # Generate the combo file as a string.
-    combo_data, dirname = combine_files(joinfile, sourcefiles, client)
     
     if path.endswith('.css'):
         mime_type = 'text/css'
     elif joinfile.endswith('.js'):
         mime_type = 'application/javascript'
 
-    return HttpResponse(combo_data, mimetype=mime_type)
+    signature = _combo_signature(joinfile, sourcefiles, client)
+    with _combo_lock:
+        combo = _combo_cache.get(joinfile)
+    if combo is None or combo['signature'] != signature:
+        # Generate the combo file as a string.
+        combo = _build_combo(joinfile, sourcefiles, mime_type, client)
+        combo['signature'] = signature
+        with _combo_lock:
+            _combo_cache[joinfile] = combo
+
+    use_gzip = msettings['COMBO_GZIP'] and \
+               'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    etag = combo['etag']
+    if use_gzip:
+        etag = '%s-gzip"' % etag[:-1]
+
+    if _not_modified(request, etag, combo['last_modified']):
+        response = HttpResponseNotModified()
+    elif use_gzip:
+        if 'gzip_data' not in combo:
+            combo['gzip_data'] = compress(combo['data'])
+        response = HttpResponse(combo['gzip_data'], mimetype=mime_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(combo['data'], mimetype=mime_type)
+
+    response['ETag'] = etag
+    if combo['last_modified'] is not None:
+        response['Last-Modified'] = http_date(combo['last_modified'])
+    if msettings['COMBO_GZIP']:
+        response['Vary'] = 'Accept-Encoding'
+
+    return response
 
 def _form_key_str(path):
     """
@@ -104,8 +196,12 @@ def static_serve(request, path, client):
             # We found a combo file match. Combine it and serve the result.
             return combo_serve(request, combo_match, client)
 
-    # No combo file, but we're serving locally. Use the standard (inefficient)
-    # Django static serve view.
+    # No combo file, but we're serving locally. Hidden and excluded files
+    # aren't served, so that they aren't used by mistake.
+    if not sync_rules().allows(path) and os.path.isfile(os.path.join(client.media_root, path)):
+        raise Http404(u'"%s" is not synced' % path)
+
+    # Use the standard (inefficient) Django static serve view.
     
     resp = serve(request, path, document_root=client.media_root, show_indexes=True)
     try:
@@ -0,0 +1,260 @@
+"""
+Keeps the backend in sync with the media root while files are edited.
+
+watch() syncs everything once, then waits for files under the media root
+to change and syncs only those, along with the JOINED files that are
+built from them. Changes are picked up with inotify when pyinotify is
+installed and by polling the modification times of the files otherwise.
+Files are listed with mediasync.tree.scan(), so the watcher and sync()
+agree on which files are media.
+"""
+from mediasync import joined_items, static_item
+from mediasync.tree import scan, sync_rules
+import mediasync
+import os
+import sys
+import time
+import traceback
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+def is_hidden(root, path):
+    """
+    True if path is in a directory under root that starts with a dot, such
+    as the .mediasync cache directory.
+    """
+    relpath = os.path.relpath(path, root)
+    return any(part.startswith('.') for part in relpath.split(os.sep)[:-1])
+
+class PollingWatcher(object):
+    """
+    Finds changed files by comparing the modification time and size of the
+    files under root every interval seconds.
+    """
+
+    name = 'polling'
+
+    def __init__(self, root, interval=1.0):
+        self.root = os.path.abspath(root)
+        self.interval = interval
+        self.files = {}
+
+    def scan(self):
+        files = {}
+        for media_file in scan(self.root, sync_rules()):
+            files[media_file.filepath] = (media_file.mtime, media_file.size)
+        return files
+
+    def start(self):
+        self.files = self.scan()
+
+    def stop(self):
+        pass
+
+    def changes(self, timeout=None):
+        """
+        Waits up to timeout seconds, or until something changes if timeout
+        is None, and returns the set of paths that were changed, added or
+        removed.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            files = self.scan()
+            changed = set(path for path in set(files) | set(self.files)
+                          if files.get(path) != self.files.get(path))
+            self.files = files
+            if changed:
+                return changed
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return changed
+            time.sleep(wait)
+
+class InotifyWatcher(object):
+    """
+    Finds changed files with inotify, through pyinotify.
+    """
+
+    name = 'inotify'
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.changed = set()
+        self.notifier = None
+
+    def start(self):
+
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                watcher.add(event)
+
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB)
+        manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(manager, Handler())
+        manager.add_watch(self.root, mask, rec=True, auto_add=True,
+                          exclude_filter=lambda path: path != self.root and is_hidden(self.root, path + os.sep))
+
+    def add(self, event):
+        if is_hidden(self.root, event.pathname):
+            return
+        if event.dir:
+            if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+                # files can be created before the new directory is watched
+                relpath = '/'.join(os.path.relpath(event.pathname, self.root).split(os.sep))
+                rules = sync_rules()
+                if rules.allows_dirs(relpath):
+                    self.changed.update(media_file.filepath for media_file in
+                                        scan(event.pathname, rules, relpath + '/'))
+        else:
+            self.changed.add(event.pathname)
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+    def changes(self, timeout=None):
+        """
+        Same as PollingWatcher.changes().
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self.changed:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                wait = int(wait * 1000)
+            if self.notifier.check_events(timeout=wait):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        changed, self.changed = self.changed, set()
+        return changed
+
+def get_watcher(root, interval=None):
+    """
+    Returns an InotifyWatcher if pyinotify is installed and no polling
+    interval is given, a PollingWatcher otherwise.
+    """
+    if pyinotify is not None and interval is None:
+        return InotifyWatcher(root)
+    return PollingWatcher(root, interval or 1.0)
+
+def wait_for_changes(watcher, delay=0.5):
+    """
+    Waits for files to change, then keeps collecting changes until none
+    are made for delay seconds, so that a burst of saves is synced once.
+    """
+    changed = watcher.changes()
+    while True:
+        more = watcher.changes(delay)
+        if not more:
+            return changed
+        changed |= more
+
+def changed_items(client, paths):
+    """
+    Returns the SyncItems to put for a set of changed paths, JOINED files
+    first, and the remote paths of static files that were removed.
+    """
+    root = os.path.abspath(client.media_root)
+    paths = set(os.path.abspath(path) for path in paths)
+
+    items = []
+    for item in joined_items(client):
+        if any(os.path.abspath(source) in paths for source in item.sources):
+            items.append(item)
+
+    removed = []
+    for path in sorted(paths):
+        parts = os.path.relpath(path, root).split(os.sep)
+        if parts[0] == os.pardir:
+            continue # outside of the media root
+        remote_path = '/'.join(parts)
+        item = static_item(client, remote_path)
+        if item is not None:
+            items.append(item)
+        elif not os.path.exists(path) and len(parts) > 1 and sync_rules().allows(remote_path):
+            removed.append(remote_path)
+
+    return items, removed
+
+def watch(client=None, force=False, verbose=True, jobs=None, processes=None, concurrency=None,
+          batch_size=None, rebuild_state=False, delay=0.5, watcher=None, rounds=None):
+    """
+    Syncs the media root, then keeps the client open and syncs the files
+    that change until interrupted. pre_sync and post_sync are sent around
+    the first sync and around each batch of changes.
+
+    Files that are removed locally are dropped from the sync state and the
+    manifest, but not from the backend. watcher defaults to the one
+    returned by get_watcher(). rounds is the number of batches of changes
+    to sync before returning, forever if it is None.
+    """
+    from mediasync import backends
+    from mediasync.signals import pre_sync, post_sync
+
+    if client is None:
+        client = backends.client()
+
+    options = mediasync._sync_options(client, jobs, processes, concurrency, batch_size)
+
+    if watcher is None:
+        watcher = get_watcher(client.media_root)
+
+    client.open()
+    client.serve_remote = True
+
+    try:
+
+        pre_sync.send(sender=client)
+
+        state = mediasync._load_state(client, rebuild_state)
+        manifest = mediasync._new_manifest(client)
+
+        # watch before the first sync so that changes made during it are synced
+        watcher.start()
+        mediasync._sync_and_record(client, mediasync._all_items(client), force, state, manifest,
+                                   verbose, *options)
+
+        post_sync.send(sender=client)
+
+        if verbose:
+            print "[watch] watching %s with %s" % (client.media_root, watcher.name)
+
+        synced = 0
+        while rounds is None or synced < rounds:
+
+            items, removed = changed_items(client, wait_for_changes(watcher, delay))
+            if not items and not removed:
+                continue
+            synced += 1
+
+            try:
+                pre_sync.send(sender=client)
+                for remote_path in removed:
+                    if state is not None:
+                        state.forget(remote_path)
+                    if manifest is not None:
+                        manifest.pop(remote_path, None)
+                mediasync._sync_and_record(client, items, force, state, manifest, verbose, *options)
+                post_sync.send(sender=client)
+            except Exception:
+                # keep watching, the files are synced again when they are fixed
+                traceback.print_exc(file=sys.stderr)
+
+    finally:
+        watcher.stop()
+        client.close()